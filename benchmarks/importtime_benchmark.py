@@ -0,0 +1,77 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the import cost of the pyri-core launcher using "python -X importtime",
+# and the wall time of "pyri-core --help", which includes plugin discovery.
+#
+#   python benchmarks/importtime_benchmark.py --repeat 5 --json importtime.json
+
+
+def run_importtime(module):
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = []
+    for l in res.stderr.splitlines():
+        if not l.startswith("import time:") or "self [us]" in l:
+            continue
+        self_us, cumulative_us, name = l[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+            "depth": depth})
+    total_us = sum(m["self_us"] for m in modules)
+    return total_us, modules
+
+
+def run_help(repeat):
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "pyri.core", "--help"], stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - t1)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser("pyri-core import time benchmark")
+    parser.add_argument("--module", type=str, default="pyri.core.__main__")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", type=str, default=None, help="Write results to a JSON file")
+    args = parser.parse_args()
+
+    totals = []
+    modules = None
+    for _ in range(args.repeat):
+        total_us, modules = run_importtime(args.module)
+        totals.append(total_us)
+
+    help_times = run_help(args.repeat)
+
+    top_level = sorted((m for m in modules if m["depth"] == 1), key=lambda m: m["cumulative_us"], reverse=True)
+
+    print(f"import {args.module}: median {statistics.median(totals)/1000:.1f} ms, "
+        f"min {min(totals)/1000:.1f} ms ({len(modules)} modules)")
+    print(f"pyri-core --help: median {statistics.median(help_times)*1000:.1f} ms, min {min(help_times)*1000:.1f} ms")
+    print()
+    print(f"{'cumulative [ms]':>16}  module")
+    for m in top_level[:args.top]:
+        print(f"{m['cumulative_us']/1000:16.1f}  {m['module']}")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({
+                "module": args.module,
+                "python": sys.version,
+                "import_total_us": totals,
+                "help_wall_s": help_times,
+                "modules": modules
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
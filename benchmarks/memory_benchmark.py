@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from pyri.core.__main__ import PyriCore
+from pyri.core import resource_monitor
+from pyri_core_benchmark import launches as bench_launches
+
+# Compares the memory use of the default service set run isolated, each
+# service in its own interpreter, and shared, all services as threads in one
+# host process (extra_params["hosting"] = "shared"). Linux only, run from the
+# benchmarks directory:
+#
+#   python memory_benchmark.py --json memory.json
+#
+# The services are synthetic, see pyri_core_benchmark/services/typical.py.
+# Memory is measured after all services are ready, as the sum of the PSS
+# (proportional set size, shared pages divided between the processes sharing
+# them) and of the RSS of the service and host processes.
+
+
+def _read_pss(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for l in f:
+                if l.startswith("Pss:"):
+                    return int(l.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(core):
+    pgids = core.service_process_groups()
+    groups = resource_monitor.read_process_groups(list(pgids.values()))
+    procs = [p for pgid in pgids.values() for p in groups.get(pgid, [])]
+    pss = [_read_pss(p["pid"]) for p in procs]
+    return {
+        "processes": len(procs),
+        "rss_mb": sum(p["rss_bytes"] for p in procs) / 1048576,
+        "pss_mb": sum(pss) / 1048576 if None not in pss else None,
+        "threads": sum(p["threads"] for p in procs)
+    }
+
+
+async def _wait_all_ready(core, names):
+    await asyncio.gather(*[core.wait_service_ready(n) for n in names])
+
+
+def run_mode(hosting, args):
+    launches = bench_launches.typical_launches(hosting, args.working_set_kb)
+    loop = asyncio.new_event_loop()
+    def loop_in_thread():
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    t = threading.Thread(target=loop_in_thread, daemon=True)
+    t.start()
+
+    with tempfile.TemporaryDirectory(prefix=f"pyri-core-memory-{hosting}-") as log_dir:
+        out = io.StringIO() if args.quiet else sys.stdout
+        with contextlib.redirect_stdout(out):
+            core = PyriCore(None, launches, argparse.Namespace(service_ready_timeout=300,
+                resource_sample_interval=0), Path(log_dir), loop)
+            t0 = time.perf_counter()
+            loop.call_soon_threadsafe(core.start_all)
+            names = [l.name for l in launches]
+            asyncio.run_coroutine_threadsafe(_wait_all_ready(core, names), loop).result(300)
+            time_to_ready = time.perf_counter() - t0
+            time.sleep(args.settle_time)
+            res = measure(core)
+            core.close()
+            t.join(5)
+    res["services"] = len(launches)
+    res["time_to_ready_s"] = time_to_ready
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser("pyri-core service memory benchmark")
+    parser.add_argument("--working-set-kb", type=int, default=512, help="Memory allocated by each service")
+    parser.add_argument("--settle-time", type=float, default=2, help="Seconds to wait after all services are ready")
+    parser.add_argument("--quiet", action="store_true", default=False, help="Hide the launcher output")
+    parser.add_argument("--json", type=str, default=None, help="Write results to a JSON file")
+    args = parser.parse_args()
+
+    if not sys.platform.startswith("linux"):
+        print("The memory benchmark requires Linux")
+        return
+
+    results = {mode: run_mode(mode, args) for mode in ("isolated", "shared")}
+
+    print()
+    print(f"{'mode':<10}{'processes':>10}{'PSS [MB]':>10}{'RSS [MB]':>10}{'ready [s]':>10}")
+    for mode, r in results.items():
+        pss = f"{r['pss_mb']:.1f}" if r["pss_mb"] is not None else "n/a"
+        print(f"{mode:<10}{r['processes']:>10}{pss:>10}{r['rss_mb']:>10.1f}{r['time_to_ready_s']:>10.2f}")
+    isolated, shared = results["isolated"], results["shared"]
+    if isolated["pss_mb"] and shared["pss_mb"] is not None:
+        print(f"Shared hosting saves {isolated['pss_mb'] - shared['pss_mb']:.1f} MB PSS "
+            f"({100 * (1 - shared['pss_mb'] / isolated['pss_mb']):.0f}%) for {isolated['services']} services")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({
+                "python": sys.version,
+                "working_set_kb": args.working_set_kb,
+                "results": results
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from pyri.core.__main__ import PyriCore
+from . import launches as bench_launches
+
+# Launcher overhead benchmarks using synthetic services. Run from the
+# benchmarks directory:
+#
+#   python -m pyri_core_benchmark --json results.json
+#   python -m pyri_core_benchmark --compare results.json
+#
+# Each scenario starts a PyriCore with its own event loop thread, the same
+# way main() does, and measures launcher CPU time, log throughput, event
+# loop lag, time until all services are ready, and the time PyriCore.close()
+# takes to stop them.
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            t1 = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - t1 - self.interval, 0))
+
+    def summary(self):
+        if len(self.lags) == 0:
+            return {"samples": 0}
+        lags = sorted(self.lags)
+        return {
+            "samples": len(lags),
+            "mean_ms": statistics.mean(lags) * 1000,
+            "p99_ms": lags[min(int(len(lags) * 0.99), len(lags) - 1)] * 1000,
+            "max_ms": lags[-1] * 1000
+        }
+
+
+def _parser_results(args):
+    return argparse.Namespace(
+        fork_server=args.fork_server,
+        service_ready_timeout=300,
+        resource_sample_interval=0,
+        log_max_size=0
+    )
+
+
+def _log_bytes(path):
+    # Service log files and their rotated copies
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.name.endswith(".txt") or ".txt." in f.name)
+
+
+def _count_starts(core):
+    starts = dict()
+    for e in core.trace.to_json()["traceEvents"]:
+        if e["name"] == "START_PENDING":
+            starts[e["tid"]] = starts.get(e["tid"], 0) + 1
+    return sum(starts.values())
+
+
+async def _wait_all_ready(core, names):
+    await asyncio.gather(*[core.wait_service_ready(n) for n in names])
+
+
+def run_scenario(name, launches, args, run_time=0, wait_ready=True):
+    loop = asyncio.new_event_loop()
+    def loop_in_thread():
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    t = threading.Thread(target=loop_in_thread, daemon=True)
+    t.start()
+
+    with tempfile.TemporaryDirectory(prefix=f"pyri-core-bench-{name}-") as log_dir:
+        out = io.StringIO() if args.quiet else sys.stdout
+        with contextlib.redirect_stdout(out):
+            core = PyriCore(None, launches, _parser_results(args), Path(log_dir), loop)
+            lag = LoopLagMonitor()
+            lag_future = asyncio.run_coroutine_threadsafe(lag.run(), loop)
+
+            ru0 = resource.getrusage(resource.RUSAGE_SELF)
+            t0 = time.perf_counter()
+            loop.call_soon_threadsafe(core.start_all)
+            time_to_ready = None
+            if wait_ready:
+                asyncio.run_coroutine_threadsafe(_wait_all_ready(core, [l.name for l in launches]), loop).result(300)
+                time_to_ready = time.perf_counter() - t0
+            if run_time > 0:
+                time.sleep(run_time)
+            t_run = time.perf_counter() - t0
+
+            lag_future.cancel()
+            t1 = time.perf_counter()
+            core.close()
+            time_to_stopped = time.perf_counter() - t1
+            ru1 = resource.getrusage(resource.RUSAGE_SELF)
+            t.join(5)
+
+        log_bytes = _log_bytes(log_dir)
+
+    cpu_time = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+    res = {
+        "services": len(launches),
+        "launcher_cpu_s": cpu_time,
+        "launcher_cpu_percent": 100.0 * cpu_time / (t_run + time_to_stopped),
+        "time_to_all_ready_s": time_to_ready,
+        "time_to_all_stopped_s": time_to_stopped,
+        "log_bytes": log_bytes,
+        "log_throughput_mb_s": log_bytes / 1048576 / time_to_ready if time_to_ready else None,
+        "starts": _count_starts(core),
+        "loop_lag": lag.summary()
+    }
+    return res
+
+
+def _scenarios(args):
+    return {
+        "idle": lambda: run_scenario("idle", bench_launches.idle_launches(args.idle_count), args, run_time=1),
+        "log_flood": lambda: run_scenario("log_flood", bench_launches.log_flood_launches(args.flood_count,
+            args.flood_stdout_mb, args.flood_stderr_mb), args),
+        "slow_start": lambda: run_scenario("slow_start", bench_launches.slow_start_launches(), args),
+        "crash": lambda: run_scenario("crash", bench_launches.crash_launches(), args, run_time=3, wait_ready=False),
+        "ignore_sigint": lambda: run_scenario("ignore_sigint", bench_launches.ignore_sigint_launches(), args)
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _print_results(results, baseline=None):
+    keys = ["time_to_all_ready_s", "time_to_all_stopped_s", "launcher_cpu_s", "log_throughput_mb_s", "starts"]
+    for name, r in results.items():
+        print(f"{name}:")
+        for k in keys:
+            v = r.get(k)
+            if v is None:
+                continue
+            line = f"  {k:<24} {v:10.3f}" if isinstance(v, float) else f"  {k:<24} {v:10}"
+            b = baseline.get(name, {}).get(k) if baseline is not None else None
+            if b:
+                line += f"  ({(v - b) / b * 100:+.1f}% vs baseline {b:.3f})"
+            print(line)
+        lag = r["loop_lag"]
+        if lag.get("samples", 0) > 0:
+            print(f"  {'loop_lag_p99_ms':<24} {lag['p99_ms']:10.3f}")
+            print(f"  {'loop_lag_max_ms':<24} {lag['max_ms']:10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser("pyri-core launcher benchmark")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run, default all")
+    parser.add_argument("--json", type=str, default=None, help="Write results to a JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with a previous JSON result file")
+    parser.add_argument("--fork-server", action="store_true", default=False)
+    parser.add_argument("--idle-count", type=int, default=30)
+    parser.add_argument("--flood-count", type=int, default=4)
+    parser.add_argument("--flood-stdout-mb", type=float, default=20)
+    parser.add_argument("--flood-stderr-mb", type=float, default=5)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", default=True,
+        help="Show launcher output")
+    args = parser.parse_args()
+
+    # The synthetic services are run with "python -m pyri_core_benchmark.services.*"
+    bench_dir = str(Path(__file__).absolute().parent.parent)
+    os.environ["PYTHONPATH"] = os.pathsep.join([bench_dir] + [p for p in [os.environ.get("PYTHONPATH")] if p])
+
+    scenarios = _scenarios(args)
+    names = args.scenarios if len(args.scenarios) > 0 else list(scenarios.keys())
+    results = dict()
+    for n in names:
+        print(f"Running {n}...", file=sys.stderr)
+        results[n] = scenarios[n]()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["scenarios"]
+    _print_results(results, baseline)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({
+                "timestamp": datetime.now().isoformat(),
+                "commit": _git_commit(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "fork_server": args.fork_server,
+                "scenarios": results
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from pyri.plugins.service_node_launch import ServiceNodeLaunch
+
+# Synthetic ServiceNodeLaunch definitions used by the launcher benchmarks.
+# The services only use the standard library, so the benchmarks run without
+# Robot Raconteur devices or the rest of the PyRI services installed.
+
+_plugin_name = "pyri-core-benchmark"
+_services = "pyri_core_benchmark.services"
+_ready = {"readiness": {"type": "stdout", "marker": "READY"}}
+
+
+def _args(args):
+    return lambda parser_results: list(args)
+
+
+def idle_launches(count=30):
+    return [ServiceNodeLaunch(f"idle_{i}", _plugin_name, f"{_services}.idle", depends=[], extra_params=_ready)
+        for i in range(count)]
+
+
+def log_flood_launches(count=4, stdout_mb=20, stderr_mb=5):
+    return [ServiceNodeLaunch(f"log_flood_{i}", _plugin_name, f"{_services}.log_flood",
+        prepare_service_args=_args([f"--stdout-mb={stdout_mb}", f"--stderr-mb={stderr_mb}"]), depends=[],
+        extra_params={"readiness": {"type": "stdout", "marker": "FLOOD DONE"}, "ready_timeout": 300})
+        for i in range(count)]
+
+
+def slow_start_launches(count=5, delay=0.5):
+    # A dependency chain of slow starting services
+    return [ServiceNodeLaunch(f"slow_start_{i}", _plugin_name, f"{_services}.slow_start",
+        prepare_service_args=_args([str(delay)]), depends=[f"slow_start_{i-1}"] if i > 0 else [],
+        extra_params=_ready)
+        for i in range(count)]
+
+
+def crash_launches(count=3, restart_backoff=0.1):
+    return [ServiceNodeLaunch(f"crash_{i}", _plugin_name, f"{_services}.crash", depends=[], restart=True,
+        restart_backoff=restart_backoff)
+        for i in range(count)]
+
+
+def ignore_sigint_launches(count=2):
+    return [ServiceNodeLaunch(f"ignore_sigint_{i}", _plugin_name, f"{_services}.ignore_sigint", depends=[],
+        extra_params=_ready)
+        for i in range(count)]
+
+
+# Names of the services started by default by pyri-core, with the dependencies of the real services
+_typical_services = [("variable_storage", []), ("device_manager", ["variable_storage"]),
+    ("devices_states", ["device_manager"]), ("sandbox", ["device_manager"]), ("program_master", ["device_manager"]),
+    ("robotics_jog", ["device_manager"]), ("robotics_motion", ["device_manager"]), ("webui_server", ["device_manager"])]
+
+
+def typical_launches(hosting="isolated", working_set_kb=512):
+    return [ServiceNodeLaunch(name, _plugin_name, f"{_services}.typical",
+        prepare_service_args=_args([f"--working-set-kb={working_set_kb}"]), depends=depends,
+        extra_params=dict(_ready, hosting=hosting))
+        for name, depends in _typical_services]
+
+
+class PyriCoreBenchmarkServiceNodeLaunchFactory:
+    def get_plugin_name(self):
+        return _plugin_name
+
+    def get_service_node_launch_names(self):
+        return [l.name for l in self.get_service_node_launches()]
+
+    def get_service_node_launches(self):
+        return idle_launches(2) + slow_start_launches(2) + log_flood_launches(1, 1, 1)
+
+
+def get_service_node_launch_factory():
+    return PyriCoreBenchmarkServiceNodeLaunchFactory()
@@ -0,0 +1,4 @@
+import sys
+
+print("crashing", file=sys.stderr, flush=True)
+sys.exit(1)
@@ -0,0 +1,8 @@
+import time
+
+print("READY", flush=True)
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,7 @@
+import signal
+import time
+
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+print("READY", flush=True)
+while True:
+    time.sleep(1)
@@ -0,0 +1,33 @@
+import argparse
+import sys
+import time
+
+# Writes stdout_mb and stderr_mb of log lines as fast as possible, prints
+# FLOOD DONE, and then idles until stopped
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--stdout-mb", type=float, default=10)
+parser.add_argument("--stderr-mb", type=float, default=2)
+parser.add_argument("--line-length", type=int, default=120)
+args = parser.parse_args()
+
+line = "x" * (args.line_length - 1) + "\n"
+stdout_lines = int(args.stdout_mb * 1048576 / len(line))
+stderr_lines = int(args.stderr_mb * 1048576 / len(line))
+ratio = stdout_lines // max(stderr_lines, 1)
+j = 0
+for i in range(stdout_lines):
+    sys.stdout.write(line)
+    if j < stderr_lines and i % max(ratio, 1) == 0:
+        sys.stderr.write(line)
+        j += 1
+for _ in range(j, stderr_lines):
+    sys.stderr.write(line)
+sys.stderr.flush()
+sys.stdout.write("FLOOD DONE\n")
+sys.stdout.flush()
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,10 @@
+import sys
+import time
+
+time.sleep(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
+print("READY", flush=True)
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
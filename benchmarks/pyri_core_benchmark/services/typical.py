@@ -0,0 +1,45 @@
+import argparse
+import importlib
+import time
+
+# Simulates the memory use of a typical PyRI service: it imports the modules
+# the PyRI services use, or standard library modules of similar size when
+# they are not installed, and keeps a small working set.
+
+_modules = ["asyncio", "json", "threading", "traceback", "argparse", "pathlib", "logging", "sqlite3",
+    "xml.etree.ElementTree", "http.server", "email.parser", "decimal", "uuid", "ssl", "concurrent.futures"]
+_optional_modules = ["numpy", "yaml", "RobotRaconteur", "RobotRaconteurCompanion"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--working-set-kb", type=int, default=512)
+    args = parser.parse_args()
+
+    for m in _modules:
+        importlib.import_module(m)
+    for m in _optional_modules:
+        try:
+            importlib.import_module(m)
+        except ImportError:
+            pass
+    working_set = [bytearray(1024) for _ in range(args.working_set_kb)]
+
+    print("READY", flush=True)
+    try:
+        from pyri.util.wait_exit import wait_exit
+    except ImportError:
+        wait_exit = None
+    try:
+        if wait_exit is not None:
+            wait_exit()
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    del working_set
+
+
+if __name__ == "__main__":
+    main()
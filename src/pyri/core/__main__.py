@@ -1,10 +1,11 @@
 import argparse
 from ctypes import ArgumentError
 import asyncio
-import yaml
+import importlib
 from typing import NamedTuple, List
 from enum import Enum
 import threading
+import json
 import traceback
 import appdirs
 from pathlib import Path
@@ -14,11 +15,28 @@ import os
 import time
 import signal
 from . import subprocess_impl
-from pyri.util.wait_exit import wait_exit
-from pyri.plugins.service_node_launch import get_all_service_node_launches
-from pyri.device_manager_client import _DeviceManagerConnectFilter
-from RobotRaconteur.Client import *
-from RobotRaconteurCompanion.Util.IdentifierUtil import IdentifierUtil
+from . import dependencies
+from . import readiness
+from .log_writer import PyriLogWriter
+from .log_buffer import PyriLogBuffer
+from . import fork_server
+from . import agent
+from . import detached
+from . import process_resources
+from . import plugin_cache
+from . import profiles
+from . import resource_monitor
+from . import service_host
+from . import loop_stats
+from . import preflight
+from . import tracing
+from . import watchdog
+from . import heartbeat
+from .restart_policy import RestartPolicy
+from .default_devices import PyriDefaultDeviceRegistration
+
+# The Robot Raconteur stack is imported on demand when default devices are
+# added, so that starting the launcher does not pay for loading it
 
 # Based on MS Windows service states
 class ProcessState(Enum):
@@ -29,6 +47,8 @@ class ProcessState(Enum):
     CONTINUE_PENDING = 0x5
     PAUSE_PENDING = 0x6
     PAUSED = 0x7
+    # Not restarted after crashing repeatedly, or a dependency failed
+    FAILED = 0x8
 
 #TODO: Don't hard code services to start
 # service_node_launch = [
@@ -42,6 +62,11 @@ class ProcessState(Enum):
 #     ServiceNodeLaunch("webui_server","pyri.webui_server", ["--device-manager-url=rr+tcp://{{ HOSTNAME }}:59902?service=device_manager"],["device_manager"])
 # ]
 
+_read_chunk_size = 65536
+_activation_modes = ("eager", "on-demand", "idle-stop")
+_hosting_modes = ("isolated", "shared")
+_max_partial_line = 65536
+
 class PyriProcess:
     def __init__(self, parent, service_node_launch, parser_results, log_dir, loop):
         self.parent = parent
@@ -50,63 +75,230 @@ class PyriProcess:
         self.log_dir = log_dir
         self.loop = loop
         self._keep_going = True
+        self._restart_requested = False
+        self._hung = False
+        self._detaching = False
         self._process = None
+        self._readiness_probe = None
+        self._watchdog = None
+        self._partial_lines = dict()
+        self._spawn_time = None
+        self._stop_requested_time = None
+        self._state = ProcessState.STOPPED
+        self._wakeup = None
+        self._run_task = None
+        self.restart_policy = parent.create_restart_policy(service_node_launch.name)
+        self.log_buffer = parent.log_buffer(service_node_launch.name)
+        self.structured_logs = parent.structured_logs
+
+    def _set_state(self, state):
+        self._state = state
+        self.parent.process_state_changed(self.service_node_launch.name, state)
+
+    async def _sleep_restart_backoff(self, delay):
+        # close() wakes up the backoff sleep so shutdown isn't delayed
+        self._wakeup = self.loop.create_future()
+        try:
+            await asyncio.wait([self._wakeup], timeout=delay)
+        finally:
+            self._wakeup = None
     
+    async def _wait_ready(self, probe, timeout):
+        s = self.service_node_launch
+        try:
+            await asyncio.wait_for(probe.wait_ready(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: service {s.name} did not report ready within {timeout} seconds")
+        except asyncio.CancelledError:
+            return
+        except Exception:
+            traceback.print_exc()
+            print(f"Warning: readiness check for service {s.name} failed")
+        if self._process is not None and probe is self._readiness_probe:
+            self.parent.process_ready(s.name)
+
+    def _start_readiness_probe(self):
+        s = self.service_node_launch
+        probe = self.parent.create_readiness_probe(s.name)
+        if probe is None:
+            self.parent.process_ready(s.name)
+            return None
+        try:
+            probe.start(self.loop)
+        except Exception:
+            traceback.print_exc()
+            print(f"Warning: could not start readiness check for service {s.name}")
+            self.parent.process_ready(s.name)
+            return None
+        self._readiness_probe = probe
+        timeout = self.parent.service_param(s.name, "ready_timeout", self.parent.ready_timeout)
+        return asyncio.ensure_future(self._wait_ready(probe, timeout))
+
+    def _stop_readiness_probe(self, ready_task):
+        if ready_task is not None:
+            ready_task.cancel()
+        probe = self._readiness_probe
+        self._readiness_probe = None
+        if probe is not None:
+            try:
+                probe.close()
+            except Exception:
+                traceback.print_exc()
+
+    def _feed_lines(self, stream_name, data):
+        partial = self._partial_lines.get(stream_name, None)
+        if partial is not None:
+            data = partial + data
+        i = data.rfind(b"\n")
+        if i < 0:
+            if len(data) <= _max_partial_line:
+                self._partial_lines[stream_name] = data
+                return
+            i = len(data)
+        self._partial_lines[stream_name] = data[i+1:]
+        # Decode all complete lines at once, the partial line may end in the middle of a character
+        text = data[:i].decode("utf-8", errors="replace")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+        self._feed_text_lines(stream_name, text.split("\n"))
+
+    def _feed_text_lines(self, stream_name, lines):
+        ts = time.time()
+        if self.log_buffer is not None:
+            self.log_buffer.append(stream_name, lines, ts)
+        if self.structured_logs is not None:
+            self.structured_logs.append(self.service_node_launch.name, stream_name, lines, ts)
+        if self._readiness_probe is not None:
+            for line in lines:
+                self._readiness_probe.feed_line(stream_name, line)
+        w = self._watchdog
+        if w is not None and w.channel == "stdout":
+            for line in lines:
+                w.feed_line(stream_name, line)
+
+    async def _pump_output(self, stream_name, stream, log):
+        first = True
+        stats = self.parent.loop_stats
+        name = self.service_node_launch.name
+        while True:
+            data = await stream.read(_read_chunk_size)
+            if len(data) == 0:
+                break
+            if first:
+                first = False
+                self.parent.trace.instant(self.service_node_launch.name, f"first {stream_name}")
+                self.parent.record_timing(self.service_node_launch.name, "first_output")
+            log.write(data)
+            if stats is not None:
+                stats.record_output(name, stream_name, data)
+            if self._readiness_probe is not None or self.log_buffer is not None or self.structured_logs is not None \
+                    or (self._watchdog is not None and self._watchdog.channel == "stdout"):
+                self._feed_lines(stream_name, data)
+            # Stops reading the pipe while the log writer is behind
+            await log.drain()
+        partial = self._partial_lines.pop(stream_name, b"")
+        if len(partial) > 0:
+            self._feed_text_lines(stream_name, [partial.decode("utf-8", errors="replace").rstrip("\r")])
+
     async def run(self):
         s = self.service_node_launch
         stdout_log_fname = self.log_dir.joinpath(f"{s.name}.txt")
         stderr_log_fname = self.log_dir.joinpath(f"{s.name}.stderr.txt")
-        with open(stdout_log_fname,"w") as stdout_log, open(stderr_log_fname,"w") as stderr_log:
+        log_writer = self.parent.log_writer
+        stdout_log = log_writer.open(stdout_log_fname)
+        stderr_log = log_writer.open(stderr_log_fname)
+        try:
             while self._keep_going:
+                ready_task = None
                 try:
-                    self.parent.process_state_changed(s.name,ProcessState.START_PENDING)
+                    self._set_state(ProcessState.START_PENDING)
                     stderr_log.write(f"Starting process {s.name}...\n")
                     args = s.prepare_service_args(self.parser_results)
-                    python_exe = sys.executable
-                    self._process = await subprocess_impl.create_subprocess_exec(python_exe,(["-m", s.module_main] + args))
+                    trace = self.parent.trace
+                    self._spawn_time = trace.now()
+                    self._stop_requested_time = None
+                    # Services left running by a previous pyri-core are adopted, see --detach-services
+                    self._process = await self.parent.adopt_service_subprocess(s.name, s.module_main, args)
+                    adopted = self._process is not None
+                    if not adopted:
+                        self._watchdog = self.parent.create_watchdog(s.name, self._heartbeat_missed)
+                        self._process = await self.parent.create_service_subprocess(s.name, s.module_main, args,
+                            watchdog=self._watchdog)
+                    if not self._keep_going:
+                        # close() was called while the process was being created
+                        self._process.send_term()
+                    t_exec = trace.now()
+                    trace.complete(s.name, "spawn", self._spawn_time, t_exec, {"pid": self._process.pid})
+                    self.parent.record_timing(s.name, "spawned", t_exec)
                     # print(f"process pid: {self._process.pid}")
-                    stderr_log.write(f"Process {s.name} started\n\n")                   
-                    self.parent.process_state_changed(s.name,ProcessState.RUNNING)
-                    stdout_read_task = asyncio.ensure_future(self._process.stdout.readline())
-                    stderr_read_task = asyncio.ensure_future(self._process.stderr.readline())
-                    while self._keep_going:
-                        wait_tasks = list(filter(lambda x: x is not None, [stdout_read_task, stderr_read_task]))
-                        if len(wait_tasks) == 0:
-                            break
-                        done, pending = await asyncio.wait(wait_tasks,return_when=asyncio.FIRST_COMPLETED)
-                        if stderr_read_task in done:
-                            stderr_line = await stderr_read_task
-                            if len(stderr_line) == 0:
-                                stderr_read_task = None
-                            else:
-                                stderr_log.write(stderr_line.decode("utf-8")) 
-                                stderr_log.flush()
-                                stderr_read_task = asyncio.ensure_future(self._process.stderr.readline())
-                        if stdout_read_task in done:
-                            stdout_line = await stdout_read_task
-                            if len(stdout_line) == 0:
-                                stdout_read_task = None
-                            else:
-                                stdout_log.write(stdout_line.decode("utf-8"))
-                                stdout_log.flush()
-                                stdout_read_task = asyncio.ensure_future(self._process.stdout.readline())
-                    await self._process.wait()
-                    self.parent.process_state_changed(s.name,ProcessState.STOPPED)
+                    stderr_log.write(f"Process {s.name} {'adopted' if adopted else 'started'}\n\n")
+                    self._set_state(ProcessState.RUNNING)
+                    if self._watchdog is not None:
+                        self._watchdog.start()
+                    if adopted:
+                        # An adopted service was already ready, its readiness markers may have been
+                        # printed before this pyri-core was started
+                        ready_task = None
+                        self.parent.process_ready(s.name)
+                    else:
+                        ready_task = self._start_readiness_probe()
+                    self._partial_lines = dict()
+                    await asyncio.gather(
+                        self._pump_output("stdout", self._process.stdout, stdout_log),
+                        self._pump_output("stderr", self._process.stderr, stderr_log)
+                    )
+                    returncode = await self._process.wait()
+                    self._stop_readiness_probe(ready_task)
+                    t_exit = trace.now()
+                    trace.complete(s.name, "run", t_exec, t_exit, {"returncode": returncode})
+                    if self._stop_requested_time is not None:
+                        trace.complete(s.name, "stop", self._stop_requested_time, t_exit)
+                    self._set_state(ProcessState.STOPPED)
                 except:
                     self._process = None
-                    self.parent.process_state_changed(s.name,ProcessState.STOPPED)
+                    self._stop_readiness_probe(ready_task)
+                    self._set_state(ProcessState.STOPPED)
                     traceback.print_exc()
                     stderr_log.write(f"\nProcess {s.name} error:\n")
                     stderr_log.write(traceback.format_exc())
                 self._process = None
-                if not s.restart:
+                if self._watchdog is not None:
+                    self._watchdog.close()
+                    self._watchdog = None
+                if self._restart_requested:
+                    self._restart_requested = False
+                    hung, self._hung = self._hung, False
+                    if not hung:
+                        continue
+                    # Restarts of hung services count as crashes, so a service that keeps hanging
+                    # is not restarted forever
+                    if not self._keep_going:
+                        break
+                elif not s.restart or not self._keep_going:
                     break
-                if self._keep_going:
-                    await asyncio.sleep(s.restart_backoff)
+                t_exit = trace.now()
+                delay = self.restart_policy.record_exit(t_exit, t_exit - self._spawn_time if self._spawn_time is not None else 0)
+                if delay is None:
+                    policy = self.restart_policy
+                    if policy.recent_crashes >= policy.max_crashes:
+                        msg = f"Service {s.name} exited {policy.recent_crashes} times in " \
+                            f"{policy.crash_window} seconds, not restarting"
+                    else:
+                        msg = f"Service {s.name} exited {policy.unstable_crashes} times in a row within " \
+                            f"{policy.stable_uptime} seconds of starting, not restarting"
+                    print(f"Warning: {msg}")
+                    stderr_log.write(f"\n{msg}\n")
+                    self._set_state(ProcessState.FAILED)
+                    break
+                stderr_log.write(f"\nRestarting process {s.name} in {delay:.2f} seconds\n")
+                await self._sleep_restart_backoff(delay)
+        finally:
+            stdout_log.close()
+            stderr_log.close()
 
     @property
     def process_state(self):
-        pass
+        return self._state
 
     @property
     def stopped(self):
@@ -114,8 +306,68 @@ class PyriProcess:
 
     def close(self):
         self._keep_going = False
+        w = self._wakeup
+        if w is not None:
+            self.loop.call_soon_threadsafe(lambda: w.done() or w.set_result(None))
         if self._process:
+            if self._stop_requested_time is None:
+                self._stop_requested_time = self.parent.trace.now()
+                self.parent.trace.instant(self.service_node_launch.name, "stop requested")
             self._process.send_term()
+
+    async def stop(self, grace_period, kill_timeout):
+        s = self.service_node_launch
+        self.close()
+        p = self._process
+        if p is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(p.wait()), grace_period)
+            except asyncio.TimeoutError:
+                print(f"Service {s.name} did not stop within {grace_period} seconds, sending SIGKILL")
+                self.parent.trace.instant(s.name, "kill")
+                self.kill()
+                try:
+                    await asyncio.wait_for(asyncio.shield(p.wait()), kill_timeout)
+                except asyncio.TimeoutError:
+                    print(f"Warning: service {s.name} still running after SIGKILL")
+                    return
+        run_task = self._run_task
+        if run_task is not None and not run_task.done():
+            # Output pipes can be held open by processes the service started
+            try:
+                await asyncio.wait_for(asyncio.shield(run_task), kill_timeout)
+            except asyncio.TimeoutError:
+                print(f"Warning: service {s.name} output did not close after exit")
+                run_task.cancel()
+
+    def detach(self):
+        # Stops supervising a detached service and leaves it running
+        p = self._process
+        if p is None or not getattr(p, "detached", False):
+            return False
+        self._keep_going = False
+        self._detaching = True
+        p.release()
+        return True
+
+    def _heartbeat_missed(self, elapsed):
+        p = self._process
+        if p is None or not self._keep_going:
+            return
+        self.loop.create_task(self.parent.service_hung(self, p, elapsed))
+
+    def restart(self, kill_timeout=10, hung=False):
+        p = self._process
+        if p is None or not self._keep_going:
+            return
+        self._restart_requested = True
+        self._hung = hung
+        p.send_term()
+        def kill_if_running():
+            if self._process is p:
+                print(f"Service {self.service_node_launch.name} did not stop for restart, killing")
+                self.kill()
+        self.loop.call_later(kill_timeout, kill_if_running)
     
     def kill(self):
         p = self._process
@@ -126,117 +378,1158 @@ class PyriProcess:
         except:
             traceback.print_exc()
 
+def _retrieve_exception(f):
+    # Exceptions of futures nobody waits for are not reported as never retrieved
+    if not f.cancelled():
+        f.exception()
+
 class PyriCore:
-    def __init__(self, device_info, service_node_launches, parser_results, log_dir, loop):
+    # PyriCore can be used from asyncio code without threads:
+    #
+    #   async with PyriCore(None, launches, parser_results, log_dir) as core:
+    #       await core.start("my_service", wait_ready=True)
+    #       await core.stop("my_service")
+    #
+    # The methods that are not coroutines can also be called from other threads,
+    # the way main() runs it. All timing uses clock, by default the time of the
+    # event loop, so a loop with a virtual clock also runs restart backoffs and
+    # timeouts on virtual time.
+    def __init__(self, device_info, service_node_launches, parser_results, log_dir, loop=None, clock=None):
         self.device_info = device_info
         self.service_node_launches = dict()
         self._closed = False
+        # All installed services, the launch profile selects and configures the services that are run
+        self._all_service_node_launches = list(service_node_launches)
+        self._profile_fname = getattr(parser_results, "profile", None)
+        self._profile = profiles.parse_profile(None)
+        self._profile_reload_lock = None
+        if self._profile_fname is not None:
+            self._profile = profiles.load_profile(self._profile_fname)
+            service_node_launches = profiles.apply_profile(self._all_service_node_launches, self._profile)
         for s in service_node_launches:
             self.service_node_launches[s.name] = s
         self.log_dir = log_dir
+        # Without a loop, the running loop is used once the core is entered with "async with"
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
         self._loop = loop
+        self.clock = clock if clock is not None else self._loop_time
         self._parser_results = parser_results
+        self.ready_timeout = getattr(parser_results, "service_ready_timeout", 60)
+        self._service_overrides = dict()
+        self.log_writer = PyriLogWriter(
+            flush_interval = getattr(parser_results, "log_flush_interval", 0.5),
+            max_bytes = int(getattr(parser_results, "log_max_size", 0) * 1024 * 1024),
+            backup_count = getattr(parser_results, "log_backup_count", 5),
+            compress = getattr(parser_results, "log_compress", False)
+        )
 
         self._subprocesses = dict()
         self._lock = threading.RLock()
+        self._log_buffers = dict()
+        self._log_buffer_lines = getattr(parser_results, "log_buffer_lines", 10000)
+        self._log_buffer_size = getattr(parser_results, "log_buffer_size", 1)
+        self.structured_logs = None
+        if getattr(parser_results, "structured_logs", False):
+            from . import structured_logs
+            self.structured_logs = structured_logs.PyriStructuredLogStore(
+                self.log_dir.joinpath(structured_logs.db_fname))
+        self._close_future = None
+        self._default_devices_task = None
+        self.stop_grace_period = getattr(parser_results, "stop_grace_period", 5)
+        self.stop_kill_timeout = getattr(parser_results, "stop_kill_timeout", 5)
+
+        self._use_fork_server = getattr(parser_results, "fork_server", False)
+        if self._use_fork_server and not fork_server.fork_server_supported():
+            print("Warning: fork server is not supported on this platform, using exec launch")
+            self._use_fork_server = False
+        self._fork_server = None
+        self._fork_server_starting = None
+
+        self._service_state = None
+        self._adoptable = dict()
+        self._detach_on_close = False
+        if getattr(parser_results, "detach_services", False):
+            if not detached.detach_supported():
+                print("Warning: --detach-services is only supported on Linux")
+            else:
+                state_dir = getattr(parser_results, "state_dir", None) or detached.default_state_dir()
+                self._service_state = detached.PyriServiceState(state_dir)
+                self._adoptable = self._service_state.load()
+                if self._use_fork_server:
+                    print("Warning: the fork server is not used with --detach-services")
+                    self._use_fork_server = False
+                for name, record in list(self._adoptable.items()):
+                    if name not in self.service_node_launches:
+                        print(f"Stopping service {name} left running by a previous pyri-core, it is not configured")
+                        del self._adoptable[name]
+                        try:
+                            os.killpg(record["pgid"], signal.SIGINT)
+                        except ProcessLookupError:
+                            pass
+
+        self._agents = dict()
+        self._agent_clients = dict()
+        self._agent_connecting = dict()
+        placement_fname = getattr(parser_results, "placement", None)
+        if placement_fname is not None:
+            self._agents, placement = agent.load_placement(placement_fname)
+            for name, agent_name in placement.items():
+                self._service_overrides.setdefault(name, dict())["agent"] = agent_name
+        for option in getattr(parser_results, "service_resources", None) or []:
+            name, resources = process_resources.parse_resources_option(option)
+            if name not in self.service_node_launches:
+                print(f"Warning: --service-resources for unknown service {name}")
+            self._service_overrides.setdefault(name, dict()).setdefault("resources", dict()).update(resources)
+
+        self.loop_stats = None
+        stats_interval = getattr(parser_results, "loop_stats_interval", 0)
+        if stats_interval > 0:
+            self.loop_stats = loop_stats.PyriLoopStats(self, self.log_dir.joinpath("loop_stats.json"),
+                write_interval = stats_interval,
+                slow_threshold = getattr(parser_results, "slow_callback_threshold", 0.1)
+            )
+
+        self.resource_monitor = None
+        sample_interval = getattr(parser_results, "resource_sample_interval", 0)
+        if sample_interval > 0 and resource_monitor.resource_monitor_supported():
+            self.resource_monitor = resource_monitor.PyriResourceMonitor(self,
+                self.log_writer.open(self.log_dir.joinpath("resources.csv")),
+                interval = sample_interval,
+                history = getattr(parser_results, "resource_history", 720),
+                rss_limit_mb = getattr(parser_results, "resource_rss_limit", None),
+                cpu_limit_percent = getattr(parser_results, "resource_cpu_limit", None),
+                limit_action = getattr(parser_results, "resource_limit_action", "warn")
+            )
+
+        self._dependency_graph = dependencies.build_dependency_graph(self.service_node_launches)
+        self._dependency_tiers = dependencies.dependency_tiers(self._dependency_graph)
+        self._dependents = dependencies.reverse_dependency_graph(self._dependency_graph)
+        self._failed = set()
+        self._pending_start = set()
+        self._pending_start_handle = None
+        self._ready = set()
+        self._ready_probed = set()
+        self._ready_waiters = dict()
+        self._start_requested_time = dict()
+        self._ready_time = dict()
+        self._startup_t0 = None
+        self._startup_reported = False
+        self.startup_critical_path = None
+        self._timings = dict()
+        self.trace = tracing.PyriTraceRecorder(self.clock)
+        self._state_waiters = dict()
+
+        self._default_activation = getattr(parser_results, "default_activation", "eager")
+        for option in getattr(parser_results, "service_activation", None) or []:
+            name, sep, mode = option.partition("=")
+            if not sep or mode not in _activation_modes:
+                raise ValueError(f"Invalid --service-activation option: {option}")
+            self._service_overrides.setdefault(name, dict())["activation"] = mode
+        self._default_hosting = getattr(parser_results, "default_hosting", "isolated")
+        for option in getattr(parser_results, "service_hosting", None) or []:
+            name, sep, mode = option.partition("=")
+            if not sep or mode not in _hosting_modes:
+                raise ValueError(f"Invalid --service-hosting option: {option}")
+            self._service_overrides.setdefault(name, dict())["hosting"] = mode
+        self._shared_hosting_supported = service_host.service_host_supported() and self._service_state is None
+        if not self._shared_hosting_supported and any(self.service_param(n, "hosting", self._default_hosting) == "shared"
+                for n in self.service_node_launches.keys()):
+            print("Warning: shared service hosting is only supported on Linux without --detach-services, "
+                "running all services isolated")
+        self._service_hosts = dict()
+        self._service_hosts_starting = dict()
+        self._idle_timeout = getattr(parser_results, "idle_timeout", 300)
+        self._idle_cpu_percent = getattr(parser_results, "idle_cpu_percent", 2)
+        self._idle_check_handle = None
+        self._last_activity = dict()
+        self._print_startup_summary = getattr(parser_results, "startup_summary", False)
+
+        # Services with pre-flight problems are not started, see preflight()
+        self._preflight = not getattr(parser_results, "no_preflight", False)
+        self._preflight_done = False
+        self._preflight_checked = set()
+        self._preflight_problems = dict()
+        # Precompile is enabled by the command line, embedded cores and tests don't pay for it by default
+        self._precompile = getattr(parser_results, "precompile", False)
+        self._precompile_workers = getattr(parser_results, "precompile_workers", 0)
+        self._bytecode_cache_dir = getattr(parser_results, "bytecode_cache_dir", None) or sys.pycache_prefix
 
     def _do_start(self,s):
         p = PyriProcess(self, s, self._parser_results, self.log_dir, self._loop)
         self._subprocesses[s.name] = p
-        self._loop.create_task(p.run())
+        self._start_requested_time[s.name] = self.clock()
+        self.record_timing(s.name, "requested", self._start_requested_time[s.name])
+        self.trace.instant(s.name, "start requested", t=self._start_requested_time[s.name])
+        p._run_task = self._loop.create_task(p.run())
+
+    def _start_ready_pending(self):
+        with self._lock:
+            self._pending_start_handle = None
+            if self._closed:
+                return
+            now = self.clock()
+            next_check = None
+            for tier in self._dependency_tiers:
+                for name in tier:
+                    if name not in self._pending_start:
+                        continue
+                    deps = self._dependency_graph[name]
+                    if not self.check_deps_status(deps):
+                        continue
+                    s = self.service_node_launches[name]
+                    # depends_backoff gives dependencies time to settle after they report ready
+                    t_start = max([self._ready_time[d] for d in deps], default=now)
+                    if any(d not in self._ready_probed for d in deps):
+                        t_start += s.depends_backoff or 0
+                    if t_start > now:
+                        next_check = t_start if next_check is None else min(next_check, t_start)
+                        continue
+                    self._pending_start.remove(name)
+                    if name not in self._subprocesses:
+                        self._do_start(s)
+            if next_check is not None:
+                self._pending_start_handle = self._loop.call_later(next_check - now, self._start_ready_pending)
+
+    def service_activation(self, name):
+        mode = self.service_param(name, "activation", self._default_activation)
+        if mode not in _activation_modes:
+            print(f"Warning: invalid activation mode {mode} for service {name}, using eager")
+            return "eager"
+        return mode
+
+    def service_hosting(self, name):
+        # "shared" services run as threads in a host process shared with the services of the same host_group
+        mode = self.service_param(name, "hosting", self._default_hosting)
+        if mode not in _hosting_modes:
+            print(f"Warning: invalid hosting mode {mode} for service {name}, using isolated")
+            return "isolated"
+        if mode == "shared" and (not self._shared_hosting_supported or self.service_param(name, "agent") is not None):
+            return "isolated"
+        return mode
+
+    def _check_service(self, name):
+        hosted_main = self.service_param(name, "hosted_main") if self.service_hosting(name) == "shared" else None
+        return preflight.check_service(self.service_node_launches[name], self._parser_results,
+            self.service_param(name, "agent") is not None, hosted_main)
+
+    def _check_services(self, names):
+        problems = dict()
+        for name in names:
+            p = self._check_service(name)
+            if len(p) > 0:
+                problems[name] = p
+        return problems
+
+    async def preflight(self):
+        # Checks all services and precompiles their bytecode, run before start_all(). Services with
+        # problems are marked FAILED by start_all() instead of being started. Returns the problems.
+        t0 = self.clock()
+        names = list(self.service_node_launches.keys())
+        if self._preflight:
+            problems = await self._loop.run_in_executor(None, self._check_services, names)
+            with self._lock:
+                self._preflight_problems = problems
+                self._preflight_checked.update(names)
+                self._preflight_done = True
+            if len(problems) > 0:
+                print(preflight.format_problems(problems, len(names)))
+            if self.structured_logs is not None:
+                for name, p in problems.items():
+                    self.structured_logs.event(name, f"pre-flight check failed: {'; '.join(p)}")
+        if self._precompile:
+            await self._precompile_services([n for n in names if n not in self._preflight_problems])
+        self.trace.complete("pyri-core", "preflight", t0, self.clock(), {"failed": sorted(self._preflight_problems)})
+        return dict(self._preflight_problems)
+
+    async def _precompile_services(self, names):
+        modules = [self.service_node_launches[n].module_main for n in names if self.service_param(n, "agent") is None]
+        paths = await self._loop.run_in_executor(None, preflight.package_paths, modules)
+        cache_dir = self._bytecode_cache_dir
+        if cache_dir is None and len(paths) > 0 and preflight.needs_cache_dir(paths):
+            cache_dir = preflight.default_cache_dir()
+            print(f"Service packages are not writable, using bytecode cache directory {cache_dir}")
+            self._bytecode_cache_dir = cache_dir
+        if cache_dir is not None:
+            try:
+                Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                print(f"Warning: could not create bytecode cache directory {cache_dir}: {e}")
+                return
+        if len(paths) > 0:
+            t0 = self.clock()
+            try:
+                await preflight.wait_compile(await preflight.compile_paths(paths, cache_dir, self._precompile_workers))
+            except Exception:
+                traceback.print_exc()
+            self.trace.complete("pyri-core", "precompile", t0, self.clock(), {"paths": len(paths)})
+
+    def _local_env(self, env=None):
+        # Environment of local service processes, the fork server and the service hosts. The
+        # bytecode cache directory is only set for them, not for the launcher process.
+        if self._bytecode_cache_dir is None:
+            return env
+        env = dict(os.environ if env is None else env)
+        env["PYTHONPYCACHEPREFIX"] = str(self._bytecode_cache_dir)
+        return env
+
+    def _preflight_failed(self, name):
+        self.trace.instant(name, ProcessState.FAILED.name)
+        self._dependency_failed(name)
+        self._notify_state_waiters(name)
 
     def start_all(self):
+        # Starts the eager services and their dependencies, other services are started by start()
+        if self.resource_monitor is not None:
+            self.resource_monitor.start(self._loop)
+        if self.loop_stats is not None:
+            self.loop_stats.start(self._loop)
         with self._lock:
-            for name,s in self.service_node_launches.items():
-                if name not in self._subprocesses:
-                    self._do_start(s)
+            if self._startup_t0 is None:
+                self._startup_t0 = self.clock()
+            names = set()
+            for name in self.service_node_launches.keys():
+                if self.service_activation(name) == "eager" or name in self._adoptable:
+                    names.add(name)
+                    names.update(dependencies.transitive_dependencies(self._dependency_graph, name))
+            failed = [name for name in names if name in self._preflight_problems]
+            for name in names:
+                if name not in self._subprocesses and name not in self._preflight_problems:
+                    self._pending_start.add(name)
+                self._last_activity[name] = self.clock()
+            # Dependents are marked failed with the services that failed the pre-flight check
+            for name in failed:
+                self._preflight_failed(name)
+        self._start_ready_pending()
+        self._schedule_idle_check()
 
-    def start(self, name):
+    def start(self, name, wait_ready=False, timeout=None):
+        # Returns an awaitable, see _submit(). With wait_ready it completes when the service and its
+        # dependencies are ready, and raises RuntimeError if the service fails to start.
         with self._lock:
             if self._closed:
                 assert False, "Already closed"
-            try:
-                s = self.service_node_launches[name]
-            except KeyError:
+            if name not in self.service_node_launches:
                 raise ArgumentError(f"Invalid service requested: {name}")
-            if name not in self._subprocesses:
-                self._do_start(s)
+            # Dependencies are started as well, on-demand dependencies may not be running
+            preflight_failed = []
+            for d in dependencies.transitive_dependencies(self._dependency_graph, name) + [name]:
+                p = self._subprocesses.get(d, None)
+                if p is not None and p.process_state == ProcessState.FAILED:
+                    # Explicit start request resets a failed service
+                    del self._subprocesses[d]
+                    p = None
+                self._failed.discard(d)
+                self._last_activity[d] = self.clock()
+                if p is None and self._preflight_done and (d in self._preflight_problems
+                        or d not in self._preflight_checked):
+                    # Checked again, the installation may have been fixed since the last check
+                    importlib.invalidate_caches()
+                    problems = self._check_service(d)
+                    self._preflight_checked.add(d)
+                    if len(problems) > 0:
+                        self._preflight_problems[d] = problems
+                        print(preflight.format_problems({d: problems}, 1))
+                        self._failed.add(d)
+                        preflight_failed.append(d)
+                        continue
+                    self._preflight_problems.pop(d, None)
+                if p is None:
+                    if self._startup_t0 is None:
+                        self._startup_t0 = self.clock()
+                    self._pending_start.add(d)
+        for d in preflight_failed:
+            self._loop.call_soon_threadsafe(self._preflight_failed, d)
+        self._loop.call_soon_threadsafe(self._start_ready_pending)
+        self._loop.call_soon_threadsafe(self._schedule_idle_check)
+        return self._submit(self._wait_started(name, wait_ready, timeout))
+
+    async def _wait_started(self, name, wait_ready, timeout):
+        if not wait_ready:
+            return
+        ready = asyncio.ensure_future(self.wait_service_ready(name))
+        failed = asyncio.ensure_future(self.wait_state(name, ProcessState.FAILED))
+        try:
+            done, _ = await asyncio.wait([ready, failed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+            failed.cancel()
+        if ready in done:
+            return
+        if failed in done:
+            raise RuntimeError(f"Service {name} failed to start")
+        raise asyncio.TimeoutError(f"Service {name} not ready within {timeout} seconds")
+
+    def stop(self, name):
+        # Stops a service, it can be started again with start(). Returns an awaitable, see _submit()
+        return self._submit(self.stop_service(name))
+
+    def _submit(self, coro):
+        # Runs coro on the event loop. Called on the event loop thread, returns an asyncio task. Called
+        # from another thread, returns a concurrent.futures.Future.
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            f = self._loop.create_task(coro)
+        else:
+            f = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        f.add_done_callback(_retrieve_exception)
+        return f
+
+    async def wait_state(self, name, states, timeout=None):
+        # Waits until the service is in one of states, returns the state
+        if isinstance(states, ProcessState):
+            states = [states]
+        states = frozenset(states)
+        with self._lock:
+            state = self.get_process_state(name)
+            if state in states:
+                return state
+            w = self._loop.create_future()
+            self._state_waiters.setdefault(name, []).append((states, w))
+        try:
+            return await asyncio.wait_for(w, timeout)
+        finally:
+            with self._lock:
+                waiters = self._state_waiters.get(name, [])
+                if (states, w) in waiters:
+                    waiters.remove((states, w))
+
+    def _notify_state_waiters(self, name):
+        with self._lock:
+            state = self.get_process_state(name)
+            waiters = self._state_waiters.get(name, [])
+            done = [w for states, w in waiters if state in states]
+            self._state_waiters[name] = [(states, w) for states, w in waiters if state not in states]
+        for w in done:
+            if not w.done():
+                w.set_result(state)
+
+    def touch_service(self, name):
+        # Records activity for a service, idle-stop services are only stopped after
+        # idle_timeout seconds without activity
+        with self._lock:
+            for d in dependencies.transitive_dependencies(self._dependency_graph, name) + [name]:
+                self._last_activity[d] = self.clock()
+
+    def _schedule_idle_check(self):
+        with self._lock:
+            if self._closed or self._idle_check_handle is not None:
+                return
+            timeouts = [self.service_param(n, "idle_timeout", self._idle_timeout) for n in self._subprocesses.keys()
+                if self.service_activation(n) == "idle-stop"]
+            if len(timeouts) == 0:
+                return
+            interval = min(max(min(timeouts) / 4, 0.1), 5)
+            self._idle_check_handle = self._loop.call_later(interval, self._idle_check)
+
+    def _service_in_use(self, name):
+        # A service is in use while services that depend on it are running or starting
+        for d in self._dependents.get(name, []):
+            if d in self._subprocesses or d in self._pending_start:
+                return True
+        return False
+
+    def _has_client_connections(self, p):
+        # Connected clients, for example Robot Raconteur clients, count as activity. Only checked for
+        # local services that are not hosted, on Linux.
+        process = p._process
+        if process is None or getattr(process, "remote", False) or getattr(process, "hosted", False) \
+                or not resource_monitor.resource_monitor_supported():
+            return False
+        try:
+            return resource_monitor.read_client_connections(process.pid) > 0
+        except OSError:
+            return False
+
+    def _idle_check(self):
+        now = self.clock()
+        latest = self.resource_monitor.latest() if self.resource_monitor is not None else dict()
+        with self._lock:
+            self._idle_check_handle = None
+            if self._closed:
+                return
+            for name, p in list(self._subprocesses.items()):
+                if self.service_activation(name) != "idle-stop" or name not in self._ready:
+                    continue
+                idle_timeout = self.service_param(name, "idle_timeout", self._idle_timeout)
+                if now - self._last_activity.get(name, now) < idle_timeout or self._service_in_use(name):
+                    continue
+                if self._has_client_connections(p):
+                    self._last_activity[name] = now
+                    continue
+                sample = latest.get(name, None)
+                if sample is not None and sample.cpu_percent > self.service_param(name, "idle_cpu_percent",
+                        self._idle_cpu_percent):
+                    continue
+                print(f"Stopping service {name} after {idle_timeout} seconds of inactivity")
+                self.trace.instant(name, "idle stop")
+                self._last_activity[name] = now
+                self._loop.create_task(self.stop_service(name))
+        self._schedule_idle_check()
+
+    async def stop_service(self, name):
+        # Stops a single service, it can be started again with start()
+        with self._lock:
+            self._pending_start.discard(name)
+            p = self._subprocesses.get(name, None)
+        if p is None:
+            return
+        await self._stop_process(p)
+        with self._lock:
+            if self._subprocesses.get(name, None) is p:
+                del self._subprocesses[name]
+            self._ready.discard(name)
+            self._ready_probed.discard(name)
+        self._notify_state_waiters(name)
+
+    def reload_profile(self):
+        # Reloads the launch profile file and restarts only the services with changed settings.
+        # Can be called from any thread, returns a concurrent.futures.Future.
+        return asyncio.run_coroutine_threadsafe(self._do_reload_profile(), self._loop)
+
+    async def _do_reload_profile(self):
+        if self._profile_fname is None:
+            print("Warning: no launch profile to reload, use --profile to set one")
+            return None
+        if self._profile_reload_lock is None:
+            self._profile_reload_lock = asyncio.Lock()
+        async with self._profile_reload_lock:
+            try:
+                new_profile = await self._loop.run_in_executor(None, profiles.load_profile, self._profile_fname)
+                launches = {l.name: l for l in profiles.apply_profile(self._all_service_node_launches, new_profile)}
+                graph = dependencies.build_dependency_graph(launches)
+            except Exception as e:
+                print(f"Warning: could not reload launch profile {self._profile_fname}, keeping the current profile: {e}")
+                return None
+            added, removed, changed = profiles.changed_services(self._profile, new_profile,
+                [l.name for l in self._all_service_node_launches])
+            with self._lock:
+                if self._closed:
+                    return None
+                running = set(n for n in removed + changed if n in self._subprocesses or n in self._pending_start)
+            # Services are stopped with their old settings, before they are replaced
+            await asyncio.gather(*[self.stop_service(n) for n in removed + changed if n in running])
+            with self._lock:
+                if self._closed:
+                    return None
+                self._profile = new_profile
+                self.service_node_launches = launches
+                self._dependency_graph = graph
+                self._dependency_tiers = dependencies.dependency_tiers(graph)
+                self._dependents = dependencies.reverse_dependency_graph(graph)
+                for n in removed:
+                    self._failed.discard(n)
+                    self._preflight_problems.pop(n, None)
+                # Added and changed services are checked again when they are started
+                self._preflight_checked.difference_update(added + changed)
+                started = [n for n in added + changed if n in running or self.service_activation(n) == "eager"]
+                for n in started:
+                    self.start(n)
+            print(f"Reloaded launch profile {self._profile_fname}: {len(changed)} changed, {len(added)} added, "
+                f"{len(removed)} removed, restarted or started: {', '.join(started) if len(started) > 0 else 'none'}")
+            return {"added": added, "removed": removed, "changed": changed, "started": started}
+
+    def record_timing(self, name, key, t=None):
+        # Only the first start of each service is recorded
+        timing = self._timings.setdefault(name, dict())
+        if key not in timing:
+            timing[key] = t if t is not None else self.trace.now()
 
     def process_state_changed(self, process_name, state):
         print(f"Process changed {process_name} {state}")
+        if self._service_state is not None and (state == ProcessState.STOPPED or state == ProcessState.FAILED):
+            self._service_state.remove_record(process_name)
+        if self.structured_logs is not None:
+            self.structured_logs.event(process_name, state.name)
+        self.trace.instant(process_name, state.name)
         if self._closed:
             if state == ProcessState.STOPPED:
                 with self._lock:
                     if process_name in self._subprocesses:
                         del self._subprocesses[process_name]
+            self._notify_state_waiters(process_name)
+            return
+        if state == ProcessState.STOPPED or state == ProcessState.FAILED:
+            with self._lock:
+                self._ready.discard(process_name)
+                self._ready_probed.discard(process_name)
+        if state == ProcessState.FAILED:
+            self._dependency_failed(process_name)
+        self._notify_state_waiters(process_name)
 
-    def check_deps_status(self, deps):
-        return True
+    def _dependency_failed(self, failed_name):
+        # Services waiting to start on a failed service will never start, mark them failed
+        # as well. Running dependents are left running, they reconnect when the dependency is
+        # started again.
+        failed = []
+        with self._lock:
+            self._failed.add(failed_name)
+            stack = list(self._dependents.get(failed_name, []))
+            while len(stack) > 0:
+                n = stack.pop()
+                if n in self._pending_start:
+                    self._pending_start.remove(n)
+                    self._failed.add(n)
+                    failed.append(n)
+                    print(f"Warning: service {n} not started because dependency {failed_name} failed")
+                    self.trace.instant(n, ProcessState.FAILED.name)
+                    stack.extend(self._dependents.get(n, []))
+        for n in failed:
+            self._notify_state_waiters(n)
+        self._check_startup_complete()
 
-    def close(self):
+    def get_process_state(self, name):
         with self._lock:
-            if self._closed:
+            if name in self._failed:
+                return ProcessState.FAILED
+            p = self._subprocesses.get(name, None)
+            if p is None:
+                return ProcessState.STOPPED
+            return p.process_state
+
+    def create_restart_policy(self, name):
+        s = self.service_node_launches[name]
+        pr = self._parser_results
+        return RestartPolicy(
+            initial_backoff = s.restart_backoff,
+            max_backoff = self.service_param(name, "restart_max_backoff", getattr(pr, "restart_max_backoff", 60)),
+            jitter = self.service_param(name, "restart_jitter", 0.1),
+            stable_uptime = self.service_param(name, "restart_stable_uptime", getattr(pr, "restart_stable_uptime", 60)),
+            max_crashes = self.service_param(name, "restart_max_crashes", getattr(pr, "restart_max_crashes", 5)),
+            crash_window = self.service_param(name, "restart_crash_window", getattr(pr, "restart_crash_window", 60))
+        )
+
+    def service_process_groups(self):
+        ret = dict()
+        with self._lock:
+            for name, p in self._subprocesses.items():
+                process = p._process
+                if process is not None and not getattr(process, "remote", False) \
+                        and not getattr(process, "hosted", False):
+                    # Services are started in a new session, so the process group id is the pid
+                    ret[name] = process.pid
+            # Hosted services can't be measured separately, the shared host processes are reported instead
+            for group, h in self._service_hosts.items():
+                if h.alive:
+                    ret[f"host:{group}"] = h.pid
+        return ret
+
+    def service_output_backlog(self):
+        # Output written by each service that has not been read yet, called from the loop stats thread
+        ret = dict()
+        for name, p in list(self._subprocesses.items()):
+            process = p._process
+            if process is not None:
+                ret[name] = loop_stats.stream_backlog(process.stdout) + loop_stats.stream_backlog(process.stderr)
+        return ret
+
+    def dump_loop_stats(self):
+        # Prints the loop statistics and writes them to the stats file. Does not use the event loop,
+        # so it also works while the loop is blocked.
+        if self.loop_stats is None:
+            print("Event loop statistics are disabled")
+            return
+        try:
+            print(self.loop_stats.format_summary())
+            self.loop_stats.write()
+        except Exception:
+            traceback.print_exc()
+
+    def restart_service(self, name):
+        with self._lock:
+            p = self._subprocesses.get(name, None)
+        if p is not None:
+            self._loop.call_soon_threadsafe(p.restart)
+
+    def log_buffer(self, name):
+        # Recent output lines of a service, kept across restarts of the service
+        if self._log_buffer_lines <= 0 or name not in self.service_node_launches:
+            return None
+        with self._lock:
+            b = self._log_buffers.get(name, None)
+            if b is None:
+                b = PyriLogBuffer(self._log_buffer_lines, int(self._log_buffer_size * 1024 * 1024))
+                self._log_buffers[name] = b
+            return b
+
+    def service_param(self, name, key, default=None):
+        overrides = self._service_overrides.get(name, None)
+        if overrides is not None and key in overrides:
+            return overrides[key]
+        s = self.service_node_launches.get(name, None)
+        extra_params = getattr(s, "extra_params", None)
+        if extra_params is not None and key in extra_params:
+            return extra_params[key]
+        return default
+
+    async def _get_fork_server(self):
+        if self._fork_server is not None and self._fork_server.alive:
+            return self._fork_server
+        if self._fork_server_starting is not None:
+            return await asyncio.shield(self._fork_server_starting)
+        self._fork_server_starting = self._loop.create_future()
+        try:
+            preimport = getattr(self._parser_results, "fork_server_preimport", None)
+            if preimport is not None:
+                preimport = [m for m in preimport.split(",") if len(m) > 0]
+            fs_log = self.log_writer.open(self.log_dir.joinpath("fork_server.stderr.txt"))
+            fs = fork_server.PyriForkServer(self._loop, preimport, fs_log, self._local_env())
+            await fs.start()
+            self._fork_server = fs
+        except Exception:
+            traceback.print_exc()
+            print("Warning: could not start fork server, using exec launch")
+            self._use_fork_server = False
+            fs = None
+        self._fork_server_starting.set_result(fs)
+        self._fork_server_starting = None
+        return fs
+
+    async def _get_service_host(self, group):
+        h = self._service_hosts.get(group, None)
+        if h is not None and h.alive:
+            return h
+        starting = self._service_hosts_starting.get(group, None)
+        if starting is not None:
+            return await asyncio.shield(starting)
+        starting = self._loop.create_future()
+        self._service_hosts_starting[group] = starting
+        try:
+            h_log = self.log_writer.open(self.log_dir.joinpath(f"service_host_{group}.stderr.txt"))
+            h = service_host.PyriServiceHost(self._loop, group, h_log, self._local_env())
+            await h.start()
+            print(f"Started service host {group}, pid {h.pid}")
+            with self._lock:
+                self._service_hosts[group] = h
+        except Exception:
+            traceback.print_exc()
+            print(f"Warning: could not start service host {group}")
+            h = None
+        starting.set_result(h)
+        del self._service_hosts_starting[group]
+        return h
+
+    async def _get_agent_client(self, agent_name):
+        c = self._agent_clients.get(agent_name, None)
+        if c is not None and c.alive:
+            return c
+        connecting = self._agent_connecting.get(agent_name, None)
+        if connecting is not None:
+            return await asyncio.shield(connecting)
+        try:
+            a = self._agents[agent_name]
+        except KeyError:
+            raise ValueError(f"Unknown agent {agent_name}")
+        connecting = self._loop.create_future()
+        self._agent_connecting[agent_name] = connecting
+        try:
+            c = agent.PyriAgentClient(self._loop, agent_name, a["host"], a["port"],
+                a["token"] or getattr(self._parser_results, "agent_token", None))
+            await c.connect()
+            print(f"Connected to agent {agent_name} on {c.remote_hostname} ({a['host']}:{a['port']})")
+            self._agent_clients[agent_name] = c
+            connecting.set_result(c)
+        except Exception as e:
+            connecting.set_exception(e)
+            # Retrieve the exception so it isn't reported as never retrieved
+            connecting.exception()
+            raise
+        finally:
+            del self._agent_connecting[agent_name]
+        return c
+
+    def service_resources(self, name):
+        # Command line settings override the settings of the plugin
+        s = self.service_node_launches[name]
+        resources = dict((getattr(s, "extra_params", None) or dict()).get("resources", None) or dict())
+        resources.update(self._service_overrides.get(name, dict()).get("resources", dict()))
+        return process_resources.validate_resources(resources)
+
+    async def create_service_subprocess(self, name, module_main, args, env=None, watchdog=None):
+        resources = self.service_resources(name)
+        agent_name = self.service_param(name, "agent")
+        if agent_name is not None:
+            if watchdog is not None:
+                env = dict(env or dict(), **watchdog.service_env())
+            c = await self._get_agent_client(agent_name)
+            return await c.create_subprocess(module_main, args, env, resources)
+        env = self._local_env(env)
+        if self.service_hosting(name) == "shared":
+            if resources is not None:
+                print(f"Warning: resources settings of service {name} are ignored, it is hosted in a shared process")
+            h = await self._get_service_host(self.service_param(name, "host_group", "default"))
+            if h is not None:
+                return await h.create_subprocess(name, module_main, args, self.service_param(name, "hosted_main"))
+            print(f"Warning: starting service {name} isolated")
+        if resources is not None and not process_resources.resources_supported():
+            print(f"Warning: service resources settings for {name} are only supported on Linux")
+            resources = None
+        fd_env = dict()
+        if watchdog is not None:
+            env = dict(os.environ if env is None else env)
+            env[heartbeat.stack_dump_file_env] = str(self.stack_dump_fname(name))
+            if watchdog.channel == "fd":
+                fd_env[heartbeat.heartbeat_fd_env] = watchdog.open_pipe()
+            else:
+                env.update(watchdog.service_env())
+        if self._use_fork_server and self.service_param(name, "fork_server", True):
+            try:
+                fs = await self._get_fork_server()
+                if fs is not None:
+                    return await fs.create_subprocess(module_main, args, env, resources=resources, fd_env=fd_env)
+            except Exception:
+                traceback.print_exc()
+                print(f"Warning: fork server launch of {name} failed, using exec launch")
+        cmd = ["-m", module_main] + args
+        if watchdog is not None:
+            # The wrapper installs the stack dump handler before running the service module
+            env.update({k: str(fd) for k, fd in fd_env.items()})
+            cmd = ["-m", "pyri.core.service_wrapper", module_main] + args
+        if self._service_state is not None:
+            preexec_fn = process_resources.make_preexec_fn(resources) if resources is not None else None
+            process, record = await detached.create_detached_subprocess(self._loop, self._service_state, name,
+                [sys.executable] + cmd, env, list(fd_env.values()), preexec_fn)
+            record["module_main"] = module_main
+            record["service_args"] = list(args)
+            self._service_state.set_record(name, record)
+            return process
+        return await subprocess_impl.create_subprocess_exec(sys.executable, cmd, env, pass_fds=list(fd_env.values()),
+            resources=resources)
+
+    async def adopt_service_subprocess(self, name, module_main, args):
+        with self._lock:
+            record = self._adoptable.pop(name, None)
+        if record is None:
+            return None
+        try:
+            process = await detached.adopt_subprocess(self._loop, self._service_state, name, record)
+        except Exception:
+            traceback.print_exc()
+            process = None
+        if process is None:
+            print(f"Service {name} exited before it could be adopted, starting it")
+            return None
+        self._service_state.set_record(name, record)
+        print(f"Adopted running service {name}, pid {record['pid']}")
+        if record.get("module_main", None) != module_main or record.get("service_args", None) != list(args):
+            print(f"Warning: service {name} was started with different arguments, restart it to apply the "
+                "current arguments")
+        return process
+
+    def create_watchdog(self, name, on_missed):
+        try:
+            settings = watchdog.parse_heartbeat_settings(name, self.service_param(name, "heartbeat"),
+                self.ready_timeout)
+        except (ValueError, TypeError) as e:
+            print(f"Warning: {e}, heartbeat watchdog disabled")
+            return None
+        if settings is None:
+            return None
+        if self.service_hosting(name) == "shared":
+            # Hung threads can't be restarted or dumped separately
+            print(f"Warning: heartbeat watchdog is not supported for service {name} hosted in a shared process")
+            return None
+        channel = settings["channel"]
+        if channel == "fd" and (self.service_param(name, "agent") is not None or sys.platform == "win32"):
+            # Services on launch agents and on Windows can't inherit the heartbeat pipe
+            channel = "stdout"
+        return watchdog.PyriHeartbeatWatchdog(self._loop, name, settings["timeout"], settings["startup_timeout"],
+            on_missed, channel, settings["marker"], settings["action"])
+
+    def stack_dump_fname(self, name):
+        return self.log_dir.joinpath(f"{name}.stackdump.txt")
+
+    async def dump_service_stacks(self, name, process):
+        # Asks a service started with the watchdog to write the stacks of all its threads to the
+        # stack dump file. faulthandler writes the dump from the signal handler, so this works even
+        # if the interpreter is deadlocked.
+        if not hasattr(signal, "SIGUSR2") or getattr(process, "remote", False):
+            print(f"Warning: stack dumps are only captured for local services on Linux, not capturing {name}")
+            return None
+        fname = self.stack_dump_fname(name)
+        size = fname.stat().st_size if fname.exists() else 0
+        try:
+            os.kill(process.pid, signal.SIGUSR2)
+        except ProcessLookupError:
+            return None
+        # Wait until the dump has been written
+        deadline = self.clock() + 1.0
+        last_size = size
+        while self.clock() < deadline:
+            await asyncio.sleep(0.05)
+            new_size = fname.stat().st_size if fname.exists() else 0
+            if new_size > size and new_size == last_size:
+                return fname
+            last_size = new_size
+        if last_size > size:
+            return fname
+        print(f"Warning: service {name} did not write a stack dump")
+        return None
+
+    async def service_hung(self, p, process, elapsed):
+        name = p.service_node_launch.name
+        w = p._watchdog
+        print(f"Warning: service {name} missed its heartbeat deadline, no heartbeat for {elapsed:.3f} s")
+        self.trace.instant(name, "heartbeat missed", {"elapsed": elapsed})
+        if self.structured_logs is not None:
+            self.structured_logs.event(name, f"heartbeat missed, no heartbeat for {elapsed:.3f} s")
+        fname = await self.dump_service_stacks(name, process)
+        if fname is not None:
+            print(f"Stack dump of service {name} written to {fname}")
+        if w is not None and w.action == "restart" and p._process is process and not self._closed:
+            print(f"Restarting hung service {name}")
+            p.restart(self.service_param(name, "stop_grace_period", self.stop_grace_period), hung=True)
+
+    def create_readiness_probe(self, name):
+        r = readiness.resolve_readiness(name, self.service_param(name, "readiness"))
+        agent_name = self.service_param(name, "agent")
+        if agent_name is not None and isinstance(r, dict) and r.get("type") == "tcp" and "host" not in r:
+            # Probe the port on the host the service was placed on
+            r = dict(r, host=self._agents[agent_name]["host"])
+        return readiness.create_readiness_probe(name, r)
+
+    def process_ready(self, process_name):
+        probed = readiness.resolve_readiness(process_name, self.service_param(process_name, "readiness")) is not None
+        with self._lock:
+            if process_name in self._ready:
                 return
-            self._closed = True
+            self._ready.add(process_name)
+            if probed:
+                self._ready_probed.add(process_name)
+            if process_name not in self._ready_time:
+                self._ready_time[process_name] = self.clock()
+            waiters = self._ready_waiters.pop(process_name, [])
+            p = self._subprocesses.get(process_name, None)
+        print(f"Process ready {process_name}")
+        t_ready = self.trace.now()
+        self.record_timing(process_name, "ready", t_ready)
+        self.trace.instant(process_name, "ready")
+        if p is not None and p._spawn_time is not None:
+            self.trace.complete(process_name, "start", p._spawn_time, t_ready)
+        for w in waiters:
+            if not w.done():
+                w.set_result(True)
+        self._start_ready_pending()
+        self._check_startup_complete()
 
-            for p in self._subprocesses.values():
-                try:
-                    p.close()
-                except Exception:
-                    traceback.print_exc()
-                    pass
+    async def wait_service_ready(self, name, timeout=None):
+        with self._lock:
+            if name in self._ready:
+                return
+            w = self._loop.create_future()
+            self._ready_waiters.setdefault(name, []).append(w)
+        await asyncio.wait_for(w, timeout)
 
-        self._wait_all_closed()
-    
-    def _wait_all_closed(self):
+    def _check_startup_complete(self):
+        with self._lock:
+            if self._startup_reported or self._startup_t0 is None or len(self._pending_start) > 0:
+                return
+            if not all(n in self._ready_time or n in self._failed for n in self._subprocesses.keys()):
+                return
+            self._startup_reported = True
+            path = dependencies.critical_path(self._dependency_graph, self._ready_time)
+            self.startup_critical_path = [(n, self._ready_time[n] - self._startup_t0) for n in path]
+            total = max(self._ready_time.values(), default=self._startup_t0) - self._startup_t0
+            failed = sorted(self._failed)
+        path_str = " -> ".join(f"{n} ({t:.2f} s)" for n, t in self.startup_critical_path)
+        print(f"All services started in {total:.2f} s, critical path: {path_str}")
+        if len(failed) > 0:
+            print(f"Warning: services failed to start: {', '.join(failed)}")
+        self.trace.instant("pyri-core", "all services ready")
+        self._write_trace()
+        if self._print_startup_summary:
+            print(tracing.format_startup_summary(self._startup_t0, self._timings))
+        if any(self.service_resources(n) is not None for n in self.service_node_launches.keys()):
+            self._write_effective_resources()
+
+    def memory_report(self):
+        if self.resource_monitor is None:
+            return None
+        report = self.resource_monitor.memory_report()
+        if report is None:
+            return None
+        with self._lock:
+            report["running"] = sorted(self._subprocesses.keys())
+        report["activation"] = {n: self.service_activation(n) for n in self.service_node_launches.keys()}
+        # Memory of shared hosted services is reported for their host process, as host:<host_group>
+        report["hosting"] = {n: self.service_hosting(n) for n in self.service_node_launches.keys()}
+        return report
+
+    def _report_memory(self):
+        report = self.memory_report()
+        if report is None:
+            return
+        not_running = [n for n in self.service_node_launches.keys() if n not in report["services"]
+            and n not in report["running"]]
+        print(f"Service memory: peak {report['peak_total_mb']:.1f} MB, steady-state {report['steady_total_mb']:.1f} MB, "
+            f"{len(report['running'])} of {len(self.service_node_launches)} services running"
+            + (f", never started: {', '.join(not_running)}" if len(not_running) > 0 else ""))
         try:
-            t1 = time.time()
-            t_last_sent_close = 0
-            while True:
-                t_diff = time.time() - t1
-                if t_diff > 15:
-                    break
-                running_count = 0
-                with self._lock:
-                    for p in self._subprocesses.values():
-                        if not p.stopped:
-                            running_count += 1
-                if running_count == 0:
-                    break
-                time.sleep(0.1)
-                if t_diff > t_last_sent_close + 1:
-                    t_last_sent_close = t_diff
-                    with self._lock:
-                        for p in self._subprocesses.values():
-                            if not p.stopped:
-                                try:
-                                    p.close()
-                                except Exception:
-                                    traceback.print_exc()
-                                    pass
-            
-            running_count = 0
+            with open(self.log_dir.joinpath("memory.json"), "w") as f:
+                json.dump(report, f, indent=2)
+        except Exception:
+            traceback.print_exc()
+
+    def effective_service_resources(self):
+        # Affinity, scheduling and limits of the running local services, read back from the kernel
+        ret = dict()
+        for name, pid in self.service_process_groups().items():
+            try:
+                ret[name] = process_resources.read_effective_resources(pid)
+            except Exception as e:
+                ret[name] = {"pid": pid, "error": str(e)}
+        return ret
+
+    def _write_effective_resources(self):
+        try:
+            with open(self.log_dir.joinpath("service_resources.json"), "w") as f:
+                json.dump(self.effective_service_resources(), f, indent=2)
+        except Exception:
+            traceback.print_exc()
+
+    def _write_trace(self):
+        try:
+            self.trace.write(self.log_dir.joinpath("trace.json"))
+        except Exception:
+            traceback.print_exc()
+
+    def check_deps_status(self, deps):
+        with self._lock:
+            return all(d in self._ready for d in deps)
+
+    def close(self, detach=False):
+        if detach:
+            self._detach_on_close = True
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            # Called from the event loop thread, can't block
+            task = self._loop.create_task(self.async_close())
+            task.add_done_callback(lambda _: self._finish_close())
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.async_close(), self._loop).result()
+        except Exception:
+            traceback.print_exc()
+        self._finish_close()
+
+    def _finish_close(self, stop_loop=True):
+        if self._service_state is not None:
+            self._service_state.close()
+        self.log_writer.close()
+        if self.structured_logs is not None:
+            self.structured_logs.close()
+        if stop_loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _loop_time(self):
+        return self._loop.time()
+
+    async def __aenter__(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        await self.preflight()
+        self.start_all()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.async_close()
+        # The log writer threads are joined in an executor, the event loop keeps running
+        await self._loop.run_in_executor(None, self._finish_close, False)
+
+    async def async_close(self, detach=False):
+        # With detach, services started with --detach-services are left running for the next pyri-core
+        if detach:
+            self._detach_on_close = True
+        with self._lock:
+            if self._close_future is not None:
+                close_future = self._close_future
+            else:
+                close_future = None
+                self._close_future = self._loop.create_future()
+        if close_future is not None:
+            await asyncio.shield(close_future)
+            return
+        try:
+            await self._do_async_close()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._close_future.set_result(None)
+
+    async def _do_async_close(self):
+        with self._lock:
+            self._closed = True
+            self.trace.instant("pyri-core", "close requested")
+            if self.resource_monitor is not None:
+                self.resource_monitor.stop()
+                self._report_memory()
+            if self._default_devices_task is not None:
+                self._default_devices_task.cancel()
+            self._pending_start.clear()
+            if self._pending_start_handle is not None:
+                self._pending_start_handle.cancel()
+                self._pending_start_handle = None
+            if self._idle_check_handle is not None:
+                self._idle_check_handle.cancel()
+                self._idle_check_handle = None
+            detach = self._detach_on_close
+
+        if detach and self._service_state is None:
+            print("Warning: services are only left running with --detach-services, stopping services")
+        elif detach:
+            self._service_state.freeze()
             with self._lock:
-                for p in self._subprocesses.values():
-                    if not p.stopped:
-                        running_count += 1
-                        try:
-                            p.kill()
-                        except Exception:
-                            traceback.print_exc()
-                        
-            if running_count != 0:
-                print("Sending processes still running SIGKILL")                
-                time.sleep(2)               
-
-            self._loop.stop()
-        except:
+                procs = list(self._subprocesses.values())
+            left = [p.service_node_launch.name for p in procs if p.detach()]
+            print(f"Leaving services running for the next pyri-core: {', '.join(left) if len(left) > 0 else 'none'}")
+            self._service_state.start_drain()
+
+        # Stop dependents before their dependencies, services in the same tier in parallel
+        for tier in reversed(self._dependency_tiers):
+            with self._lock:
+                procs = [self._subprocesses[n] for n in tier if n in self._subprocesses]
+            if len(procs) == 0:
+                continue
+            await asyncio.gather(*[self._stop_process(p) for p in procs])
+
+        if self._fork_server is not None:
+            self._fork_server.close()
+        for h in self._service_hosts.values():
+            h.close()
+        closing = list(self._service_hosts.values())
+        if self._fork_server is not None:
+            closing.append(self._fork_server)
+        await asyncio.gather(*[c.wait_closed() for c in closing])
+        for c in self._agent_clients.values():
+            c.close()
+        self.trace.instant("pyri-core", "all services stopped")
+        if self.loop_stats is not None:
+            self.loop_stats.close()
+        self._write_trace()
+
+    async def _stop_process(self, p):
+        name = p.service_node_launch.name
+        grace_period = self.service_param(name, "stop_grace_period", self.stop_grace_period)
+        try:
+            await p.stop(grace_period, self.stop_kill_timeout)
+        except Exception:
             traceback.print_exc()
 
-    def add_default_devices(self, delay_seconds=5):
-        self._loop.create_task(self._do_add_default_devices(delay_seconds))
+    def add_default_devices(self, timeout=None):
+        if timeout is None:
+            timeout = self.ready_timeout
+        self._default_devices_task = self._loop.create_task(self._do_add_default_devices(timeout))
     
-    async def _do_add_default_devices(self, delay_seconds):
+    async def _do_add_default_devices(self, timeout):
 
         default_devices = []
         for l in self.service_node_launches.values():
@@ -245,56 +1538,135 @@ class PyriCore:
         if len(default_devices) == 0:
             return
 
+        from RobotRaconteur.Client import RRN
+        from pyri.device_manager_client import _DeviceManagerConnectFilter
         filter = _DeviceManagerConnectFilter(RRN, "pyri_device_manager")
         device_manager_sub = RRN.SubscribeServiceByType("tech.pyri.device_manager.DeviceManager", filter.get_filter())
-        if delay_seconds > 0:            
-            await asyncio.sleep(delay_seconds)
-
-        a, f = await self._do_add_default_devices2(default_devices, device_manager_sub)
-
-        while f is None or len(f) > 0:
-            print("Retrying add default devices...")
-            await asyncio.sleep(5)
-            a, f = await self._do_add_default_devices2(default_devices, device_manager_sub)
-
-    async def _do_add_default_devices2(self, default_devices, device_manager_sub):
-
-        res, c = device_manager_sub.TryGetDefaultClient()
-        if not res:
-            print("Warning: could not connect to device manager to add default devices")
-            return None, None
+        try:
+            if "device_manager" in self.service_node_launches:
+                await self.wait_service_ready("device_manager", timeout)
+            await asyncio.wait_for(readiness.wait_subscription_connected(device_manager_sub, self._loop), timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: device manager not ready after {timeout} seconds, adding default devices anyway")
 
-        active_devices = await c.async_getf_active_devices(None)
-        active_device_names = [a.local_device_name for a in active_devices]
+        def get_client():
+            res, c = device_manager_sub.TryGetDefaultClient()
+            return c if res else None
 
-        ident_util = IdentifierUtil(client_obj = c)
+        registration = PyriDefaultDeviceRegistration(default_devices,
+            concurrency = getattr(self._parser_results, "default_devices_concurrency", 4),
+            max_retry_backoff = getattr(self._parser_results, "default_devices_max_retry_backoff", 10),
+            clock = self.clock
+        )
+        await registration.run(get_client)
 
-        added_devices = []
-        failed_devices = []
+def _plugin_cache_fname():
+    return Path(appdirs.user_cache_dir(appname="pyri-project")).joinpath("pyri-core-service-node-launch-cache.json")
 
-        for d in default_devices:
-            try:
-                if d[1] not in active_device_names:
-                    d_ident = ident_util.CreateIdentifierFromName(d[0])
-                    await c.async_add_device(d_ident,d[1],[],None)
-                    added_devices.append(d[1])
-            except Exception as e:
-                print(f"Warning: could not add default device {d[1]}: {str(e)}")
-                failed_devices.append(d[1])
-        if len(added_devices) > 0:
-            print(f"Added default devices: {added_devices}")
-
-        return added_devices, failed_devices
+async def run_core(service_node_launches, parser_results, log_dir):
+    # Runs pyri-core on the current event loop until SIGINT or SIGTERM is received
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    core = PyriCore(None, service_node_launches, parser_results, log_dir, loop)
+    def add_signal_handler(sig, callback):
+        try:
+            loop.add_signal_handler(sig, callback)
+        except NotImplementedError:
+            signal.signal(sig, lambda *args: loop.call_soon_threadsafe(callback))
+    add_signal_handler(signal.SIGINT, stop.set)
+    add_signal_handler(signal.SIGTERM, stop.set)
+    if getattr(parser_results, "detach_services", False) and hasattr(signal, "SIGUSR2"):
+        def detach_requested():
+            # Exit through the normal shutdown path, leaving the detached services running
+            core._detach_on_close = True
+            stop.set()
+        add_signal_handler(signal.SIGUSR2, detach_requested)
+    if hasattr(signal, "SIGUSR1"):
+        # Not a loop signal handler, the statistics are most useful while the loop is blocked
+        def stats_requested(signum, frame):
+            core.dump_loop_stats()
+        signal.signal(signal.SIGUSR1, stats_requested)
+    if getattr(parser_results, "profile", None) is not None and hasattr(signal, "SIGHUP"):
+        add_signal_handler(signal.SIGHUP, core.reload_profile)
+    async with core:
+        if not getattr(parser_results, "no_add_default_devices", False):
+            core.add_default_devices()
+        await stop.wait()
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "logs":
+        from . import logs_command
+        sys.exit(logs_command.main(sys.argv[2:]))
     try:
-        
-        service_node_launch_dict = get_all_service_node_launches()
-        service_node_launch = []
-        for l in service_node_launch_dict.values():
-            service_node_launch.extend(l)
+        pre_parser = argparse.ArgumentParser(add_help=False)
+        pre_parser.add_argument("--no-plugin-cache",action='store_true',default=False)
+        pre_parser.add_argument("--agent",action='store_true',default=False)
+        pre_parser_results, _ = pre_parser.parse_known_args()
+
+        if pre_parser_results.agent:
+            # Agents only launch services for a primary pyri-core, plugins are not loaded
+            agent_parser = argparse.ArgumentParser("PyRI Core Launch Agent")
+            agent_parser.add_argument("--agent",action='store_true',default=False,help="Run as a launch agent for a pyri-core on another host")
+            agent_parser.add_argument("--agent-host",type=str,default="127.0.0.1",help="Address the agent listens on, use 0.0.0.0 to accept connections from other hosts")
+            agent_parser.add_argument("--agent-port",type=int,default=agent._default_port,help="Port the agent listens on")
+            agent_parser.add_argument("--agent-token",type=str,default=os.environ.get("PYRI_AGENT_TOKEN",None),help="Token required from the primary pyri-core, defaults to the PYRI_AGENT_TOKEN environment variable")
+            agent_parser.add_argument("--stop-grace-period",type=float,default=5,help="Seconds to wait for a service to stop before sending SIGKILL")
+            agent_results = agent_parser.parse_args()
+            agent.run_agent(agent_results.agent_host, agent_results.agent_port, agent_results.agent_token,
+                agent_results.stop_grace_period)
+            return
+
+        service_node_launch = plugin_cache.get_service_node_launches(
+            None if pre_parser_results.no_plugin_cache else _plugin_cache_fname())
         parser = argparse.ArgumentParser("PyRI Core Launcher")
         parser.add_argument("--no-add-default-devices",action='store_true',default=False,help="Don't add default devices")
+        parser.add_argument("--no-plugin-cache",action='store_true',default=False,help="Don't use the cached service plugin metadata")
+        parser.add_argument("--service-ready-timeout",type=float,default=60,help="Seconds to wait for a service to report ready")
+        parser.add_argument("--log-flush-interval",type=float,default=0.5,help="Maximum seconds service output is buffered before being written to the log files")
+        parser.add_argument("--log-max-size",type=float,default=50,help="Rotate service log files larger than this size in MB, 0 to disable")
+        parser.add_argument("--log-backup-count",type=int,default=5,help="Number of rotated service log files to keep")
+        parser.add_argument("--log-buffer-lines",type=int,default=10000,help="Number of recent output lines kept in memory for each service, 0 to disable")
+        parser.add_argument("--log-buffer-size",type=float,default=1,help="Maximum size in MB of the recent output lines kept in memory for each service")
+        parser.add_argument("--structured-logs",action='store_true',default=False,help="Also store service output in an indexed SQLite database, see \"pyri-core logs\"")
+        parser.add_argument("--log-retention-days",type=float,default=None,help="Remove log directories of previous runs older than this many days")
+        parser.add_argument("--log-retention-size",type=float,default=None,help="Remove the oldest log directories of previous runs until the total size is below this many MB")
+        parser.add_argument("--log-compact-days",type=float,default=None,help="Compress the log directories of previous runs older than this many days")
+        parser.add_argument("--log-compress",action='store_true',default=False,help="Compress rotated service log files using gzip")
+        parser.add_argument("--fork-server",action='store_true',default=False,help="Fork services from a preloaded server process (Linux only)")
+        parser.add_argument("--startup-summary",action='store_true',default=False,help="Print a table of per-service startup times when all services are ready")
+        parser.add_argument("--stop-grace-period",type=float,default=5,help="Seconds to wait for a service to stop before sending SIGKILL")
+        parser.add_argument("--stop-kill-timeout",type=float,default=5,help="Seconds to wait for a service to exit after SIGKILL")
+        parser.add_argument("--restart-max-backoff",type=float,default=60,help="Maximum seconds between restarts of a crashing service")
+        parser.add_argument("--restart-stable-uptime",type=float,default=60,help="Seconds a service must run before its restart backoff is reset")
+        parser.add_argument("--restart-max-crashes",type=int,default=5,help="Stop restarting a service after this many crashes within --restart-crash-window, or this many crashes in a row within --restart-stable-uptime of starting, 0 to always restart")
+        parser.add_argument("--restart-crash-window",type=float,default=60,help="Window in seconds for --restart-max-crashes")
+        parser.add_argument("--resource-sample-interval",type=float,default=5,help="Seconds between service resource samples, 0 to disable")
+        parser.add_argument("--resource-history",type=int,default=720,help="Number of resource samples kept in memory for each service")
+        parser.add_argument("--resource-rss-limit",type=float,default=None,help="Warn or restart when a service uses more memory than this in MB")
+        parser.add_argument("--resource-cpu-limit",type=float,default=None,help="Warn or restart when a service uses more CPU than this percent")
+        parser.add_argument("--resource-limit-action",type=str,choices=["warn","restart"],default="warn",help="Action when a service exceeds a resource limit")
+        parser.add_argument("--default-devices-concurrency",type=int,default=4,help="Maximum number of default devices added to the device manager at the same time")
+        parser.add_argument("--default-devices-max-retry-backoff",type=float,default=10,help="Maximum seconds between retries of a default device that could not be added")
+        parser.add_argument("--service-resources",type=str,action='append',default=None,help="Override CPU affinity, priority and limits of a service, for example \"robot:cpu_affinity=2-3;sched_policy=fifo;sched_priority=50\". Can be repeated")
+        parser.add_argument("--loop-stats-interval",type=float,default=60,help="Seconds between writes of the event loop statistics to loop_stats.json in the log directory, 0 to disable. The statistics are printed on SIGUSR1")
+        parser.add_argument("--slow-callback-threshold",type=float,default=0.1,help="Report event loop callbacks that block the loop for longer than this many seconds")
+        parser.add_argument("--default-activation",type=str,choices=["eager","on-demand","idle-stop"],default="eager",help="Activation mode of services that don't set one. on-demand services are only started when requested, idle-stop services are also stopped when idle")
+        parser.add_argument("--service-activation",type=str,action='append',default=None,help="Override the activation mode of a service, for example \"my_service=on-demand\". Can be repeated")
+        parser.add_argument("--default-hosting",type=str,choices=["isolated","shared"],default="isolated",help="Hosting mode of services that don't set one. shared services run as threads in a shared host process to reduce memory use (Linux only)")
+        parser.add_argument("--service-hosting",type=str,action='append',default=None,help="Override the hosting mode of a service, for example \"my_service=shared\". Can be repeated")
+        parser.add_argument("--idle-timeout",type=float,default=300,help="Seconds without activity before an idle-stop service is stopped")
+        parser.add_argument("--idle-cpu-percent",type=float,default=2,help="idle-stop services using more CPU than this percent are not considered idle")
+        parser.add_argument("--profile",type=str,default=None,help="YAML launch profile that enables, disables and configures services. Reloaded on SIGHUP")
+        parser.add_argument("--detach-services",action='store_true',default=False,help="Start services detached from pyri-core, so a restarted pyri-core adopts them instead of restarting them. Send SIGUSR2 to exit leaving the services running (Linux only)")
+        parser.add_argument("--state-dir",type=str,default=None,help="Directory for the state file and output FIFOs of detached services")
+        parser.add_argument("--placement",type=str,default=None,help="YAML file placing services on launch agents running on other hosts")
+        parser.add_argument("--agent-token",type=str,default=os.environ.get("PYRI_AGENT_TOKEN",None),help="Token used to connect to launch agents, defaults to the PYRI_AGENT_TOKEN environment variable")
+        parser.add_argument("--agent",action='store_true',default=False,help="Run as a launch agent for a pyri-core on another host")
+        parser.add_argument("--fork-server-preimport",type=str,default=None,help="Comma separated list of modules to import in the fork server")
+        parser.add_argument("--no-preflight",action='store_true',default=False,help="Don't check the modules and arguments of the services before starting them")
+        parser.add_argument("--no-precompile",action='store_false',dest='precompile',default=True,help="Don't precompile the bytecode of the service packages before starting the services")
+        parser.add_argument("--precompile-workers",type=int,default=0,help="Number of processes used to precompile bytecode, 0 for one per CPU")
+        parser.add_argument("--bytecode-cache-dir",type=str,default=None,help="Directory the services write and read bytecode in, instead of the __pycache__ directories. Used by default in a user cache directory when the service packages are not writable")
         for l in service_node_launch:
             if l.add_arg_parser_options is not None:
                 l.add_arg_parser_options(parser)
@@ -302,28 +1674,19 @@ def main():
         parser_results, _ = parser.parse_known_args()
 
         timestamp = datetime.now().strftime("pyri-core-%Y-%m-%d--%H-%M-%S")
-        log_dir = Path(appdirs.user_log_dir(appname="pyri-project")).joinpath(timestamp)
+        log_root = Path(appdirs.user_log_dir(appname="pyri-project"))
+        log_dir = log_root.joinpath(timestamp)
         log_dir.mkdir(parents=True, exist_ok=True)
-        def loop_in_thread(loop):
-            asyncio.set_event_loop(loop)
-            loop.run_forever()
-            print("Exited loop!")
-        loop = asyncio.new_event_loop()
-        t = threading.Thread(target=loop_in_thread, args=(loop,), daemon=True)
-        t.start()
-                
-        core = PyriCore(None, service_node_launch, parser_results, log_dir, loop)
-        loop.call_soon_threadsafe(lambda: core.start_all())
-        if not parser_results.no_add_default_devices:
-            loop.call_soon_threadsafe(lambda: core.add_default_devices())
-        def ctrl_c_pressed(signum, frame):
-            loop.call_soon_threadsafe(lambda: core.close())
-        signal.signal(signal.SIGINT, ctrl_c_pressed)
-        signal.signal(signal.SIGTERM, ctrl_c_pressed)
-        #loop.run_forever()
-        wait_exit()
-        core.close()
+        from . import log_retention
+        # Held until pyri-core exits, "pyri-core logs --prune" skips locked runs
+        run_lock = log_retention.lock_run(log_dir)
+        if parser_results.log_retention_days is not None or parser_results.log_retention_size is not None \
+                or parser_results.log_compact_days is not None:
+            threading.Thread(target=log_retention.apply_retention, args=(log_root, parser_results.log_retention_days,
+                parser_results.log_retention_size, parser_results.log_compact_days, [log_dir]), daemon=True).start()
+        asyncio.run(run_core(service_node_launch, parser_results, log_dir))
         
+        run_lock.close()
         print("Done")
     except Exception:
         traceback.print_exc()
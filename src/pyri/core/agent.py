@@ -0,0 +1,452 @@
+import asyncio
+import base64
+import hmac
+import ipaddress
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from . import subprocess_impl
+from . import process_resources
+from . import heartbeat
+
+# Launch agent for running services on other hosts. Start an agent on each
+# compute node with "pyri-core --agent", and place services on it using a
+# placement file passed to the primary pyri-core with --placement:
+#
+#   agents:
+#     compute1:
+#       host: 192.168.1.20
+#       port: 50110
+#   placement:
+#     vision_service: compute1
+#
+# The primary connects to each agent over TCP. Messages are JSON objects, one
+# per line. The agent spawns services using subprocess_impl and streams their
+# output and exit status back. Services started by a connection are stopped
+# when the connection is lost.
+#
+# An agent runs the modules it is asked to run, so an agent listening on a
+# non-loopback address requires a token. The connection is not encrypted and
+# the token is sent in cleartext, use an SSH tunnel or a VPN between hosts on
+# untrusted networks. Only the environment variables the primary sets for the
+# heartbeat watchdog are passed to the services.
+
+_default_port = 50110
+_read_chunk_size = 32768
+_max_msg_size = 1024 * 1024
+_allowed_env = (heartbeat.heartbeat_marker_env,)
+
+
+def _encode_msg(msg):
+    return json.dumps(msg).encode("utf-8") + b"\n"
+
+
+async def _read_msg(reader):
+    line = await reader.readline()
+    if len(line) == 0:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
+def parse_agent_address(address, default_port=_default_port):
+    host, sep, port = address.rpartition(":")
+    if not sep:
+        return address, default_port
+    return host, int(port)
+
+
+def is_loopback_address(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _valid_module_name(name):
+    return isinstance(name, str) and len(name) > 0 and all(p.isidentifier() for p in name.split("."))
+
+
+def load_placement(fname):
+    import yaml
+    with open(fname) as f:
+        placement = yaml.safe_load(f) or dict()
+    agents = dict()
+    for name, a in (placement.get("agents", None) or dict()).items():
+        if isinstance(a, str):
+            host, port = parse_agent_address(a)
+            a = {"host": host, "port": port}
+        agents[name] = {"host": a["host"], "port": int(a.get("port", _default_port)), "token": a.get("token", None)}
+    services = dict()
+    for service_name, agent_name in (placement.get("placement", None) or dict()).items():
+        if agent_name is not None and agent_name not in agents:
+            raise ValueError(f"Service {service_name} placed on unknown agent {agent_name}")
+        services[service_name] = agent_name
+    return agents, services
+
+
+class _AgentConnection:
+    def __init__(self, agent, reader, writer):
+        self.agent = agent
+        self._reader = reader
+        self._writer = writer
+        self._write_lock = asyncio.Lock()
+        self._processes = dict()
+        self._tasks = set()
+        self.peer = writer.get_extra_info("peername")
+
+    async def _send(self, msg):
+        async with self._write_lock:
+            self._writer.write(_encode_msg(msg))
+            await self._writer.drain()
+
+    async def run(self):
+        try:
+            hello = await _read_msg(self._reader)
+            if hello is None or hello.get("op") != "hello":
+                return
+            token = self.agent.token
+            if token is not None and not hmac.compare_digest(str(hello.get("token", "")), token):
+                print(f"Agent connection from {self.peer} rejected, invalid token")
+                await self._send({"op": "error", "error": "invalid token"})
+                return
+            await self._send({"op": "hello", "hostname": socket.gethostname(), "pid": os.getpid()})
+            print(f"Agent connection from {self.peer}")
+            while True:
+                msg = await _read_msg(self._reader)
+                if msg is None:
+                    break
+                op = msg["op"]
+                if op == "spawn":
+                    await self._spawn(msg)
+                elif op == "signal":
+                    self._signal(msg["pid"], msg["signal"])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            print(f"Agent connection from {self.peer} closed")
+            await self._stop_all()
+            self._writer.close()
+
+    async def _spawn(self, msg):
+        env = msg.get("env", None) or dict()
+        denied = [k for k in env.keys() if k not in _allowed_env]
+        if len(denied) > 0 or not _valid_module_name(msg.get("module_main", None)) \
+                or not all(isinstance(a, str) for a in msg.get("args", [])):
+            error = f"environment variables not allowed: {', '.join(denied)}" if len(denied) > 0 \
+                else "invalid module or arguments"
+            print(f"Agent spawn request from {self.peer} rejected, {error}")
+            await self._send({"op": "error", "id": msg["id"], "error": error})
+            return
+        env = dict(os.environ, **env) if len(env) > 0 else None
+        try:
+            resources = process_resources.validate_resources(msg.get("resources", None))
+            process = await subprocess_impl.create_subprocess_exec(sys.executable,
+                ["-m", msg["module_main"]] + list(msg["args"]), env, resources=resources)
+        except Exception as e:
+            traceback.print_exc()
+            await self._send({"op": "error", "id": msg["id"], "error": str(e)})
+            return
+        print(f"Agent started {msg['module_main']} pid {process.pid}")
+        self._processes[process.pid] = process
+        await self._send({"op": "spawned", "id": msg["id"], "pid": process.pid})
+        t = asyncio.ensure_future(self._watch(process))
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def _pump_output(self, pid, stream_name, stream):
+        while True:
+            data = await stream.read(_read_chunk_size)
+            if len(data) == 0:
+                break
+            await self._send({"op": "output", "pid": pid, "stream": stream_name,
+                "data": base64.b64encode(data).decode("ascii")})
+
+    async def _watch(self, process):
+        pid = process.pid
+        try:
+            await asyncio.gather(
+                self._pump_output(pid, "stdout", process.stdout),
+                self._pump_output(pid, "stderr", process.stderr)
+            )
+        except ConnectionError:
+            pass
+        returncode = await process.wait()
+        self._processes.pop(pid, None)
+        print(f"Agent process pid {pid} exited with {returncode}")
+        try:
+            await self._send({"op": "exited", "pid": pid, "returncode": returncode})
+        except ConnectionError:
+            pass
+
+    def _signal(self, pid, sig):
+        process = self._processes.get(pid, None)
+        if process is None:
+            return
+        try:
+            if sig == "kill":
+                process.kill()
+            else:
+                process.send_term()
+        except Exception:
+            traceback.print_exc()
+
+    async def _stop_all(self):
+        processes = list(self._processes.values())
+        if len(processes) == 0:
+            return
+        for p in processes:
+            self._signal(p.pid, "term")
+        waits = [asyncio.ensure_future(p.wait()) for p in processes]
+        _, pending = await asyncio.wait(waits, timeout=self.agent.stop_grace_period)
+        if len(pending) > 0:
+            for p in processes:
+                if p.process.returncode is None:
+                    self._signal(p.pid, "kill")
+            await asyncio.wait(pending, timeout=5)
+
+
+class PyriAgent:
+    def __init__(self, host="127.0.0.1", port=_default_port, token=None, stop_grace_period=5):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.stop_grace_period = stop_grace_period
+        self._server = None
+        self._connections = set()
+        self._closing = False
+
+    async def start(self):
+        if self.token is None and not is_loopback_address(self.host):
+            raise ValueError(f"Agent listening on {self.host} requires a token, set --agent-token or PYRI_AGENT_TOKEN")
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, limit=_max_msg_size)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"PyRI agent listening on {self.host}:{self.port}")
+
+    async def _handle_connection(self, reader, writer):
+        conn = _AgentConnection(self, reader, writer)
+        t = asyncio.ensure_future(conn.run())
+        self._connections.add(t)
+        try:
+            await t
+        except asyncio.CancelledError:
+            # Connections are cancelled by close()
+            if not self._closing:
+                raise
+        finally:
+            self._connections.discard(t)
+
+    async def close(self):
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Closing the connections stops their services
+        for t in list(self._connections):
+            t.cancel()
+        if len(self._connections) > 0:
+            await asyncio.wait(list(self._connections), timeout=self.stop_grace_period + 5)
+
+
+class PyriAgentClient:
+    def __init__(self, loop, name, host, port=_default_port, token=None):
+        self._loop = loop
+        self.name = name
+        self.host = host
+        self.port = port
+        self.token = token
+        self.remote_hostname = None
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._next_id = 1
+        self._spawn_futures = dict()
+        self._processes = dict()
+        self._closed = False
+
+    @property
+    def alive(self):
+        return self._writer is not None and not self._closed
+
+    async def connect(self, timeout=10):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=_max_msg_size), timeout)
+        self._write({"op": "hello", "token": self.token})
+        hello = await asyncio.wait_for(_read_msg(self._reader), timeout)
+        if hello is None or hello.get("op") != "hello":
+            err = hello.get("error", "connection closed") if hello is not None else "connection closed"
+            self._writer.close()
+            self._writer = None
+            raise ConnectionError(f"Could not connect to agent {self.name}: {err}")
+        self.remote_hostname = hello.get("hostname", None)
+        self._read_task = self._loop.create_task(self._read_loop())
+
+    def _write(self, msg):
+        self._writer.write(_encode_msg(msg))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                msg = await _read_msg(self._reader)
+                if msg is None:
+                    break
+                self._handle_msg(msg)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        self._lost()
+
+    def _handle_msg(self, msg):
+        op = msg["op"]
+        if op == "output":
+            p = self._processes.get(msg["pid"], None)
+            if p is not None:
+                p._feed(msg["stream"], base64.b64decode(msg["data"]))
+        elif op == "spawned":
+            f = self._spawn_futures.pop(msg["id"], None)
+            p = PyriRemoteSubprocessImpl(self, msg["pid"], self._loop)
+            self._processes[p.pid] = p
+            if f is not None and not f.done():
+                f.set_result(p)
+        elif op == "error":
+            f = self._spawn_futures.pop(msg.get("id", None), None)
+            if f is not None and not f.done():
+                f.set_exception(OSError(f"Agent {self.name}: {msg['error']}"))
+        elif op == "exited":
+            p = self._processes.pop(msg["pid"], None)
+            if p is not None:
+                p._set_exited(msg["returncode"])
+
+    def _lost(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        err = ConnectionError(f"Connection to agent {self.name} lost")
+        for f in self._spawn_futures.values():
+            if not f.done():
+                f.set_exception(err)
+        self._spawn_futures.clear()
+        # The agent stops the services of a lost connection
+        for p in self._processes.values():
+            p._set_exited(None)
+        self._processes.clear()
+        if not self._closed:
+            print(f"Warning: connection to agent {self.name} at {self.host}:{self.port} lost")
+
+    async def create_subprocess(self, module_main, args, env=None, resources=None):
+        if not self.alive:
+            raise ConnectionError(f"Agent {self.name} not connected")
+        req_id = self._next_id
+        self._next_id += 1
+        f = self._loop.create_future()
+        self._spawn_futures[req_id] = f
+        self._write({"op": "spawn", "id": req_id, "module_main": module_main, "args": list(args),
+            "env": dict(env) if env is not None else None, "resources": resources})
+        return await f
+
+    def signal(self, pid, sig):
+        if self.alive:
+            self._write({"op": "signal", "pid": pid, "signal": sig})
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+        elif self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class PyriRemoteSubprocessImpl:
+    remote = True
+
+    def __init__(self, client, pid, loop):
+        self._client = client
+        self._pid = pid
+        self._stdout = asyncio.StreamReader(loop=loop)
+        self._stderr = asyncio.StreamReader(loop=loop)
+        self._exit_future = loop.create_future()
+
+    def _feed(self, stream_name, data):
+        if stream_name == "stdout":
+            self._stdout.feed_data(data)
+        else:
+            self._stderr.feed_data(data)
+
+    def _set_exited(self, returncode):
+        self._stdout.feed_eof()
+        self._stderr.feed_eof()
+        if not self._exit_future.done():
+            self._exit_future.set_result(returncode)
+
+    @property
+    def process(self):
+        return None
+
+    @property
+    def host(self):
+        return self._client.host
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def returncode(self):
+        if not self._exit_future.done():
+            return None
+        return self._exit_future.result()
+
+    async def wait(self):
+        return await asyncio.shield(self._exit_future)
+
+    def kill(self):
+        if not self._exit_future.done():
+            self._client.signal(self._pid, "kill")
+
+    def send_term(self):
+        if not self._exit_future.done():
+            self._client.signal(self._pid, "term")
+
+    def close(self):
+        self.kill()
+
+
+def run_agent(host, port, token=None, stop_grace_period=5):
+    async def run():
+        agent = PyriAgent(host, port, token, stop_grace_period)
+        try:
+            await agent.start()
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                signal.signal(sig, lambda *args: loop.call_soon_threadsafe(stop.set))
+        await stop.wait()
+        print("Stopping agent...")
+        await agent.close()
+
+    asyncio.run(run())
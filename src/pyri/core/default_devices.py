@@ -0,0 +1,135 @@
+import asyncio
+import time
+from typing import NamedTuple
+
+# Registers the default devices of the installed plugins with the device
+# manager. Devices are added concurrently, bounded by a semaphore, and only
+# devices that failed are retried, each with its own exponential backoff.
+# The set of active devices is cached between retry rounds. It is refreshed
+# when the device manager connection changes, and at most every
+# max_retry_backoff seconds while devices are retried, in case a failed
+# device was added by someone else.
+
+
+class DefaultDeviceResult(NamedTuple):
+    device_name: str
+    local_device_name: str
+    added: bool
+    attempts: int
+    latency: float
+    error: str
+
+
+class _PendingDevice:
+    def __init__(self, device_name, local_device_name):
+        self.device_name = device_name
+        self.local_device_name = local_device_name
+        self.attempts = 0
+        self.next_try = 0
+        self.error = None
+
+
+_warning_interval = 5
+
+
+class PyriDefaultDeviceRegistration:
+    def __init__(self, default_devices, concurrency=4, retry_backoff=0.5, max_retry_backoff=10, clock=time.monotonic):
+        self.concurrency = concurrency
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._clock = clock
+        self.results = dict()
+        self._t0 = None
+        self._pending = dict()
+        for device_name, local_device_name in default_devices:
+            if local_device_name in self._pending:
+                print(f"Warning: duplicate default device {local_device_name}, ignoring {device_name}")
+                continue
+            self._pending[local_device_name] = _PendingDevice(device_name, local_device_name)
+
+    async def run(self, get_client, client_wait=1.0):
+        # get_client returns the device manager client, or None if not connected
+        from RobotRaconteurCompanion.Util.IdentifierUtil import IdentifierUtil
+
+        self._t0 = self._clock()
+        client = None
+        active_device_names = None
+        active_time = None
+        ident_util = None
+        last_warning = None
+        sem = asyncio.Semaphore(self.concurrency)
+
+        while len(self._pending) > 0:
+            c = get_client()
+            if c is None:
+                now = self._clock()
+                if last_warning is None or now - last_warning >= _warning_interval:
+                    print("Warning: could not connect to device manager to add default devices")
+                    last_warning = now
+                await asyncio.sleep(client_wait)
+                continue
+            last_warning = None
+            if c is not client:
+                client = c
+                ident_util = IdentifierUtil(client_obj = client)
+                active_device_names = None
+
+            if active_device_names is None or self._clock() - active_time >= self.max_retry_backoff:
+                try:
+                    active_devices = await client.async_getf_active_devices(None)
+                    active_device_names = set(a.local_device_name for a in active_devices)
+                    active_time = self._clock()
+                except Exception as e:
+                    print(f"Warning: could not get active devices from device manager: {str(e)}")
+                    client = None
+                    await asyncio.sleep(client_wait)
+                    continue
+
+            for name in [n for n in self._pending.keys() if n in active_device_names]:
+                self._record(self._pending.pop(name), False)
+
+            now = self._clock()
+            due = [d for d in self._pending.values() if d.next_try <= now]
+            if len(due) > 0:
+                await asyncio.gather(*[self._add_device(client, ident_util, sem, d, active_device_names) for d in due])
+
+            if len(self._pending) > 0:
+                next_try = min(d.next_try for d in self._pending.values())
+                await asyncio.sleep(max(next_try - self._clock(), 0))
+
+        self.print_summary()
+        return self.results
+
+    async def _add_device(self, client, ident_util, sem, d, active_device_names):
+        async with sem:
+            d.attempts += 1
+            t1 = self._clock()
+            try:
+                d_ident = ident_util.CreateIdentifierFromName(d.device_name)
+                await client.async_add_device(d_ident, d.local_device_name, [], None)
+            except Exception as e:
+                d.error = str(e)
+                backoff = min(self.retry_backoff * (2 ** (d.attempts - 1)), self.max_retry_backoff)
+                d.next_try = self._clock() + backoff
+                print(f"Warning: could not add default device {d.local_device_name} "
+                    f"(attempt {d.attempts}, retry in {backoff:.1f} s): {d.error}")
+                return
+            t2 = self._clock()
+            active_device_names.add(d.local_device_name)
+            self._pending.pop(d.local_device_name, None)
+            self._record(d, True, t2 - t1)
+
+    def _record(self, d, added, latency=0.0):
+        self.results[d.local_device_name] = DefaultDeviceResult(d.device_name, d.local_device_name, added,
+            d.attempts, latency, d.error)
+
+    def print_summary(self):
+        added = [r for r in self.results.values() if r.added]
+        existing = [r.local_device_name for r in self.results.values() if not r.added]
+        total = self._clock() - self._t0 if self._t0 is not None else 0
+        if len(added) > 0:
+            added_str = ", ".join(f"{r.local_device_name} ({r.latency*1000:.0f} ms"
+                f"{f', {r.attempts} attempts' if r.attempts > 1 else ''})" for r in added)
+            print(f"Added default devices in {total:.2f} s: {added_str}")
+        if len(existing) > 0:
+            print(f"Default devices already active: {', '.join(existing)}")
@@ -0,0 +1,108 @@
+from typing import Dict, List
+
+
+class DependencyCycleError(Exception):
+    def __init__(self, cycle):
+        super().__init__(f"Service dependency cycle detected: {' -> '.join(cycle)}")
+        self.cycle = cycle
+
+
+def build_dependency_graph(service_node_launches):
+    # service_node_launches is a dict of name -> ServiceNodeLaunch
+    graph = dict()
+    for name, s in service_node_launches.items():
+        deps = []
+        for d in (s.depends or []):
+            if d not in service_node_launches:
+                print(f"Warning: service {name} depends on unknown service {d}, ignoring dependency")
+                continue
+            if d not in deps:
+                deps.append(d)
+        graph[name] = deps
+
+    cycle = find_dependency_cycle(graph)
+    if cycle is not None:
+        raise DependencyCycleError(cycle)
+    return graph
+
+
+def find_dependency_cycle(graph: Dict[str, List[str]]):
+    WHITE, GRAY, BLACK = 0, 1, 2
+    color = {n: WHITE for n in graph}
+    stack = []
+
+    def visit(n):
+        color[n] = GRAY
+        stack.append(n)
+        for d in graph.get(n, []):
+            if color.get(d, BLACK) == GRAY:
+                return stack[stack.index(d):] + [d]
+            if color.get(d, BLACK) == WHITE:
+                c = visit(d)
+                if c is not None:
+                    return c
+        stack.pop()
+        color[n] = BLACK
+        return None
+
+    for n in graph:
+        if color[n] == WHITE:
+            c = visit(n)
+            if c is not None:
+                return c
+    return None
+
+
+def dependency_tiers(graph: Dict[str, List[str]]):
+    # Kahn's algorithm grouped by level. Tier 0 has no dependencies, tier n
+    # only depends on services in tiers < n
+    remaining = {n: set(d for d in deps if d in graph) for n, deps in graph.items()}
+    tiers = []
+    while len(remaining) > 0:
+        tier = sorted(n for n, deps in remaining.items() if len(deps) == 0)
+        if len(tier) == 0:
+            raise DependencyCycleError(find_dependency_cycle(graph) or sorted(remaining))
+        tiers.append(tier)
+        for n in tier:
+            del remaining[n]
+        for deps in remaining.values():
+            deps.difference_update(tier)
+    return tiers
+
+
+def reverse_dependency_graph(graph: Dict[str, List[str]]):
+    dependents = {n: [] for n in graph}
+    for n, deps in graph.items():
+        for d in deps:
+            dependents[d].append(n)
+    return dependents
+
+
+def transitive_dependencies(graph: Dict[str, List[str]], name):
+    ret = []
+    stack = list(graph.get(name, []))
+    while len(stack) > 0:
+        d = stack.pop()
+        if d in ret:
+            continue
+        ret.append(d)
+        stack.extend(graph.get(d, []))
+    return ret
+
+
+def critical_path(graph: Dict[str, List[str]], ready_times: Dict[str, float]):
+    # Walks back from the last service to become ready, always following the
+    # dependency that became ready last. Returns the path from the root.
+    candidates = [n for n in graph if n in ready_times]
+    if len(candidates) == 0:
+        return []
+    n = max(candidates, key=lambda x: ready_times[x])
+    path = [n]
+    while True:
+        deps = [d for d in graph.get(n, []) if d in ready_times]
+        if len(deps) == 0:
+            break
+        n = max(deps, key=lambda x: ready_times[x])
+        path.append(n)
+    path.reverse()
+    return path
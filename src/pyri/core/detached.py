@@ -0,0 +1,412 @@
+import asyncio
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+if sys.platform != "win32":
+    import fcntl
+import time
+import traceback
+from pathlib import Path
+from . import resource_monitor
+
+# Detached service launch, used with --detach-services so pyri-core can be
+# restarted or upgraded without restarting the services. Services are started
+# in their own session with stdout and stderr connected to named FIFOs in the
+# state directory instead of pipes owned by the launcher. Each service also
+# holds an unused read end of its FIFOs, so writes never fail while no
+# launcher is running. When the launcher exits leaving the services running,
+# it starts a drain process that copies the output from the FIFOs to files
+# next to them, so the services don't block once the FIFO buffers are full.
+# Output beyond _drain_max_bytes for each stream is dropped. The next
+# launcher stops the drain process before it adopts the services.
+#
+# The pid, start time and launch arguments of each service are kept in a state
+# file. A restarted pyri-core verifies the recorded processes using the pid and
+# the start time from /proc, and adopts them instead of starting new ones.
+
+state_fname = "services.json"
+_lock_fname = "lock"
+_fifo_dir = "fifo"
+_pipe_size = 1024 * 1024
+_drain_max_bytes = 16 * 1024 * 1024
+# F_SETPIPE_SZ on Linux, only defined by the fcntl module since Python 3.10
+_F_SETPIPE_SZ = 1031
+
+
+def detach_supported():
+    return sys.platform.startswith("linux") and hasattr(os, "mkfifo")
+
+
+def default_state_dir():
+    import appdirs
+    return Path(appdirs.user_data_dir(appname="pyri-project")).joinpath("pyri-core-state")
+
+
+def process_start_time(pid):
+    # Start time in clock ticks since boot, None if the process doesn't exist
+    try:
+        return resource_monitor.read_proc_stat(pid)["starttime"]
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def verify_record(record):
+    # The pid may have been reused by another process, check the start time as well
+    pid = record["pid"]
+    if process_start_time(pid) != record["starttime"]:
+        return False
+    try:
+        return os.getpgid(pid) == record["pgid"]
+    except OSError:
+        return False
+
+
+class PyriServiceState:
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+        self.state_dir.joinpath(_fifo_dir).mkdir(parents=True, exist_ok=True)
+        self._lock_fd = os.open(str(self.state_dir.joinpath(_lock_fname)), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._lock_fd)
+            raise RuntimeError(f"Another pyri-core is using the state directory {self.state_dir}")
+        self.records = dict()
+        self._frozen = False
+
+    def load(self):
+        # Returns the recorded services that are still running
+        fname = self.state_dir.joinpath(state_fname)
+        if not fname.is_file():
+            return dict()
+        try:
+            with open(fname) as f:
+                state = json.load(f)
+            records = state.get("services", dict())
+        except Exception:
+            traceback.print_exc()
+            print(f"Warning: could not read service state file {fname}")
+            return dict()
+        _stop_drain(state.get("drain", None))
+        drained = [str(f) for f in self.state_dir.joinpath(_fifo_dir).glob("*.log") if f.stat().st_size > 0]
+        if len(drained) > 0:
+            print(f"Output of detached services while no pyri-core was running: {', '.join(sorted(drained))}")
+        ret = dict()
+        for name, record in records.items():
+            if verify_record(record):
+                ret[name] = record
+            else:
+                print(f"Service {name} recorded in state file is no longer running")
+        return ret
+
+    def fifo_fnames(self, name):
+        d = self.state_dir.joinpath(_fifo_dir)
+        return d.joinpath(f"{name}.stdout"), d.joinpath(f"{name}.stderr")
+
+    def set_record(self, name, record):
+        self.records[name] = record
+        self.save()
+
+    def remove_record(self, name):
+        if self.records.pop(name, None) is not None:
+            self.save()
+
+    def save(self, drain=None):
+        if self._frozen:
+            return
+        fname = self.state_dir.joinpath(state_fname)
+        tmp_fname = fname.with_suffix(".tmp")
+        state = {"launcher_pid": os.getpid(), "time": time.time(), "services": self.records}
+        if drain is not None:
+            state["drain"] = drain
+        try:
+            with open(tmp_fname, "w") as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_fname, fname)
+        except Exception:
+            traceback.print_exc()
+
+    def freeze(self):
+        # Keep the current records when the launcher exits leaving the services running
+        self.save()
+        self._frozen = True
+
+    def start_drain(self):
+        # Called after the launcher has stopped reading the output of the services it leaves running
+        if len(self.records) == 0:
+            return
+        try:
+            popen = subprocess.Popen([sys.executable, "-m", "pyri.core.detached", str(self.state_dir)],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True)
+        except Exception:
+            traceback.print_exc()
+            print("Warning: could not start the drain process, services block when their output FIFOs are full")
+            return
+        self._frozen = False
+        self.save({"pid": popen.pid, "starttime": process_start_time(popen.pid)})
+        self._frozen = True
+
+    def close(self):
+        os.close(self._lock_fd)
+
+
+def _stop_drain(record):
+    if record is None:
+        return
+    pid = record["pid"]
+    if process_start_time(pid) != record["starttime"]:
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        try:
+            # Only reaps the drain process if it was started by this process
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return
+        except ChildProcessError:
+            pass
+        if process_start_time(pid) != record["starttime"]:
+            return
+        time.sleep(0.05)
+    print(f"Warning: drain process {pid} did not exit, killing it")
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_drain(state_dir):
+    # Copies the output of the services in the state file to <fifo>.log until they exit or SIGTERM is received
+    state_dir = Path(state_dir)
+    with open(state_dir.joinpath(state_fname)) as f:
+        records = json.load(f).get("services", dict())
+    stop = []
+    signal.signal(signal.SIGTERM, lambda *args: stop.append(True))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    streams = dict()
+    d = state_dir.joinpath(_fifo_dir)
+    for name in records.keys():
+        for stream_name in ("stdout", "stderr"):
+            fifo = d.joinpath(f"{name}.{stream_name}")
+            try:
+                fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            streams[fd] = [open(f"{fifo}.log", "wb"), False]
+    while len(streams) > 0 and len(stop) == 0:
+        readable, _, _ = select.select(list(streams.keys()), [], [], 1.0)
+        for fd in readable:
+            f, dropping = streams[fd]
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if len(data) == 0:
+                # The service has exited
+                os.close(fd)
+                f.close()
+                del streams[fd]
+            elif f.tell() + len(data) > _drain_max_bytes:
+                if not dropping:
+                    f.write(b"\n[output dropped, no pyri-core is running]\n")
+                    f.flush()
+                    streams[fd][1] = True
+            else:
+                f.write(data)
+                f.flush()
+    for fd, (f, _) in streams.items():
+        os.close(fd)
+        f.close()
+
+
+def _open_fifo(fname, create):
+    # Returns (read_fd, keepalive_read_fd, write_fd) for new FIFOs, only the read fd when adopting
+    if create:
+        try:
+            os.unlink(fname)
+        except FileNotFoundError:
+            pass
+        os.mkfifo(fname, 0o600)
+    read_fd = os.open(fname, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        fcntl.fcntl(read_fd, _F_SETPIPE_SZ, _pipe_size)
+    except OSError:
+        pass
+    if not create:
+        return read_fd, None, None
+    keepalive_fd = os.open(fname, os.O_RDONLY | os.O_NONBLOCK)
+    write_fd = os.open(fname, os.O_WRONLY)
+    return read_fd, keepalive_fd, write_fd
+
+
+async def _open_read_pipe(loop, fd):
+    reader = asyncio.StreamReader(loop=loop)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop),
+        os.fdopen(fd, "rb", 0))
+    return reader, transport
+
+
+async def _watch_exit(loop, pid, popen, exit_future):
+    # Services started by this launcher are reaped to get the exit code. Adopted services are
+    # children of init, only their exit is detected.
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            pass
+        except OSError:
+            pidfd = None
+        if pidfd is not None:
+            readable = loop.create_future()
+            loop.add_reader(pidfd, lambda: readable.done() or readable.set_result(True))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+    if pidfd is None:
+        while True:
+            if popen is not None:
+                if popen.poll() is not None:
+                    break
+            elif process_start_time(pid) is None:
+                break
+            await asyncio.sleep(0.5)
+    if not exit_future.done():
+        exit_future.set_result(popen.wait() if popen is not None else None)
+
+
+async def create_detached_subprocess(loop, state, name, args, env=None, pass_fds=(), preexec_fn=None):
+    stdout_fname, stderr_fname = state.fifo_fnames(name)
+    fds = []
+    try:
+        stdout_r, stdout_keepalive, stdout_w = _open_fifo(stdout_fname, True)
+        fds.extend([stdout_r, stdout_keepalive, stdout_w])
+        stderr_r, stderr_keepalive, stderr_w = _open_fifo(stderr_fname, True)
+        fds.extend([stderr_r, stderr_keepalive, stderr_w])
+        popen = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=stdout_w, stderr=stderr_w, env=env,
+            close_fds=True, pass_fds=[stdout_keepalive, stderr_keepalive] + list(pass_fds),
+            preexec_fn=preexec_fn if preexec_fn is not None else os.setsid)
+    except:
+        for fd in fds:
+            os.close(fd)
+        raise
+    for fd in [stdout_keepalive, stdout_w, stderr_keepalive, stderr_w]:
+        os.close(fd)
+    record = {"pid": popen.pid, "starttime": process_start_time(popen.pid), "pgid": popen.pid,
+        "args": list(args), "started": time.time()}
+    return await _create_impl(loop, popen.pid, stdout_r, stderr_r, popen), record
+
+
+async def adopt_subprocess(loop, state, name, record):
+    # Returns None if the process has exited since the state file was loaded
+    if not verify_record(record):
+        return None
+    stdout_fname, stderr_fname = state.fifo_fnames(name)
+    stdout_r = None
+    try:
+        stdout_r, _, _ = _open_fifo(stdout_fname, False)
+        stderr_r, _, _ = _open_fifo(stderr_fname, False)
+    except OSError:
+        traceback.print_exc()
+        if stdout_r is not None:
+            os.close(stdout_r)
+        print(f"Warning: could not open the output of service {name}, not adopting")
+        return None
+    return await _create_impl(loop, record["pid"], stdout_r, stderr_r, None, record["pgid"])
+
+
+async def _create_impl(loop, pid, stdout_r, stderr_r, popen, pgid=None):
+    stdout, stdout_transport = await _open_read_pipe(loop, stdout_r)
+    stderr, stderr_transport = await _open_read_pipe(loop, stderr_r)
+    exit_future = loop.create_future()
+    impl = PyriDetachedSubprocessImpl(pid, pgid if pgid is not None else pid, stdout, stderr,
+        [stdout_transport, stderr_transport], exit_future, popen)
+    impl._watch_task = loop.create_task(_watch_exit(loop, pid, popen, exit_future))
+    return impl
+
+
+class PyriDetachedSubprocessImpl:
+    detached = True
+
+    def __init__(self, pid, pgid, stdout, stderr, transports, exit_future, popen=None):
+        self._pid = pid
+        self._pgid = pgid
+        self._stdout = stdout
+        self._stderr = stderr
+        self._transports = transports
+        self._exit_future = exit_future
+        self._popen = popen
+        self._watch_task = None
+
+    @property
+    def adopted(self):
+        return self._popen is None
+
+    @property
+    def process(self):
+        return self._popen
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def returncode(self):
+        if not self._exit_future.done():
+            return None
+        return self._exit_future.result()
+
+    async def wait(self):
+        return await asyncio.shield(self._exit_future)
+
+    def kill(self):
+        if self._exit_future.done():
+            return
+        try:
+            os.killpg(self._pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def send_term(self):
+        if self._exit_future.done():
+            return
+        try:
+            os.killpg(self._pgid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    def release(self):
+        # Stop reading the output and watching the process, leaving it running
+        for t in self._transports:
+            t.close()
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        if not self._exit_future.done():
+            self._exit_future.set_result(None)
+
+    def close(self):
+        try:
+            self.kill()
+        except Exception:
+            pass
+
+
+if __name__ == "__main__":
+    run_drain(sys.argv[1])
@@ -0,0 +1,278 @@
+import array
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from . import subprocess_impl
+
+_default_preimport = ["RobotRaconteur", "numpy", "yaml"]
+
+
+def fork_server_supported():
+    return sys.platform.startswith("linux") and hasattr(socket, "SOCK_SEQPACKET") and hasattr(os, "fork")
+
+
+class PyriForkServer:
+    def __init__(self, loop, preimport=None, log=None, env=None):
+        self._loop = loop
+        self.preimport = preimport if preimport is not None else _default_preimport
+        self._log = log
+        self._env = env
+        self._sock = None
+        self._process = None
+        self._ready = None
+        self._next_id = 1
+        self._spawn_futures = dict()
+        self._exit_futures = dict()
+        self._early_exits = dict()
+        self._pump_tasks = []
+        self._closed = False
+
+    @property
+    def alive(self):
+        return self._sock is not None and not self._closed
+
+    async def start(self):
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._process = await subprocess_impl.create_subprocess_exec(sys.executable,
+                ["-m", "pyri.core.zygote", "--fd", str(child_sock.fileno()), "--preimport", ",".join(self.preimport)],
+                env=self._env, pass_fds=[child_sock.fileno()])
+        finally:
+            child_sock.close()
+        parent_sock.setblocking(False)
+        self._sock = parent_sock
+        self._ready = self._loop.create_future()
+        self._loop.add_reader(parent_sock.fileno(), self._on_readable)
+        self._pump_tasks = [self._loop.create_task(self._pump_output(self._process.stdout)),
+            self._loop.create_task(self._pump_output(self._process.stderr))]
+        await self._ready
+
+    async def _pump_output(self, stream):
+        while True:
+            data = await stream.read(65536)
+            if len(data) == 0:
+                break
+            if self._log is not None:
+                self._log.write(data)
+                await self._log.drain()
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+            if len(data) == 0:
+                self._lost()
+                return
+            try:
+                self._handle_msg(json.loads(data.decode("utf-8")))
+            except Exception:
+                traceback.print_exc()
+
+    def _handle_msg(self, msg):
+        op = msg["op"]
+        if op == "ready":
+            if not self._ready.done():
+                self._ready.set_result(True)
+        elif op == "spawned":
+            f = self._spawn_futures.pop(msg["id"], None)
+            if f is not None and not f.done():
+                f.set_result(msg["pid"])
+        elif op == "error":
+            f = self._spawn_futures.pop(msg["id"], None)
+            if f is not None and not f.done():
+                f.set_exception(OSError(msg["error"]))
+        elif op == "exited":
+            pid = msg["pid"]
+            f = self._exit_futures.pop(pid, None)
+            if f is None:
+                self._early_exits[pid] = msg["returncode"]
+            elif not f.done():
+                f.set_result(msg["returncode"])
+
+    def _lost(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        err = ConnectionError("Fork server exited")
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(err)
+        for f in self._spawn_futures.values():
+            if not f.done():
+                f.set_exception(err)
+        self._spawn_futures.clear()
+        # Exit notifications can no longer be received, watch the orphaned services directly
+        for pid, f in self._exit_futures.items():
+            asyncio.ensure_future(_watch_pid_exit(pid, f))
+        self._exit_futures.clear()
+        if not self._closed:
+            print("Warning: fork server exited unexpectedly")
+
+    async def create_subprocess(self, module_main, args, env=None, cwd=None, resources=None, fd_env=None):
+        # fd_env maps environment variable names to file descriptors passed to the service. The
+        # variables are set to the descriptor numbers in the service.
+        if not self.alive:
+            raise ConnectionError("Fork server not running")
+        req_id = self._next_id
+        self._next_id += 1
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        try:
+            msg = {"op": "spawn", "id": req_id, "module_main": module_main, "args": list(args),
+                "env": dict(env) if env is not None else None, "cwd": cwd, "resources": resources,
+                "fd_env": list(fd_env.keys()) if fd_env else []}
+            f = self._loop.create_future()
+            self._spawn_futures[req_id] = f
+            self._sock.sendmsg([json.dumps(msg).encode("utf-8")],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                    array.array("i", [stdout_w, stderr_w] + (list(fd_env.values()) if fd_env else [])))])
+        except:
+            self._spawn_futures.pop(req_id, None)
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        try:
+            pid = await f
+        except:
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+
+        exit_future = self._loop.create_future()
+        if pid in self._early_exits:
+            exit_future.set_result(self._early_exits.pop(pid))
+        else:
+            self._exit_futures[pid] = exit_future
+
+        stdout = await _open_read_pipe(self._loop, stdout_r)
+        stderr = await _open_read_pipe(self._loop, stderr_r)
+        return PyriForkedSubprocessImpl(pid, stdout, stderr, exit_future)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+        # Zygote exits when the socket is closed, services keep running until stopped
+        if self._process is not None:
+            try:
+                self._process.close()
+            except Exception:
+                traceback.print_exc()
+        for t in self._pump_tasks:
+            t.cancel()
+
+    async def wait_closed(self, timeout=5):
+        # Waits for the zygote to exit after close()
+        if self._process is None:
+            return
+        try:
+            await asyncio.wait_for(self._process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: fork server {self._process.pid} did not exit")
+        await asyncio.gather(*self._pump_tasks, return_exceptions=True)
+
+
+async def _open_read_pipe(loop, fd):
+    reader = asyncio.StreamReader(loop=loop)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), os.fdopen(fd, "rb", 0))
+    return reader
+
+
+async def _watch_pid_exit(pid, exit_future):
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            exit_future.set_result(None)
+            return
+        except OSError:
+            pidfd = None
+        if pidfd is not None:
+            loop = asyncio.get_running_loop()
+            readable = loop.create_future()
+            loop.add_reader(pidfd, lambda: readable.done() or readable.set_result(True))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            if not exit_future.done():
+                exit_future.set_result(None)
+            return
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        except PermissionError:
+            pass
+        await asyncio.sleep(0.5)
+    if not exit_future.done():
+        exit_future.set_result(None)
+
+
+class PyriForkedSubprocessImpl:
+    def __init__(self, pid, stdout, stderr, exit_future):
+        self._pid = pid
+        self._stdout = stdout
+        self._stderr = stderr
+        self._exit_future = exit_future
+
+    @property
+    def process(self):
+        return None
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def returncode(self):
+        if not self._exit_future.done():
+            return None
+        return self._exit_future.result()
+
+    async def wait(self):
+        return await asyncio.shield(self._exit_future)
+
+    def kill(self):
+        if self._exit_future.done():
+            return
+        os.kill(self._pid, signal.SIGKILL)
+
+    def send_term(self):
+        if self._exit_future.done():
+            return
+        pgid = os.getpgid(self._pid)
+        os.killpg(pgid, signal.SIGINT)
+
+    def close(self):
+        try:
+            self.kill()
+        except Exception:
+            pass
@@ -0,0 +1,82 @@
+import faulthandler
+import os
+import signal
+import sys
+import threading
+import time
+
+# Service side of the pyri-core hang detection watchdog. Services that enable
+# the watchdog with extra_params["heartbeat"] call heartbeat() regularly from
+# the loop that should be watched, for example:
+#
+#   from pyri.core import heartbeat
+#   while True:
+#       heartbeat.heartbeat()
+#       ...
+#
+# The heartbeat is written to a pipe inherited from pyri-core, or printed as a
+# marker line on stdout for services run by a launch agent. heartbeat() does
+# nothing when the service was started without the watchdog.
+
+heartbeat_fd_env = "PYRI_HEARTBEAT_FD"
+heartbeat_marker_env = "PYRI_HEARTBEAT_MARKER"
+stack_dump_file_env = "PYRI_STACK_DUMP_FILE"
+
+_fd = None
+_marker = None
+_initialized = False
+_stack_dump_file = None
+
+
+def _init():
+    global _fd, _marker, _initialized
+    _initialized = True
+    fd = os.environ.get(heartbeat_fd_env, None)
+    if fd is not None:
+        try:
+            _fd = int(fd)
+            os.set_blocking(_fd, False)
+        except (ValueError, OSError):
+            _fd = None
+    _marker = os.environ.get(heartbeat_marker_env, None)
+
+
+def heartbeat():
+    if not _initialized:
+        _init()
+    if _fd is not None:
+        try:
+            os.write(_fd, b".")
+        except BlockingIOError:
+            # pyri-core has not read the previous heartbeats yet
+            pass
+        except OSError:
+            pass
+    elif _marker is not None:
+        print(_marker, flush=True)
+
+
+def start_heartbeat_thread(interval=0.5):
+    # Heartbeats from a background thread only detect hangs of the whole
+    # interpreter, such as a thread stuck holding the GIL. Call heartbeat()
+    # from the watched loop to detect hangs of that loop.
+    def run():
+        while True:
+            heartbeat()
+            time.sleep(interval)
+    t = threading.Thread(target=run, name="pyri-heartbeat", daemon=True)
+    t.start()
+    return t
+
+
+def install_stack_dump_handler():
+    # Dump the stacks of all threads to the stack dump file when pyri-core sends SIGUSR2
+    global _stack_dump_file
+    fname = os.environ.get(stack_dump_file_env, None)
+    if fname is None or not hasattr(signal, "SIGUSR2"):
+        return
+    try:
+        _stack_dump_file = open(fname, "a")
+        faulthandler.register(signal.SIGUSR2, file=_stack_dump_file, all_threads=True)
+    except Exception as e:
+        print(f"Warning: could not install stack dump handler: {e}", file=sys.stderr)
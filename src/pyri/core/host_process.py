@@ -0,0 +1,274 @@
+import argparse
+import ctypes
+import importlib
+import io
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import traceback
+from .zygote import _recv_msg
+
+# Shared service host used by pyri-core for services with
+# extra_params["hosting"] = "shared". Several services run in this one
+# process, each in its own thread, so the interpreter and the modules the
+# services import are only loaded once. Requests are received as JSON
+# messages on a SOCK_SEQPACKET socket, the same way as the fork server, with
+# the stdout and stderr pipes of each service passed as file descriptors.
+#
+# Each service module is run with runpy in a new namespace. sys.argv,
+# sys.stdout and sys.stderr are replaced with objects that forward to the
+# service of the current thread, and threads started by a service belong to
+# that service. pyri.util.wait_exit.wait_exit() returns when pyri-core stops the
+# service, other code is interrupted with KeyboardInterrupt, like SIGINT
+# interrupts an isolated service.
+
+_send_lock = threading.Lock()
+_exit_lock = threading.Lock()
+_sock = None
+
+
+def _send(msg):
+    with _send_lock:
+        _sock.send(json.dumps(msg).encode("utf-8"))
+
+
+class _HostedService:
+    def __init__(self, hid, name, module_main, args, entry, stdout_fd, stderr_fd):
+        self.hid = hid
+        self.name = name
+        self.module_main = module_main
+        self.argv = [module_main] + list(args)
+        self.entry = entry
+        self.stdout = io.TextIOWrapper(io.FileIO(stdout_fd, "w"), encoding="utf-8", errors="replace",
+            line_buffering=True)
+        self.stderr = io.TextIOWrapper(io.FileIO(stderr_fd, "w"), encoding="utf-8", errors="replace",
+            line_buffering=True)
+        self.stop_event = threading.Event()
+        self.waiting = False
+        self.thread = None
+        self.exited = False
+
+
+def _current():
+    return getattr(threading.current_thread(), "_pyri_hosted_service", None)
+
+
+class _ServiceStream:
+    # sys.stdout and sys.stderr, writes go to the service of the current thread
+    def __init__(self, attr, host_stream):
+        self._attr = attr
+        self._host_stream = host_stream
+
+    def _stream(self):
+        s = _current()
+        if s is None or s.exited:
+            return self._host_stream
+        return getattr(s, self._attr)
+
+    def write(self, data):
+        return self._stream().write(data)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+
+class _ServiceArgv(list):
+    # sys.argv of the service of the current thread
+    def __getitem__(self, i):
+        s = _current()
+        return s.argv[i] if s is not None else list.__getitem__(self, i)
+
+    def __len__(self):
+        s = _current()
+        return len(s.argv) if s is not None else list.__len__(self)
+
+    def __iter__(self):
+        s = _current()
+        return iter(s.argv) if s is not None else list.__iter__(self)
+
+    def __contains__(self, item):
+        s = _current()
+        return item in s.argv if s is not None else list.__contains__(self, item)
+
+    def __eq__(self, other):
+        s = _current()
+        return s.argv == other if s is not None else list.__eq__(self, other)
+
+    def __repr__(self):
+        s = _current()
+        return repr(s.argv) if s is not None else list.__repr__(self)
+
+
+def _wait_exit():
+    # Replaces pyri.util.wait_exit.wait_exit for hosted services
+    s = _current()
+    if s is None:
+        return _original_wait_exit()
+    s.waiting = True
+    try:
+        s.stop_event.wait()
+    finally:
+        s.waiting = False
+
+
+_original_wait_exit = None
+
+
+def _install_hooks():
+    global _original_wait_exit
+    sys.stdout = _ServiceStream("stdout", sys.stdout)
+    sys.stderr = _ServiceStream("stderr", sys.stderr)
+    sys.argv = _ServiceArgv(sys.argv)
+
+    original_start = threading.Thread.start
+
+    def start(self):
+        # Threads started by a service belong to the service
+        if not hasattr(self, "_pyri_hosted_service"):
+            self._pyri_hosted_service = _current()
+        return original_start(self)
+    threading.Thread.start = start
+
+    try:
+        from pyri.util import wait_exit as wait_exit_module
+        _original_wait_exit = wait_exit_module.wait_exit
+        wait_exit_module.wait_exit = _wait_exit
+    except ImportError:
+        pass
+
+
+def _run(s):
+    returncode = 0
+    try:
+        if s.entry is not None:
+            module_name, func_name = s.entry.split(":")
+            getattr(importlib.import_module(module_name), func_name)()
+        else:
+            import runpy
+            runpy.run_module(s.module_main, run_name="__main__", alter_sys=False)
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except KeyboardInterrupt:
+        returncode = -signal.SIGINT
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    _exited(s, returncode)
+
+
+def _exited(s, returncode):
+    with _exit_lock:
+        if s.exited:
+            return
+        s.exited = True
+    for f in (s.stdout, s.stderr):
+        try:
+            f.close()
+        except Exception:
+            pass
+    _services.pop(s.hid, None)
+    _send({"op": "exited", "hid": s.hid, "returncode": returncode})
+
+
+def _interrupt(s):
+    if s.thread is None or not s.thread.is_alive():
+        return
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(s.thread.ident), ctypes.py_object(KeyboardInterrupt))
+
+
+_services = dict()
+_next_hid = 1
+
+
+def _spawn(msg, fds):
+    global _next_hid
+    hid = _next_hid
+    _next_hid += 1
+    s = _HostedService(hid, msg["name"], msg["module_main"], msg.get("args", []), msg.get("entry", None),
+        fds[0], fds[1])
+    for fd in fds[2:]:
+        os.close(fd)
+    _services[hid] = s
+    s.thread = threading.Thread(target=_run, args=(s,), name=f"pyri-hosted-{s.name}", daemon=True)
+    s.thread._pyri_hosted_service = s
+    s.thread.start()
+    return hid
+
+
+def _stop(s):
+    s.stop_event.set()
+    if not s.waiting:
+        _interrupt(s)
+
+
+def _kill(s):
+    # Threads can't be killed, the service is abandoned and its output closed
+    _stop(s)
+    _exited(s, -signal.SIGKILL)
+
+
+def serve(sock, stop_timeout=5):
+    global _sock
+    _sock = sock
+    _send({"op": "ready", "pid": os.getpid()})
+    while True:
+        try:
+            select.select([sock], [], [])
+        except InterruptedError:
+            continue
+        msg, fds = _recv_msg(sock)
+        if msg is None:
+            # Launcher has gone away, stop the services
+            for s in list(_services.values()):
+                _stop(s)
+            for s in list(_services.values()):
+                s.thread.join(stop_timeout)
+            return
+        op = msg["op"]
+        if op == "spawn":
+            try:
+                hid = _spawn(msg, fds)
+                _send({"op": "spawned", "id": msg["id"], "hid": hid})
+            except Exception as e:
+                for fd in fds:
+                    os.close(fd)
+                _send({"op": "error", "id": msg["id"], "error": str(e)})
+            continue
+        for fd in fds:
+            os.close(fd)
+        s = _services.get(msg.get("hid", None), None)
+        if s is None:
+            continue
+        if op == "stop":
+            _stop(s)
+        elif op == "kill":
+            _kill(s)
+
+
+def main():
+    parser = argparse.ArgumentParser("PyRI Core Service Host")
+    parser.add_argument("--fd", type=int, required=True)
+    parser_results = parser.parse_args()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _install_hooks()
+    serve(socket.socket(fileno=parser_results.fd))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import re
+import threading
+import time
+from typing import NamedTuple
+
+# Fixed-memory ring buffer of recent service output lines. Each line gets a
+# monotonic sequence number, so readers can follow the output by asking for
+# the lines after the last sequence number they have seen. Reads locate the
+# starting line with a binary search, so they only touch the lines they
+# return. The oldest lines are dropped when either the line count or the
+# byte size limit is reached.
+
+
+class LogLine(NamedTuple):
+    seq: int
+    timestamp: float
+    stream: str
+    text: str
+
+
+_levels = {"debug": 10, "info": 20, "warning": 30, "warn": 30, "error": 40, "critical": 50, "fatal": 50}
+_level_re = re.compile(r"\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b")
+# Only the start of the line is searched for the level
+_level_search_len = 128
+
+
+def line_level(text):
+    m = _level_re.search(text, 0, _level_search_len)
+    if m is None:
+        return None
+    return _levels[m.group(1).lower()]
+
+
+def _make_filter(stream, level, pattern):
+    if stream is None and level is None and pattern is None:
+        return None
+    if isinstance(level, str):
+        level = _levels[level.lower()]
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+
+    def f(l):
+        if stream is not None and l.stream != stream:
+            return False
+        if level is not None:
+            l_level = line_level(l.text)
+            if l_level is None or l_level < level:
+                return False
+        if pattern is not None and pattern.search(l.text) is None:
+            return False
+        return True
+    return f
+
+
+class _Chunk:
+    __slots__ = ("first_seq", "timestamp", "stream", "lines", "size")
+
+    def __init__(self, first_seq, timestamp, stream, lines, size):
+        self.first_seq = first_seq
+        self.timestamp = timestamp
+        self.stream = stream
+        self.lines = lines
+        self.size = size
+
+
+class PyriLogBuffer:
+    def __init__(self, max_lines=10000, max_bytes=1024*1024, clock=time.time):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self._clock = clock
+        # Lines are stored in the chunks they were read in, so appending a chunk
+        # doesn't need any per-line work
+        self._chunks = collections.deque()
+        self._next_seq = 1
+        self._line_count = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    @property
+    def first_seq(self):
+        with self._lock:
+            return self._chunks[0].first_seq if len(self._chunks) > 0 else self._next_seq
+
+    @property
+    def last_seq(self):
+        return self._next_seq - 1
+
+    def append(self, stream, lines, timestamp=None):
+        if len(lines) == 0:
+            return
+        if timestamp is None:
+            timestamp = self._clock()
+        with self._lock:
+            first_seq = self._next_seq
+            self._next_seq += len(lines)
+            if len(lines) > self.max_lines:
+                first_seq += len(lines) - self.max_lines
+                lines = lines[-self.max_lines:]
+            c = _Chunk(first_seq, timestamp, stream, lines, sum(map(len, lines)))
+            self._chunks.append(c)
+            self._line_count += len(lines)
+            self._bytes += c.size
+            # Drop the oldest chunks, trimming the oldest chunk if only some of its lines have to go
+            while len(self._chunks) > 0 and (self._line_count > self.max_lines or self._bytes > self.max_bytes):
+                old = self._chunks[0]
+                excess_lines = self._line_count - self.max_lines
+                excess_bytes = self._bytes - self.max_bytes
+                if excess_lines >= len(old.lines) or excess_bytes > old.size - len(old.lines[-1]):
+                    self._chunks.popleft()
+                    self._line_count -= len(old.lines)
+                    self._bytes -= old.size
+                    continue
+                n = max(excess_lines, 0)
+                dropped = sum(map(len, old.lines[:n]))
+                while self._bytes - dropped > self.max_bytes:
+                    dropped += len(old.lines[n])
+                    n += 1
+                old.lines = old.lines[n:]
+                old.first_seq += n
+                old.size -= dropped
+                self._line_count -= n
+                self._bytes -= dropped
+            waiters = self._waiters
+            self._waiters = []
+        for loop, f in waiters:
+            loop.call_soon_threadsafe(lambda f=f: f.done() or f.set_result(None))
+
+    def _find_chunk(self, seq):
+        # Index of the chunk containing seq, or of the first chunk after seq
+        chunks = self._chunks
+        lo, hi = 0, len(chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            c = chunks[mid]
+            if c.first_seq + len(c.lines) <= seq:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def tail(self, n=100, stream=None, level=None, pattern=None):
+        # Last n matching lines, oldest first
+        f = _make_filter(stream, level, pattern)
+        ret = []
+        with self._lock:
+            for c in reversed(self._chunks):
+                if stream is not None and c.stream != stream:
+                    continue
+                for i in range(len(c.lines) - 1, -1, -1):
+                    l = LogLine(c.first_seq + i, c.timestamp, c.stream, c.lines[i])
+                    if f is None or f(l):
+                        ret.append(l)
+                        if len(ret) >= n:
+                            break
+                if len(ret) >= n:
+                    break
+        ret.reverse()
+        return ret
+
+    def since(self, seq=0, limit=None, stream=None, level=None, pattern=None):
+        # Matching lines with sequence number greater than seq, oldest first. Lines that
+        # have already been dropped are skipped, check the sequence numbers for gaps.
+        f = _make_filter(stream, level, pattern)
+        ret = []
+        with self._lock:
+            chunks = self._chunks
+            for ci in range(self._find_chunk(seq + 1), len(chunks)):
+                c = chunks[ci]
+                if stream is not None and c.stream != stream:
+                    continue
+                for i in range(max(seq + 1 - c.first_seq, 0), len(c.lines)):
+                    l = LogLine(c.first_seq + i, c.timestamp, c.stream, c.lines[i])
+                    if f is None or f(l):
+                        ret.append(l)
+                        if limit is not None and len(ret) >= limit:
+                            return ret
+        return ret
+
+    async def wait_new(self, seq, timeout=None):
+        # Wait until there are lines after seq
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._next_seq - 1 > seq:
+                return
+            f = loop.create_future()
+            self._waiters.append((loop, f))
+        try:
+            await asyncio.wait_for(f, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def follow(self, seq=None, stream=None, level=None, pattern=None, batch=1000):
+        # Async generator of new lines. Starts after seq, or with new lines if seq is None
+        if seq is None:
+            seq = self.last_seq
+        while True:
+            await self.wait_new(seq)
+            last = self.last_seq
+            while seq < last:
+                lines = self.since(seq, batch, stream, level, pattern)
+                if len(lines) == 0:
+                    break
+                for l in lines:
+                    yield l
+                seq = lines[-1].seq
+            seq = max(seq, last)
@@ -0,0 +1,175 @@
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+from . import structured_logs
+
+# Retention and compaction of the per-run log directories created under the
+# pyri-project log directory. Runs older than a number of days, or the oldest
+# runs when the total size is over a limit, are deleted. Older runs are
+# compacted by compressing the text logs and vacuuming the structured log
+# database. A running pyri-core holds a lock on a file in its run directory,
+# locked runs are never removed or compacted.
+
+_run_dir_re = re.compile(r"^pyri-core-(\d{4}-\d{2}-\d{2}--\d{2}-\d{2}-\d{2})$")
+_run_dir_time_format = "%Y-%m-%d--%H-%M-%S"
+_compacted_marker = ".compacted"
+_lock_fname = ".lock"
+
+
+def _try_lock(f):
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def lock_run(path):
+    # Called by pyri-core for its own run directory. The lock is held until the returned file is
+    # closed, or the process exits.
+    f = open(Path(path).joinpath(_lock_fname), "a+b")
+    if not _try_lock(f):
+        f.close()
+        raise RuntimeError(f"Log directory {path} is in use by another pyri-core")
+    return f
+
+
+def run_locked(path):
+    # True while the pyri-core writing to the run directory is running
+    fname = Path(path).joinpath(_lock_fname)
+    if not fname.is_file():
+        return False
+    try:
+        with open(fname, "a+b") as f:
+            # The lock is released when the file is closed
+            return not _try_lock(f)
+    except OSError:
+        return True
+
+
+def run_start_time(path):
+    m = _run_dir_re.match(Path(path).name)
+    if m is None:
+        return None
+    return datetime.strptime(m.group(1), _run_dir_time_format)
+
+
+def list_runs(log_root):
+    # Run directories, oldest first
+    log_root = Path(log_root)
+    if not log_root.is_dir():
+        return []
+    runs = []
+    for p in log_root.iterdir():
+        t = run_start_time(p)
+        if t is not None and p.is_dir():
+            runs.append((t, p))
+    runs.sort()
+    return [p for _, p in runs]
+
+
+def run_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return size
+
+
+def prune_runs(log_root, max_age_days=None, max_total_mb=None, exclude=(), now=None):
+    # Returns the removed run directories
+    if now is None:
+        now = datetime.now()
+    exclude = set(Path(p).resolve() for p in exclude)
+    exclude.update(p.resolve() for p in list_runs(log_root) if run_locked(p))
+    runs = [p for p in list_runs(log_root) if p.resolve() not in exclude]
+    removed = []
+    if max_age_days is not None:
+        for p in list(runs):
+            if (now - run_start_time(p)).total_seconds() > max_age_days * 86400:
+                removed.append(p)
+                runs.remove(p)
+    if max_total_mb is not None:
+        sizes = [(p, run_size(p)) for p in runs]
+        total = sum(s for _, s in sizes) + sum(run_size(p) for p in exclude if p.is_dir())
+        for p, s in sizes:
+            if total <= max_total_mb * 1024 * 1024:
+                break
+            removed.append(p)
+            total -= s
+    for p in removed:
+        try:
+            shutil.rmtree(p)
+        except Exception:
+            traceback.print_exc()
+    return removed
+
+
+def _compress_file(fname):
+    tmp_fname = f"{fname}.gz.tmp"
+    with open(fname, "rb") as f_in, gzip.open(tmp_fname, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(tmp_fname, f"{fname}.gz")
+    os.remove(fname)
+
+
+def compact_run(path):
+    path = Path(path)
+    for f in path.iterdir():
+        if f.is_file() and (f.name.endswith(".txt") or re.search(r"\.txt\.\d+$", f.name)):
+            _compress_file(f)
+    db = path.joinpath(structured_logs.db_fname)
+    if db.is_file():
+        conn = sqlite3.connect(str(db))
+        try:
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+    path.joinpath(_compacted_marker).touch()
+
+
+def compact_runs(log_root, older_than_days, exclude=(), now=None):
+    # Returns the compacted run directories
+    if now is None:
+        now = datetime.now()
+    exclude = set(Path(p).resolve() for p in exclude)
+    compacted = []
+    for p in list_runs(log_root):
+        if p.resolve() in exclude or p.joinpath(_compacted_marker).exists() or run_locked(p):
+            continue
+        if (now - run_start_time(p)).total_seconds() <= older_than_days * 86400:
+            continue
+        try:
+            compact_run(p)
+            compacted.append(p)
+        except Exception:
+            traceback.print_exc()
+    return compacted
+
+
+def apply_retention(log_root, max_age_days=None, max_total_mb=None, compact_days=None, exclude=()):
+    t1 = time.perf_counter()
+    removed = prune_runs(log_root, max_age_days, max_total_mb, exclude)
+    compacted = []
+    if compact_days is not None:
+        compacted = compact_runs(log_root, compact_days, exclude)
+    if len(removed) > 0 or len(compacted) > 0:
+        print(f"Log retention removed {len(removed)} and compacted {len(compacted)} old runs "
+            f"in {time.perf_counter() - t1:.2f} s")
+    return removed, compacted
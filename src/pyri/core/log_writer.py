@@ -0,0 +1,278 @@
+import asyncio
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+from .loop_stats import LatencyHistogram
+
+# Service output is read from the pipes in chunks on the event loop thread and
+# handed to a single writer thread. The writer thread batches the chunks and
+# flushes when flush_interval has elapsed or flush_bytes are pending, so the
+# event loop never blocks on disk I/O. The time chunks wait in the queue and
+# the duration of writes and flushes are recorded for the loop statistics.
+#
+# The queue is bounded by max_queue_bytes. Output readers call drain() after
+# each write, so when the disk can't keep up the pipes are no longer read and
+# the services block on their writes, instead of the core buffering their
+# output without limit. Rotated files are compressed by a separate thread, so
+# writes to the other logs continue while a large file is compressed.
+
+_WRITE = 0
+_CLOSE = 1
+_STOP = 2
+
+
+class PyriLogFile:
+    def __init__(self, writer, fname, max_bytes, backup_count, compress):
+        self._writer = writer
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._f = None
+        self._size = 0
+        self._pending = 0
+        self._first_pending_time = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._writer._put(_WRITE, self, data)
+
+    def close(self):
+        self._writer._put(_CLOSE, self, None)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    # The following are only called from the writer thread
+
+    def _open(self):
+        self._f = open(self.fname, "wb", buffering=65536)
+        self._size = 0
+
+    def _do_write(self, data):
+        if self._f is None:
+            self._open()
+        self._f.write(data)
+        self._size += len(data)
+        self._pending += len(data)
+        if self._first_pending_time is None:
+            self._first_pending_time = time.monotonic()
+        if self.max_bytes > 0 and self._size >= self.max_bytes:
+            self._rotate()
+
+    def _do_flush(self):
+        if self._f is not None and self._pending > 0:
+            self._f.flush()
+        self._pending = 0
+        self._first_pending_time = None
+
+    def _do_close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._pending = 0
+        self._first_pending_time = None
+
+    def _backup_name(self, i):
+        if self.compress:
+            return f"{self.fname}.{i}.gz"
+        return f"{self.fname}.{i}"
+
+    def _rotate(self):
+        self._do_close()
+        if self.backup_count > 0:
+            if self.compress:
+                # The compress thread shifts the backups once the file is compressed
+                self._writer._rotated_count += 1
+                rotated = f"{self.fname}.rotated-{self._writer._rotated_count}"
+                os.replace(self.fname, rotated)
+                self._writer._compress(self, rotated)
+            else:
+                self._shift_backups()
+                os.replace(self.fname, self._backup_name(1))
+        self._open()
+
+    def _shift_backups(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self._backup_name(i)
+            if os.path.exists(src):
+                os.replace(src, self._backup_name(i + 1))
+
+
+def _compress_file(src, dest):
+    tmp = dest + ".tmp"
+    with open(src, "rb") as f_in, gzip.open(tmp, "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(tmp, dest)
+    os.remove(src)
+
+
+class PyriLogWriter:
+    def __init__(self, flush_interval=0.5, flush_bytes=65536, max_bytes=0, backup_count=5, compress=False,
+            max_queue_bytes=16*1024*1024):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.max_queue_bytes = max_queue_bytes
+        self._queue = queue.SimpleQueue()
+        self._queued_bytes = 0
+        self._queued_lock = threading.Lock()
+        self._drain_waiters = []
+        self._files = set()
+        self._closed = False
+        self._rotated_count = 0
+        self._compress_queue = None
+        self._compress_thread = None
+        self.queue_latency = LatencyHistogram()
+        self.write_latency = LatencyHistogram()
+        self.flush_latency = LatencyHistogram()
+        self._thread = threading.Thread(target=self._run, name="pyri-log-writer", daemon=True)
+        self._thread.start()
+
+    def open(self, fname):
+        f = PyriLogFile(self, fname, self.max_bytes, self.backup_count, self.compress)
+        # Create the file even if the service never writes to it
+        f.write(b"")
+        return f
+
+    def _put(self, op, log_file, data):
+        if data:
+            with self._queued_lock:
+                self._queued_bytes += len(data)
+        self._queue.put((op, log_file, data, time.monotonic()))
+
+    async def drain(self):
+        # Waits until the queued output is below max_queue_bytes
+        if self._queued_bytes < self.max_queue_bytes or self._closed:
+            return
+        loop = asyncio.get_running_loop()
+        f = loop.create_future()
+        with self._queued_lock:
+            if self._queued_bytes < self.max_queue_bytes:
+                return
+            self._drain_waiters.append((loop, f))
+        await f
+
+    def _written(self, count):
+        # Called from the writer thread, readers resume when the queue is half empty
+        with self._queued_lock:
+            self._queued_bytes -= count
+            if self._queued_bytes > self.max_queue_bytes // 2 and not self._closed:
+                return
+            waiters = self._drain_waiters
+            self._drain_waiters = []
+        for loop, f in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_drained, f)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+    def _compress(self, log_file, rotated):
+        if self._compress_thread is None:
+            self._compress_queue = queue.SimpleQueue()
+            self._compress_thread = threading.Thread(target=self._run_compress, name="pyri-log-compress", daemon=True)
+            self._compress_thread.start()
+        self._compress_queue.put((log_file, rotated))
+
+    def _run_compress(self):
+        while True:
+            log_file, rotated = self._compress_queue.get()
+            if log_file is None:
+                break
+            try:
+                log_file._shift_backups()
+                _compress_file(rotated, log_file._backup_name(1))
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_bytes": self._queued_bytes,
+            "queue_latency": self.queue_latency.to_json(),
+            "write": self.write_latency.to_json(),
+            "flush": self.flush_latency.to_json()
+        }
+
+    def close(self, timeout=5):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_STOP, None, None, time.monotonic()))
+        self._thread.join(timeout)
+        self._written(0)
+        if self._compress_thread is not None:
+            self._compress_queue.put((None, None))
+            self._compress_thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            timeout = None
+            now = time.monotonic()
+            for f in self._files:
+                if f._first_pending_time is not None:
+                    t = f._first_pending_time + self.flush_interval - now
+                    timeout = t if timeout is None else min(timeout, t)
+            items = []
+            try:
+                items.append(self._queue.get(timeout=max(timeout, 0) if timeout is not None else None))
+                # Drain everything queued so far in one batch
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for op, f, data, t_put in items:
+                try:
+                    if op == _WRITE:
+                        self._files.add(f)
+                        t1 = time.monotonic()
+                        self.queue_latency.add(t1 - t_put)
+                        try:
+                            f._do_write(data)
+                        finally:
+                            self._written(len(data))
+                        t2 = time.monotonic()
+                        self.write_latency.add(t2 - t1)
+                        if f._pending >= self.flush_bytes:
+                            f._do_flush()
+                            self.flush_latency.add(time.monotonic() - t2)
+                    elif op == _CLOSE:
+                        f._do_flush()
+                        f._do_close()
+                        self._files.discard(f)
+                    elif op == _STOP:
+                        stop = True
+                except Exception:
+                    traceback.print_exc()
+
+            now = time.monotonic()
+            for f in list(self._files):
+                if f._first_pending_time is not None and (stop or now - f._first_pending_time >= self.flush_interval):
+                    try:
+                        t1 = time.monotonic()
+                        f._do_flush()
+                        self.flush_latency.add(time.monotonic() - t1)
+                    except Exception:
+                        traceback.print_exc()
+
+        for f in list(self._files):
+            try:
+                f._do_close()
+            except Exception:
+                traceback.print_exc()
+        self._files.clear()
+
+
+def _set_drained(f):
+    if not f.done():
+        f.set_result(None)
@@ -0,0 +1,135 @@
+import argparse
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from . import structured_logs
+from . import log_retention
+
+# "pyri-core logs" subcommand. Queries the structured logs of previous and
+# running pyri-core runs, lists runs, and applies log retention:
+#
+#   pyri-core logs --since 14:00 --until 14:05 --service robot
+#   pyri-core logs --runs
+#   pyri-core logs --prune --retention-days 30 --compact-days 2
+
+
+def default_log_root():
+    import appdirs
+    return Path(appdirs.user_log_dir(appname="pyri-project"))
+
+
+_relative_re = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+_relative_units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(s, now=None):
+    # ISO date and time, a time today like "14:02", or a time ago like "10m"
+    if now is None:
+        now = datetime.now()
+    m = _relative_re.match(s)
+    if m is not None:
+        return (now - timedelta(seconds=float(m.group(1)) * _relative_units[m.group(2)])).timestamp()
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        pass
+    for fmt in ("%H:%M", "%H:%M:%S", "%H:%M:%S.%f"):
+        try:
+            t = datetime.strptime(s, fmt).time()
+            return datetime.combine(now.date(), t).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid time: {s}")
+
+
+def _format_line(row):
+    ts, service, stream, text = row
+    t = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    return f"{t} {service} {stream}: {text}"
+
+
+def _runs_in_range(log_root, since, until):
+    # Structured log databases of the runs that may have lines in the range
+    ret = []
+    for p in log_retention.list_runs(log_root):
+        db = p.joinpath(structured_logs.db_fname)
+        if not db.is_file():
+            continue
+        try:
+            meta = structured_logs.read_meta(db)
+            start_time = float(meta["start_time"])
+            end_time = float(meta["end_time"])
+        except Exception:
+            start_time, end_time = None, None
+        if until is not None and start_time is not None and start_time > until:
+            continue
+        # The end time of a running pyri-core is only updated when lines are written
+        if since is not None and end_time is not None and end_time < since and not log_retention.run_locked(p):
+            continue
+        ret.append(db)
+    return ret
+
+
+def _print_runs(log_root):
+    for p in log_retention.list_runs(log_root):
+        size = log_retention.run_size(p)
+        structured = p.joinpath(structured_logs.db_fname).is_file()
+        running = log_retention.run_locked(p)
+        print(f"{p.name}  {size / 1048576:10.1f} MB{'  structured' if structured else ''}{'  running' if running else ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("pyri-core logs", description="Query structured logs of pyri-core runs")
+    parser.add_argument("--log-root", type=str, default=None, help="Directory containing the run log directories")
+    parser.add_argument("--since", type=str, default=None, help="Start time, for example \"2026-10-18 14:00\", \"14:00\" or \"10m\"")
+    parser.add_argument("--until", type=str, default=None, help="End time, same formats as --since")
+    parser.add_argument("--service", type=str, action='append', default=None, help="Only show this service, can be repeated")
+    parser.add_argument("--stream", type=str, action='append', default=None, help="Only show this stream, \"stdout\", \"stderr\" or \"pyri-core\"")
+    parser.add_argument("--grep", type=str, default=None, help="Only show lines matching this regular expression")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of lines to show")
+    parser.add_argument("--runs", action='store_true', default=False, help="List the runs instead of showing log lines")
+    parser.add_argument("--prune", action='store_true', default=False, help="Apply the retention options and exit")
+    parser.add_argument("--retention-days", type=float, default=None, help="With --prune, remove runs older than this many days")
+    parser.add_argument("--retention-size", type=float, default=None, help="With --prune, remove the oldest runs until the total size is below this many MB")
+    parser.add_argument("--compact-days", type=float, default=None, help="With --prune, compress the logs of runs older than this many days")
+    args = parser.parse_args(argv)
+
+    log_root = Path(args.log_root) if args.log_root is not None else default_log_root()
+
+    if args.runs:
+        _print_runs(log_root)
+        return 0
+
+    if args.prune:
+        removed, compacted = log_retention.apply_retention(log_root, args.retention_days, args.retention_size,
+            args.compact_days)
+        for p in removed:
+            print(f"Removed {p.name}")
+        for p in compacted:
+            print(f"Compacted {p.name}")
+        return 0
+
+    try:
+        since = parse_time(args.since) if args.since is not None else None
+        until = parse_time(args.until) if args.until is not None else None
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    dbs = _runs_in_range(log_root, since, until)
+    if len(dbs) == 0:
+        print("No structured logs found, run pyri-core with --structured-logs to record them", file=sys.stderr)
+        return 1
+    remaining = args.limit
+    try:
+        for db in dbs:
+            for row in structured_logs.query_logs(db, since, until, args.service, args.stream, args.grep, remaining):
+                print(_format_line(row))
+                if remaining is not None:
+                    remaining -= 1
+            if remaining is not None and remaining <= 0:
+                break
+    except BrokenPipeError:
+        pass
+    return 0
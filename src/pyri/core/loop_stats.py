@@ -0,0 +1,284 @@
+import asyncio
+import bisect
+import collections
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Health counters of the launcher event loop, cheap enough to leave enabled:
+#
+# * Event loop lag: a task sleeps for a short interval and records how late
+#   it wakes up, in a histogram.
+# * Slow callbacks: a monitor thread checks that the lag task keeps running.
+#   When the loop is blocked for more than slow_threshold seconds, the stack
+#   of the loop thread is captured to find the callback or coroutine that is
+#   blocking it. Nothing is done on the loop thread while it runs normally.
+# * Service output: bytes and lines read from each service, and the pipe
+#   backlog, data the service has written that has not been processed yet.
+# * Log writer: time from queueing a chunk until it is written, and the
+#   duration of writes and flushes, see log_writer.py.
+#
+# The counters are written to loop_stats.json in the log directory by the
+# monitor thread, so they are still written while the event loop is blocked.
+# They are updated on the loop thread and read from the monitor thread and
+# the SIGUSR1 handler, under _lock. The lock is reentrant because the signal
+# handler runs on the main thread, which may be the loop thread holding it.
+
+_lag_interval = 0.1
+_warn_interval = 60
+
+
+class LatencyHistogram:
+    bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds_ms, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile_ms(self, p):
+        # Upper bound of the bucket containing the percentile
+        if self.count == 0:
+            return 0.0
+        target = p * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= target:
+                return min(float(self.bounds_ms[i]), self.max * 1000) if i < len(self.bounds_ms) else self.max * 1000
+        return self.max * 1000
+
+    def to_json(self):
+        buckets = {f"<={b}ms": c for b, c in zip(self.bounds_ms, self.counts)}
+        buckets[f">{self.bounds_ms[-1]}ms"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count > 0 else 0.0,
+            "p50_ms": self.percentile_ms(0.5),
+            "p99_ms": self.percentile_ms(0.99),
+            "max_ms": self.max * 1000,
+            "buckets": buckets
+        }
+
+
+def stream_backlog(stream):
+    # Bytes buffered in the StreamReader plus bytes waiting in the pipe
+    if stream is None:
+        return 0
+    backlog = len(getattr(stream, "_buffer", b""))
+    transport = getattr(stream, "_transport", None)
+    pipe = transport.get_extra_info("pipe") if transport is not None else None
+    if pipe is not None and sys.platform != "win32":
+        import fcntl
+        import termios
+        try:
+            backlog += int.from_bytes(fcntl.ioctl(pipe.fileno(), termios.FIONREAD, b"\0\0\0\0"), sys.byteorder)
+        except (OSError, ValueError):
+            pass
+    return backlog
+
+
+def describe_frame(frame):
+    # Name of the task coroutine or callback running in frame, and the innermost location
+    location = f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}"
+    coro = None
+    callback = None
+    f = frame
+    while f is not None:
+        if f.f_code.co_flags & inspect.CO_COROUTINE:
+            coro = f
+        if f.f_code.co_name == "_run" and f.f_code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+            break
+        callback = f
+        f = f.f_back
+    f = coro if coro is not None else callback
+    if f is None:
+        return "unknown", location
+    code = f.f_code
+    return f"{f.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}", location
+
+
+class PyriLoopStats:
+    def __init__(self, core, fname=None, write_interval=60, slow_threshold=0.1, slow_history=50):
+        self._core = core
+        self.fname = fname
+        self.write_interval = write_interval
+        self.slow_threshold = slow_threshold
+        self.lag = LatencyHistogram()
+        self.slow_callbacks = dict()
+        self.recent_slow = collections.deque(maxlen=slow_history)
+        self._service_output = dict()
+        self._rate_base = (time.monotonic(), dict())
+        self._lock = threading.RLock()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._expected = None
+        self._stall = None
+        self._last_warning = dict()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self, loop):
+        # Called on the event loop thread
+        if self._task is not None:
+            return
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._started = time.time()
+        self._expected = time.monotonic() + _lag_interval
+        self._task = loop.create_task(self._run())
+        self._thread = threading.Thread(target=self._monitor, name="pyri-loop-stats", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._stop_event.set()
+
+    async def _run(self):
+        while True:
+            t1 = time.monotonic()
+            self._expected = t1 + _lag_interval
+            await asyncio.sleep(_lag_interval)
+            now = time.monotonic()
+            lag = max(now - self._expected, 0)
+            with self._lock:
+                self.lag.add(lag)
+            stall = self._stall
+            if stall is not None:
+                self._stall = None
+                self._finish_stall(stall, lag)
+
+    def _finish_stall(self, stall, duration):
+        name = stall["name"]
+        stall["duration_ms"] = duration * 1000
+        with self._lock:
+            s = self.slow_callbacks.get(name, None)
+            if s is None:
+                s = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "location": stall["location"]}
+                self.slow_callbacks[name] = s
+            s["count"] += 1
+            s["total_ms"] += duration * 1000
+            if duration * 1000 > s["max_ms"]:
+                s["max_ms"] = duration * 1000
+                s["location"] = stall["location"]
+            self.recent_slow.append(stall)
+        self._core.trace.instant("pyri-core", "slow callback", {"callback": name, "duration_ms": duration * 1000})
+        now = time.monotonic()
+        if now - self._last_warning.get(name, -_warn_interval) >= _warn_interval:
+            self._last_warning[name] = now
+            print(f"Warning: event loop blocked for {duration:.3f} s by {name} at {stall['location']}")
+
+    def _monitor(self):
+        check_interval = max(self.slow_threshold / 2, 0.01)
+        next_write = time.monotonic() + self.write_interval if self.write_interval > 0 else None
+        while not self._stop_event.wait(check_interval):
+            now = time.monotonic()
+            expected = self._expected
+            if self._stall is None and now - expected > self.slow_threshold:
+                frame = sys._current_frames().get(self._loop_thread_id, None)
+                if frame is not None:
+                    name, location = describe_frame(frame)
+                    del frame
+                    # The loop may have resumed while the stack was captured
+                    if self._expected == expected:
+                        self._stall = {"time": time.time(), "name": name, "location": location}
+            if next_write is not None and now >= next_write:
+                next_write = now + self.write_interval
+                self.write()
+
+    def record_output(self, name, stream_name, data):
+        # Called by the output pumps for each chunk read from a service
+        lines = data.count(b"\n")
+        with self._lock:
+            c = self._service_output.get(name, None)
+            if c is None:
+                c = {"stdout_bytes": 0, "stdout_lines": 0, "stderr_bytes": 0, "stderr_lines": 0}
+                self._service_output[name] = c
+            c[stream_name + "_bytes"] += len(data)
+            c[stream_name + "_lines"] += lines
+
+    def snapshot(self, update_rates=False):
+        # Safe to call from any thread
+        backlog = self._core.service_output_backlog()
+        log_writer_stats = self._core.log_writer.stats()
+        with self._lock:
+            now = time.monotonic()
+            base_time, base = self._rate_base
+            elapsed = now - base_time
+            services = dict()
+            for name, c in self._service_output.items():
+                b = base.get(name, dict())
+                s = dict(c)
+                for k, v in c.items():
+                    s[k + "_per_s"] = (v - b.get(k, 0)) / elapsed if elapsed > 0 else 0.0
+                s["backlog_bytes"] = backlog.get(name, 0)
+                services[name] = s
+            if update_rates:
+                self._rate_base = (now, {n: dict(c) for n, c in self._service_output.items()})
+            stall = self._stall
+            ret = {
+                "time": time.time(),
+                "started": self._started,
+                "loop_lag": self.lag.to_json(),
+                "loop_blocked": {"name": stall["name"], "location": stall["location"],
+                    "blocked_s": now - self._expected} if stall is not None else None,
+                "slow_callback_threshold_ms": self.slow_threshold * 1000,
+                "slow_callbacks": {n: dict(s) for n, s in self.slow_callbacks.items()},
+                "recent_slow_callbacks": list(self.recent_slow),
+                "services": services,
+                "log_writer": log_writer_stats
+            }
+        return ret
+
+    def write(self):
+        if self.fname is None:
+            return
+        try:
+            stats = self.snapshot(update_rates=True)
+            tmp_fname = str(self.fname) + ".tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(stats, f, indent=2)
+            os.replace(tmp_fname, self.fname)
+        except Exception:
+            traceback.print_exc()
+
+    def format_summary(self, stats=None):
+        if stats is None:
+            stats = self.snapshot()
+        lag = stats["loop_lag"]
+        w = stats["log_writer"]
+        lines = [f"Event loop lag: mean {lag['mean_ms']:.1f} ms, p99 {lag['p99_ms']:.0f} ms, max {lag['max_ms']:.1f} ms "
+            f"({lag['count']} samples)"]
+        if stats["loop_blocked"] is not None:
+            b = stats["loop_blocked"]
+            lines.append(f"Event loop blocked for {b['blocked_s']:.3f} s by {b['name']} at {b['location']}")
+        for name, s in sorted(stats["slow_callbacks"].items(), key=lambda x: x[1]["total_ms"], reverse=True)[:10]:
+            lines.append(f"Slow callback {name}: {s['count']} times, max {s['max_ms']:.0f} ms, at {s['location']}")
+        for name, s in sorted(stats["services"].items()):
+            lines.append(f"Service {name}: stdout {s['stdout_bytes_per_s'] / 1024:.1f} KB/s "
+                f"{s['stdout_lines_per_s']:.0f} lines/s, stderr {s['stderr_bytes_per_s'] / 1024:.1f} KB/s "
+                f"{s['stderr_lines_per_s']:.0f} lines/s, backlog {s['backlog_bytes']} bytes")
+        lines.append(f"Log writer: queue {w['queue_depth']}, queue latency p99 {w['queue_latency']['p99_ms']:.0f} ms, "
+            f"write max {w['write']['max_ms']:.1f} ms, flush max {w['flush']['max_ms']:.1f} ms")
+        return "\n".join(lines)
+
+    def close(self):
+        self.stop()
+        if self._thread is not None:
+            self._thread.join(1)
+        self.write()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import sys
+import traceback
+from pathlib import Path
+
+# Caches the metadata of the installed ServiceNodeLaunch plugins so pyri-core
+# does not need to import every plugin module on startup. The cache is keyed
+# on the installed distribution versions, and is rebuilt when any of them
+# change, or when the module file of a plugin entry point is modified. The
+# module files are checked because editable installs don't change their
+# dist-info directory when the plugin source is edited. Plugin modules are imported on first access to a field that is not
+# cached, such as prepare_service_args.
+
+_entry_point_group = "pyri.plugins.service_node_launch"
+_cache_version = 2
+
+_cached_fields = ["name", "plugin_name", "module_main", "depends", "depends_backoff", "restart",
+    "restart_backoff", "default_devices"]
+
+
+def _entry_points():
+    import importlib.metadata as importlib_metadata
+    eps = importlib_metadata.entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=_entry_point_group))
+    return list(eps.get(_entry_point_group, []))
+
+
+def distributions_key():
+    # The dist-info directory names contain the distribution name and version.
+    # Listing them is much faster than reading the metadata of every distribution.
+    dists = set()
+    for p in sys.path:
+        try:
+            with os.scandir(p or ".") as it:
+                for e in it:
+                    if e.name.endswith((".dist-info", ".egg-info", ".egg-link", ".pth")):
+                        dists.add(f"{p}/{e.name}:{e.stat().st_mtime_ns}")
+        except OSError:
+            pass
+    h = hashlib.sha256()
+    h.update(f"{_cache_version}\n{sys.executable}\n{sys.version}\n".encode("utf-8"))
+    for d in sorted(dists):
+        h.update(d.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _module_source(module_name):
+    # Returns the file and mtime of an imported module, or None for modules without a file
+    f = getattr(sys.modules.get(module_name, None), "__file__", None)
+    if f is None:
+        return None
+    try:
+        return [f, os.stat(f).st_mtime_ns]
+    except OSError:
+        return None
+
+
+def _sources_unchanged(plugins):
+    for p in plugins:
+        source = p.get("source", None)
+        if source is None:
+            continue
+        try:
+            if os.stat(source[0]).st_mtime_ns != source[1]:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _load_factory(entry_point_value):
+    import importlib.metadata as importlib_metadata
+    ep = importlib_metadata.EntryPoint(name="", value=entry_point_value, group=_entry_point_group)
+    return ep.load()()
+
+
+def _is_default_callable(f, default_name):
+    return f is None or (getattr(f, "__name__", None) == default_name
+        and getattr(f, "__module__", None) == "pyri.plugins.service_node_launch")
+
+
+def _is_json_serializable(v):
+    try:
+        json.dumps(v)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+class _PluginLoader:
+    def __init__(self, entry_point_value, plugin_name):
+        self.entry_point_value = entry_point_value
+        self.plugin_name = plugin_name
+        self._launches = None
+
+    def get_launch(self, name):
+        if self._launches is None:
+            factory = _load_factory(self.entry_point_value)
+            self._launches = {l.name: l for l in factory.get_service_node_launches()}
+        return self._launches[name]
+
+
+class CachedServiceNodeLaunch:
+    def __init__(self, metadata, loader):
+        self._metadata = metadata
+        self._loader = loader
+        self._resolved = None
+
+    def resolve(self):
+        if self._resolved is None:
+            self._resolved = self._loader.get_launch(self._metadata["name"])
+        return self._resolved
+
+    @property
+    def add_arg_parser_options(self):
+        if not self._metadata["has_add_arg_parser_options"]:
+            return None
+        return self.resolve().add_arg_parser_options
+
+    @property
+    def prepare_service_args(self):
+        if not self._metadata["has_prepare_service_args"]:
+            return _no_service_args
+        return self.resolve().prepare_service_args
+
+    @property
+    def extra_params(self):
+        if self._metadata["extra_params_cached"]:
+            return self._metadata["extra_params"]
+        return self.resolve().extra_params
+
+    def __getattr__(self, name):
+        metadata = self.__dict__["_metadata"]
+        if name in metadata and name in _cached_fields:
+            return metadata[name]
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        return f"CachedServiceNodeLaunch({self._metadata['name']!r}, {self._metadata['module_main']!r})"
+
+
+def _no_service_args(parser_results):
+    return []
+
+
+def _launch_metadata(l):
+    m = {f: getattr(l, f, None) for f in _cached_fields}
+    m["depends"] = list(m["depends"] or [])
+    m["default_devices"] = [list(d) for d in (m["default_devices"] or [])]
+    m["has_add_arg_parser_options"] = not _is_default_callable(l.add_arg_parser_options, "_default_add_args")
+    m["has_prepare_service_args"] = not _is_default_callable(l.prepare_service_args, "_default_prepare_args")
+    extra_params = getattr(l, "extra_params", None)
+    m["extra_params_cached"] = _is_json_serializable(extra_params)
+    m["extra_params"] = extra_params if m["extra_params_cached"] else None
+    return m
+
+
+def _scan_plugins():
+    plugins = []
+    launches = []
+    for ep in _entry_points():
+        factory = ep.load()()
+        plugin_launches = factory.get_service_node_launches()
+        plugins.append({
+            "entry_point": ep.value,
+            "source": _module_source(ep.value.partition(":")[0].strip()),
+            "plugin_name": factory.get_plugin_name(),
+            "launches": [_launch_metadata(l) for l in plugin_launches]
+        })
+        launches.extend(plugin_launches)
+    return plugins, launches
+
+
+def _launches_from_cache(plugins):
+    launches = []
+    for p in plugins:
+        loader = _PluginLoader(p["entry_point"], p["plugin_name"])
+        for m in p["launches"]:
+            m["default_devices"] = [tuple(d) for d in m["default_devices"]]
+            launches.append(CachedServiceNodeLaunch(m, loader))
+    return launches
+
+
+def _scan_all_service_node_launches():
+    from pyri.plugins.service_node_launch import get_all_service_node_launches
+    service_node_launch = []
+    for l in get_all_service_node_launches().values():
+        service_node_launch.extend(l)
+    return service_node_launch
+
+
+def get_service_node_launches(cache_fname=None):
+    if cache_fname is None:
+        return _scan_all_service_node_launches()
+
+    cache_fname = Path(cache_fname)
+    try:
+        key = distributions_key()
+    except Exception:
+        traceback.print_exc()
+        return _scan_all_service_node_launches()
+
+    try:
+        if cache_fname.is_file():
+            with open(cache_fname, "r") as f:
+                cache = json.load(f)
+            if cache.get("key", None) == key and _sources_unchanged(cache["plugins"]):
+                return _launches_from_cache(cache["plugins"])
+    except Exception:
+        print("Warning: could not read service node launch cache, rebuilding")
+
+    try:
+        plugins, launches = _scan_plugins()
+    except Exception:
+        traceback.print_exc()
+        print("Warning: could not scan service node launch plugins for cache")
+        return _scan_all_service_node_launches()
+
+    try:
+        cache_fname.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fname = cache_fname.with_suffix(".tmp")
+        with open(tmp_fname, "w") as f:
+            json.dump({"key": key, "plugins": plugins}, f, indent=2)
+        tmp_fname.replace(cache_fname)
+    except Exception:
+        traceback.print_exc()
+        print("Warning: could not write service node launch cache")
+    return launches
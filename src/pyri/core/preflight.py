@@ -0,0 +1,148 @@
+import asyncio
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+# Checks run by pyri-core before the services are started, so a service that
+# can't be launched is reported once instead of being spawned and restarted:
+#
+# * module_main (and hosted_main) is resolved with importlib.util.find_spec
+#   and its source is compiled, without running it. Note that find_spec
+#   imports the parent packages of a dotted module name.
+# * The arguments returned by prepare_service_args must be a list of str.
+#
+# The bytecode of the service packages is then precompiled with compileall
+# in worker processes, so the services don't all compile the same modules
+# when they are started for the first time. If the packages are not
+# writable, for example on a read-only image, the bytecode is written to a
+# cache directory that the services use through PYTHONPYCACHEPREFIX. Only the
+# service packages are precompiled. Python ignores the __pycache__
+# directories of all modules when a prefix is set, so the other modules the
+# services import are compiled into the cache directory by the services on
+# their first start.
+
+
+def check_module(name, run_main=True):
+    # Returns a description of the problem, or None. run_main checks that "python -m name" can run it.
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError as e:
+        return f"module {name} not found: {e}"
+    except Exception as e:
+        return f"importing the parent package of {name} failed: {type(e).__name__}: {e}"
+    if spec is None:
+        return f"module {name} not found"
+    if run_main and spec.submodule_search_locations is not None:
+        # python -m runs the __main__ module of a package
+        if check_module(name + ".__main__", False) is not None:
+            return f"package {name} has no __main__ module"
+        return None
+    if spec.origin is not None and spec.origin.endswith(".py"):
+        try:
+            with open(spec.origin, "rb") as f:
+                compile(f.read(), spec.origin, "exec", dont_inherit=True)
+        except SyntaxError as e:
+            return f"module {name} has a syntax error: {e.msg} ({e.filename}, line {e.lineno})"
+        except Exception as e:
+            return f"module {name} can't be read: {type(e).__name__}: {e}"
+    return None
+
+
+def check_service(s, parser_results, remote=False, hosted_main=None):
+    # Returns a list of problems of the ServiceNodeLaunch s, empty if it can be started
+    problems = []
+    # The modules of services on launch agents are resolved on the agent
+    if not remote:
+        p = check_module(s.module_main)
+        if p is not None:
+            problems.append(p)
+        if hosted_main is not None:
+            module_name, sep, func_name = hosted_main.partition(":")
+            if not sep or not func_name:
+                problems.append(f"invalid hosted_main {hosted_main}, expected \"module:function\"")
+            else:
+                p = check_module(module_name, False)
+                if p is not None:
+                    problems.append(p)
+    try:
+        args = s.prepare_service_args(parser_results)
+    except Exception as e:
+        problems.append(f"prepare_service_args failed: {type(e).__name__}: {e}")
+    else:
+        if not isinstance(args, list):
+            problems.append(f"prepare_service_args returned {type(args).__name__}, expected a list of str")
+        else:
+            bad = [a for a in args if not isinstance(a, str)]
+            if len(bad) > 0:
+                problems.append(f"prepare_service_args returned arguments that are not str: "
+                    f"{', '.join(repr(a) for a in bad)}")
+    return problems
+
+
+def format_problems(problems, service_count):
+    lines = [f"Pre-flight check failed for {len(problems)} of {service_count} services, they will not be started:"]
+    for name in sorted(problems.keys()):
+        for p in problems[name]:
+            lines.append(f"  {name}: {p}")
+    return "\n".join(lines)
+
+
+def package_dir(module_name):
+    # Directory of the outermost regular package containing module_name, or the file of a top level module
+    parts = module_name.split(".")
+    for i in range(1, len(parts) + 1):
+        try:
+            spec = importlib.util.find_spec(".".join(parts[:i]))
+        except Exception:
+            return None
+        if spec is None or spec.origin is None or spec.origin in ("built-in", "frozen", "namespace"):
+            # Namespace packages are skipped, they span several distributions
+            continue
+        if spec.submodule_search_locations is not None:
+            return os.path.dirname(spec.origin)
+        return spec.origin if spec.origin.endswith(".py") else None
+    return None
+
+
+def package_paths(modules):
+    return sorted(set(p for p in (package_dir(m) for m in modules) if p is not None))
+
+
+def default_cache_dir():
+    import appdirs
+    return Path(appdirs.user_cache_dir(appname="pyri-project")).joinpath("pycache")
+
+
+def needs_cache_dir(paths):
+    # Bytecode can't be written next to the sources on read-only images
+    for p in paths:
+        d = p if os.path.isdir(p) else os.path.dirname(p)
+        pycache = os.path.join(d, "__pycache__")
+        if not os.access(pycache if os.path.isdir(pycache) else d, os.W_OK):
+            return True
+    return False
+
+
+async def compile_paths(paths, cache_dir=None, workers=0):
+    # Compiles paths with "python -m compileall" using workers processes, 0 for one per CPU.
+    # Returns the process, call wait_compile() for the result.
+    env = dict(os.environ)
+    if cache_dir is not None:
+        env["PYTHONPYCACHEPREFIX"] = str(cache_dir)
+    return await asyncio.create_subprocess_exec(sys.executable, "-m", "compileall", "-q", "-j", str(workers),
+        *[str(p) for p in paths], env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        stdin=asyncio.subprocess.DEVNULL)
+
+
+async def wait_compile(process):
+    # Returns True if all files were compiled, compileall lists the files that failed
+    output, _ = await process.communicate()
+    if process.returncode != 0:
+        lines = output.decode("utf-8", errors="replace").splitlines()
+        print("Warning: bytecode precompile failed for some files:")
+        for l in lines[:10]:
+            print(f"  {l}")
+        if len(lines) > 10:
+            print(f"  ... {len(lines) - 10} more lines")
+    return process.returncode == 0
@@ -0,0 +1,245 @@
+import os
+import sys
+
+# Per-service CPU affinity, scheduling, rlimit and I/O priority settings.
+# Settings are read from the "resources" key of the service extra_params, and
+# can be overridden with the --service-resources command line option:
+#
+#   extra_params={"resources": {"cpu_affinity": "2-3", "sched_policy": "fifo", "sched_priority": 50}}
+#
+# The system calls are prepared by the launching process and made in the
+# service process before the service module is run. Settings that can't be
+# applied are reported in the service stderr log. Only Linux is supported.
+
+_sched_policies = {
+    "other": "SCHED_OTHER",
+    "batch": "SCHED_BATCH",
+    "idle": "SCHED_IDLE",
+    "fifo": "SCHED_FIFO",
+    "rr": "SCHED_RR"
+}
+
+_ioprio_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+_ioprio_class_names = {v: k for k, v in _ioprio_classes.items()}
+_ioprio_class_shift = 13
+_ioprio_who_process = 1
+
+# ioprio_set and ioprio_get are not wrapped by libc or the os module
+_ioprio_syscalls = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "armv7l": (314, 315),
+    "ppc64le": (273, 274),
+    "riscv64": (30, 31)
+}
+
+# resources key -> (rlimit name, scale)
+_rlimits = {
+    "memory_limit_mb": ("RLIMIT_AS", 1024 * 1024),
+    "memlock_limit_mb": ("RLIMIT_MEMLOCK", 1024 * 1024),
+    "nofile_limit": ("RLIMIT_NOFILE", 1)
+}
+
+_proc_limits_names = {
+    "RLIMIT_AS": "Max address space",
+    "RLIMIT_MEMLOCK": "Max locked memory",
+    "RLIMIT_NOFILE": "Max open files"
+}
+
+_keys = {"cpu_affinity", "nice", "sched_policy", "sched_priority", "ioprio_class", "ioprio_level"} | set(_rlimits.keys())
+
+_syscall = None
+
+
+def parse_cpu_list(cpus):
+    # "0-3,6" -> [0, 1, 2, 3, 6]
+    if isinstance(cpus, int):
+        return [cpus]
+    if not isinstance(cpus, str):
+        return sorted(set(int(c) for c in cpus))
+    ret = set()
+    for part in cpus.split(","):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        first, sep, last = part.partition("-")
+        if sep:
+            ret.update(range(int(first), int(last) + 1))
+        else:
+            ret.add(int(first))
+    return sorted(ret)
+
+
+def _parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_resources_option(option):
+    # "name:key=value;key=value" -> name, dict
+    name, sep, settings = option.partition(":")
+    if not sep or len(name) == 0:
+        raise ValueError(f"Invalid service resources option: {option}")
+    ret = dict()
+    for setting in settings.split(";"):
+        if len(setting.strip()) == 0:
+            continue
+        key, sep, value = setting.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid service resources setting: {setting}")
+        ret[key.strip()] = _parse_value(value.strip())
+    return name, ret
+
+
+def validate_resources(resources):
+    # Returns normalized resources that can be sent to the fork server or an agent as JSON
+    if resources is None or len(resources) == 0:
+        return None
+    unknown = set(resources.keys()) - _keys
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown service resources settings: {', '.join(sorted(unknown))}")
+    ret = dict(resources)
+    if "cpu_affinity" in ret:
+        ret["cpu_affinity"] = parse_cpu_list(ret["cpu_affinity"])
+    if "sched_policy" in ret:
+        if ret["sched_policy"] not in _sched_policies:
+            raise ValueError(f"Invalid sched_policy: {ret['sched_policy']}")
+        if ret["sched_policy"] in ("fifo", "rr"):
+            ret.setdefault("sched_priority", 1)
+    if "ioprio_class" in ret and ret["ioprio_class"] not in _ioprio_classes:
+        raise ValueError(f"Invalid ioprio_class: {ret['ioprio_class']}")
+    for k in ("nice", "sched_priority", "ioprio_level") + tuple(_rlimits.keys()):
+        if k in ret:
+            ret[k] = int(ret[k])
+    return ret
+
+
+def _get_syscall():
+    global _syscall
+    if _syscall is None:
+        import ctypes
+        _syscall = ctypes.CDLL(None, use_errno=True).syscall
+    return _syscall
+
+
+def _checked_syscall(*args):
+    import ctypes
+    ret = _get_syscall()(*args)
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ret
+
+
+def _ioprio_syscall(index, *args):
+    nums = _ioprio_syscalls.get(os.uname().machine, None)
+    if nums is None:
+        raise OSError(f"ioprio not supported on {os.uname().machine}")
+    return _checked_syscall(nums[index], *args)
+
+
+def prepare_resources(resources):
+    # Runs in the parent process. Returns the calls that apply resources as (key, function, args),
+    # so only these calls are made in the child after fork. Problems found here are printed.
+    if resources is None:
+        return []
+    calls = []
+    if "cpu_affinity" in resources:
+        calls.append(("cpu_affinity", os.sched_setaffinity, (0, resources["cpu_affinity"])))
+    if "nice" in resources:
+        calls.append(("nice", os.setpriority, (os.PRIO_PROCESS, 0, resources["nice"])))
+    if "sched_policy" in resources:
+        policy = getattr(os, _sched_policies[resources["sched_policy"]], None)
+        priority = resources.get("sched_priority", 0)
+        calls.append(("sched_policy", os.sched_setscheduler, (0, policy, os.sched_param(priority))))
+    if "ioprio_class" in resources or "ioprio_level" in resources:
+        nums = _ioprio_syscalls.get(os.uname().machine, None)
+        if nums is None:
+            print(f"Warning: ioprio not supported on {os.uname().machine}")
+        else:
+            ioprio = (_ioprio_classes[resources.get("ioprio_class", "best-effort")] << _ioprio_class_shift) \
+                | resources.get("ioprio_level", 4)
+            _get_syscall()
+            calls.append(("ioprio", _checked_syscall, (nums[0], _ioprio_who_process, 0, ioprio)))
+    if any(k in resources for k in _rlimits.keys()):
+        import resource
+        for k, (rlimit_name, scale) in _rlimits.items():
+            if k in resources:
+                rlimit = getattr(resource, rlimit_name)
+                limit = resources[k] * scale
+                # The child inherits the limits of this process. Raising the hard limit requires
+                # CAP_SYS_RESOURCE, so the soft limit is clamped to the current hard limit.
+                _, hard = resource.getrlimit(rlimit)
+                if hard != resource.RLIM_INFINITY and limit > hard:
+                    print(f"Warning: service resources setting {k} {resources[k]} is above the hard limit "
+                        f"{hard // scale}, using the hard limit")
+                    limit = hard
+                calls.append((k, resource.setrlimit, (rlimit, (limit, hard))))
+    return calls
+
+
+def apply_prepared_resources(calls):
+    # Runs in the child process, errors are written to stderr and don't prevent the service from starting
+    for key, f, args in calls:
+        try:
+            f(*args)
+        except Exception as e:
+            os.write(2, f"Warning: could not apply service resources setting {key}: {e}\n".encode("utf-8"))
+
+
+def apply_resources(resources):
+    apply_prepared_resources(prepare_resources(resources))
+
+
+def make_preexec_fn(resources):
+    # Everything that may import modules or take locks runs before fork, the locks may be held
+    # by other threads of the parent when it forks
+    calls = prepare_resources(resources)
+
+    def preexec_fn():
+        os.setsid()
+        apply_prepared_resources(calls)
+    return preexec_fn
+
+
+def _read_proc_limits(pid):
+    ret = dict()
+    with open(f"/proc/{pid}/limits") as f:
+        lines = f.read().splitlines()
+    for rlimit_name, proc_name in _proc_limits_names.items():
+        for l in lines:
+            if l.startswith(proc_name):
+                soft, hard = l[len(proc_name):].split()[:2]
+                ret[rlimit_name] = (_parse_value(soft), _parse_value(hard))
+    return ret
+
+
+def read_effective_resources(pid):
+    ret = {"pid": pid}
+    ret["cpu_affinity"] = sorted(os.sched_getaffinity(pid))
+    ret["nice"] = os.getpriority(os.PRIO_PROCESS, pid)
+    policy = os.sched_getscheduler(pid)
+    ret["sched_policy"] = next((k for k, v in _sched_policies.items() if getattr(os, v, None) == policy), str(policy))
+    ret["sched_priority"] = os.sched_getparam(pid).sched_priority
+    try:
+        ioprio = _ioprio_syscall(1, _ioprio_who_process, pid)
+        ioprio_class = _ioprio_class_names.get(ioprio >> _ioprio_class_shift, "none")
+        ret["ioprio"] = f"{ioprio_class}/{ioprio & ((1 << _ioprio_class_shift) - 1)}"
+    except OSError:
+        pass
+    ret["limits"] = _read_proc_limits(pid)
+    return ret
+
+
+def format_effective_resources(r):
+    limits = ", ".join(f"{k} {soft}/{hard}" for k, (soft, hard) in r["limits"].items())
+    return f"Effective resources for pid {r['pid']}: cpu_affinity {r['cpu_affinity']}, nice {r['nice']}, " \
+        f"sched {r['sched_policy']}/{r['sched_priority']}, ioprio {r.get('ioprio', 'unknown')}, {limits}"
+
+
+def resources_supported():
+    return sys.platform.startswith("linux")
@@ -0,0 +1,161 @@
+# Launch profiles select and configure the services started by pyri-core,
+# without changing the installed plugins:
+#
+#   default_enabled: true
+#   services:
+#     robot:
+#       extra_args: ["--robot-info-file", "abb_1200.yml"]
+#       restart: true
+#     vision:
+#       enabled: false
+#
+# The launch fields of ServiceNodeLaunch can be overridden, and all other keys
+# are merged into extra_params. Keys that are not settings of pyri-core are
+# still merged, for plugins that read their own extra_params, but a warning is
+# printed so misspelled settings are noticed. Profiles can be reloaded while pyri-core is
+# running, and only the services with changed settings are restarted.
+
+_launch_fields = ["depends", "depends_backoff", "restart", "restart_backoff", "default_devices"]
+_args_fields = ["args", "extra_args"]
+# extra_params settings read by pyri-core, see doc/plugin_development.md
+_extra_params_keys = {"readiness", "ready_timeout", "fork_server", "rss_limit_mb", "cpu_limit_percent",
+    "resource_limit_action", "restart_max_backoff", "restart_stable_uptime", "restart_max_crashes",
+    "restart_crash_window", "restart_jitter", "stop_grace_period", "resources", "activation", "idle_timeout",
+    "idle_cpu_percent", "heartbeat", "hosting", "host_group", "hosted_main", "agent"}
+# Fields of ServiceNodeLaunch that identify the service and can't be changed by a profile
+_fixed_fields = ["name", "plugin_name", "module_main"]
+
+
+def _check_list_of_str(service_name, key, v):
+    if not isinstance(v, list) or not all(isinstance(a, (str, int, float)) for a in v):
+        raise ValueError(f"Profile setting {key} of service {service_name} must be a list of strings")
+    return [str(a) for a in v]
+
+
+def _parse_service_settings(service_name, settings):
+    if settings is None:
+        return dict()
+    if not isinstance(settings, dict):
+        raise ValueError(f"Profile settings of service {service_name} must be a mapping")
+    settings = dict(settings)
+    if "enabled" in settings and not isinstance(settings["enabled"], bool):
+        raise ValueError(f"Profile setting enabled of service {service_name} must be true or false")
+    for key in _args_fields:
+        if key in settings:
+            settings[key] = _check_list_of_str(service_name, key, settings[key])
+    if "depends" in settings:
+        settings["depends"] = _check_list_of_str(service_name, "depends", settings["depends"] or [])
+    if "default_devices" in settings:
+        devices = settings["default_devices"] or []
+        if not all(isinstance(d, list) and len(d) == 2 for d in devices):
+            raise ValueError(f"Profile setting default_devices of service {service_name} must be a list of "
+                "[device_type, device_name] pairs")
+        settings["default_devices"] = [tuple(d) for d in devices]
+    for key in ["depends_backoff", "restart_backoff"]:
+        if key in settings and not isinstance(settings[key], (int, float)):
+            raise ValueError(f"Profile setting {key} of service {service_name} must be a number")
+    for key in settings.keys():
+        if key in _fixed_fields:
+            raise ValueError(f"Profile setting {key} of service {service_name} can't be changed by a profile")
+        if key not in _launch_fields and key not in _args_fields and key != "enabled" and key not in _extra_params_keys:
+            print(f"Warning: profile setting {key} of service {service_name} is not a pyri-core setting, "
+                "passing it to the service in extra_params")
+    return settings
+
+
+def parse_profile(profile):
+    if profile is None:
+        profile = dict()
+    if not isinstance(profile, dict):
+        raise ValueError("Launch profile must be a mapping")
+    default_enabled = profile.get("default_enabled", True)
+    if not isinstance(default_enabled, bool):
+        raise ValueError("Profile setting default_enabled must be true or false")
+    services = dict()
+    for name, settings in (profile.get("services", None) or dict()).items():
+        services[str(name)] = _parse_service_settings(name, settings)
+    return {"default_enabled": default_enabled, "services": services}
+
+
+def load_profile(fname):
+    import yaml
+    with open(fname) as f:
+        return parse_profile(yaml.safe_load(f))
+
+
+class ProfiledServiceNodeLaunch:
+    # Wraps a ServiceNodeLaunch, or a cached launch, with the settings from a profile
+    def __init__(self, launch, settings):
+        self._launch = launch
+        self._settings = settings
+
+    @property
+    def prepare_service_args(self):
+        settings = self._settings
+        if "args" not in settings and "extra_args" not in settings:
+            return self._launch.prepare_service_args
+        prepare_service_args = self._launch.prepare_service_args
+
+        def f(parser_results):
+            args = list(settings["args"]) if "args" in settings else list(prepare_service_args(parser_results))
+            return args + settings.get("extra_args", [])
+        return f
+
+    @property
+    def extra_params(self):
+        extra_params = getattr(self._launch, "extra_params", None)
+        params = {k: v for k, v in self._settings.items() if k not in _launch_fields and k not in _args_fields
+            and k != "enabled"}
+        if len(params) == 0:
+            return extra_params
+        ret = dict(extra_params or dict())
+        ret.update(params)
+        return ret
+
+    def __getattr__(self, name):
+        settings = self.__dict__["_settings"]
+        if name in _launch_fields and name in settings:
+            return settings[name]
+        return getattr(self.__dict__["_launch"], name)
+
+    def __repr__(self):
+        return f"ProfiledServiceNodeLaunch({self._launch!r})"
+
+
+def service_enabled(profile, name):
+    settings = profile["services"].get(name, dict())
+    return settings.get("enabled", profile["default_enabled"])
+
+
+def apply_profile(service_node_launches, profile):
+    # Returns the enabled launches, with the profile settings applied
+    names = set(l.name for l in service_node_launches)
+    for name in profile["services"].keys():
+        if name not in names:
+            print(f"Warning: launch profile configures unknown service {name}")
+    ret = []
+    for l in service_node_launches:
+        if not service_enabled(profile, l.name):
+            continue
+        settings = profile["services"].get(l.name, None)
+        ret.append(ProfiledServiceNodeLaunch(l, settings) if settings else l)
+    return ret
+
+
+def _service_settings(profile, name):
+    return {k: v for k, v in profile["services"].get(name, dict()).items() if k != "enabled"}
+
+
+def changed_services(old_profile, new_profile, service_names):
+    # Returns (added, removed, changed) service names between two profiles
+    added, removed, changed = [], [], []
+    for name in service_names:
+        old_enabled = service_enabled(old_profile, name)
+        new_enabled = service_enabled(new_profile, name)
+        if old_enabled and not new_enabled:
+            removed.append(name)
+        elif new_enabled and not old_enabled:
+            added.append(name)
+        elif new_enabled and _service_settings(old_profile, name) != _service_settings(new_profile, name):
+            changed.append(name)
+    return added, removed, changed
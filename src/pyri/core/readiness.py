@@ -0,0 +1,144 @@
+import asyncio
+
+# Readiness is declared by plugins in ServiceNodeLaunch.extra_params["readiness"]
+# as a dict, for example:
+#
+#   {"type": "robotraconteur", "service_type": "tech.pyri.device_manager.DeviceManager"}
+#   {"type": "stdout", "marker": "Server started"}
+#   {"type": "tcp", "port": 8000}
+#
+# Services without a readiness declaration are considered ready as soon as
+# they are running.
+
+_default_readiness = {
+    "device_manager": {"type": "robotraconteur", "service_type": "tech.pyri.device_manager.DeviceManager",
+        "device_manager_filter": True}
+}
+
+
+class ReadinessProbe:
+    def start(self, loop):
+        pass
+
+    async def wait_ready(self):
+        pass
+
+    def feed_line(self, stream, line):
+        pass
+
+    def close(self):
+        pass
+
+
+class StdoutMarkerReadinessProbe(ReadinessProbe):
+    def __init__(self, marker, stream="stdout"):
+        self.marker = marker
+        self.stream = stream
+        self._ready = None
+
+    def start(self, loop):
+        self._ready = loop.create_future()
+
+    async def wait_ready(self):
+        await self._ready
+
+    def feed_line(self, stream, line):
+        if self._ready is None or self._ready.done():
+            return
+        if self.stream != "any" and stream != self.stream:
+            return
+        if self.marker in line:
+            self._ready.set_result(True)
+
+
+class TcpPortReadinessProbe(ReadinessProbe):
+    def __init__(self, port, host="localhost", interval=0.1):
+        self.port = port
+        self.host = host
+        self.interval = interval
+
+    async def wait_ready(self):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(self.host, self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(self.interval)
+
+
+class RobotRaconteurReadinessProbe(ReadinessProbe):
+    def __init__(self, service_type, service_name=None, device_manager_filter=False):
+        self.service_type = service_type
+        self.service_name = service_name
+        self.device_manager_filter = device_manager_filter
+        self._sub = None
+        self._loop = None
+
+    def start(self, loop):
+        self._loop = loop
+        from RobotRaconteur.Client import RRN
+        if self.device_manager_filter:
+            from pyri.device_manager_client import _DeviceManagerConnectFilter
+            f = _DeviceManagerConnectFilter(RRN, "pyri_device_manager").get_filter()
+        elif self.service_name is not None:
+            from RobotRaconteur.Client import ServiceSubscriptionFilter
+            f = ServiceSubscriptionFilter()
+            f.ServiceNames = [self.service_name]
+        else:
+            f = None
+        if f is not None:
+            self._sub = RRN.SubscribeServiceByType(self.service_type, f)
+        else:
+            self._sub = RRN.SubscribeServiceByType(self.service_type)
+
+    async def wait_ready(self):
+        await wait_subscription_connected(self._sub, self._loop)
+
+    def close(self):
+        if self._sub is not None:
+            try:
+                self._sub.Close()
+            except Exception:
+                pass
+            self._sub = None
+
+
+async def wait_subscription_connected(sub, loop):
+    # ClientConnected is fired from a Robot Raconteur thread
+    connected = loop.create_future()
+
+    def client_connected(*args):
+        loop.call_soon_threadsafe(lambda: connected.done() or connected.set_result(True))
+
+    sub.ClientConnected += client_connected
+    try:
+        res, _ = sub.TryGetDefaultClient()
+        if res:
+            return
+        await connected
+    finally:
+        sub.ClientConnected -= client_connected
+
+
+def resolve_readiness(name, readiness):
+    if readiness is None:
+        return _default_readiness.get(name, None)
+    return readiness
+
+
+def create_readiness_probe(name, readiness):
+    readiness = resolve_readiness(name, readiness)
+    if readiness is None:
+        return None
+    if isinstance(readiness, ReadinessProbe):
+        return readiness
+    readiness = dict(readiness)
+    probe_type = readiness.pop("type")
+    if probe_type == "stdout":
+        return StdoutMarkerReadinessProbe(**readiness)
+    if probe_type == "tcp":
+        return TcpPortReadinessProbe(**readiness)
+    if probe_type == "robotraconteur":
+        return RobotRaconteurReadinessProbe(**readiness)
+    raise ValueError(f"Invalid readiness type for service {name}: {probe_type}")
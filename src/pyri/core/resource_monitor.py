@@ -0,0 +1,243 @@
+import asyncio
+import collections
+import os
+import time
+import traceback
+from typing import NamedTuple
+
+# Samples the CPU, memory, thread and file descriptor use of each service by
+# reading /proc. All processes in the process group of a service are counted,
+# so helper processes started by a service are included.
+
+
+class ResourceSample(NamedTuple):
+    timestamp: float
+    pids: int
+    cpu_percent: float
+    rss_bytes: int
+    threads: int
+    fds: int
+
+
+def resource_monitor_supported():
+    return os.path.isdir("/proc/self")
+
+
+_clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_proc_stat(pid):
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        stat = f.read()
+    # comm may contain spaces and parentheses
+    rest = stat[stat.rindex(b")") + 2:].split()
+    return {
+        "pgrp": int(rest[2]),
+        "cpu_ticks": int(rest[11]) + int(rest[12]),
+        "threads": int(rest[17]),
+        "starttime": int(rest[19]),
+        "rss_bytes": int(rest[21]) * _page_size
+    }
+
+
+def _count_fds(pid):
+    try:
+        return len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        return 0
+
+
+def _socket_inodes(pid):
+    inodes = set()
+    fd_dir = f"/proc/{pid}/fd"
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(f"{fd_dir}/{fd}")
+        except OSError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(int(target[8:-1]))
+    return inodes
+
+
+def read_client_connections(pid):
+    # Number of connections accepted by the process: TCP connections to a port it listens on, and
+    # connected Unix sockets bound to a path, which accepted connections share with the listening
+    # socket. Connections made by the process itself are not counted.
+    inodes = _socket_inodes(pid)
+    if len(inodes) == 0:
+        return 0
+    listen_ports = set()
+    established = []
+    for proto in ("tcp", "tcp6"):
+        try:
+            with open(f"/proc/{pid}/net/{proto}") as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for l in lines:
+            cols = l.split()
+            if int(cols[9]) not in inodes:
+                continue
+            port = cols[1].rsplit(":", 1)[1]
+            if cols[3] == "0A":
+                listen_ports.add(port)
+            elif cols[3] == "01":
+                established.append(port)
+    count = sum(1 for port in established if port in listen_ports)
+    try:
+        with open(f"/proc/{pid}/net/unix") as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        lines = []
+    for l in lines:
+        cols = l.split()
+        if len(cols) >= 8 and cols[5] == "03" and int(cols[6]) in inodes:
+            count += 1
+    return count
+
+
+def read_process_groups(pgids):
+    groups = {pgid: [] for pgid in pgids}
+    for e in os.listdir("/proc"):
+        if not e.isdigit():
+            continue
+        try:
+            stat = read_proc_stat(e)
+        except (OSError, ValueError, IndexError):
+            continue
+        g = groups.get(stat["pgrp"], None)
+        if g is not None:
+            stat["pid"] = int(e)
+            g.append(stat)
+    return groups
+
+
+class PyriResourceMonitor:
+    def __init__(self, core, log_file, interval=5.0, history=720, rss_limit_mb=None, cpu_limit_percent=None,
+            limit_action="warn", limit_samples=3):
+        self._core = core
+        self._log_file = log_file
+        self.interval = interval
+        self.history_size = history
+        self.rss_limit_mb = rss_limit_mb
+        self.cpu_limit_percent = cpu_limit_percent
+        self.limit_action = limit_action
+        self.limit_samples = limit_samples
+        self._history = dict()
+        self._last_ticks = dict()
+        self._last_time = None
+        self._over_limit = dict()
+        self._peak_rss = dict()
+        self._total_history = collections.deque(maxlen=history)
+        self._peak_total_rss = 0
+        self._task = None
+        if self._log_file is not None:
+            self._log_file.write("timestamp,service,pids,cpu_percent,rss_mb,threads,fds\n")
+
+    def start(self, loop):
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def history(self, name):
+        h = self._history.get(name, None)
+        if h is None:
+            return []
+        return list(h)
+
+    def latest(self):
+        return {name: h[-1] for name, h in self._history.items() if len(h) > 0}
+
+    def memory_report(self, steady_window=60):
+        # Peak and steady-state memory of all services. Steady-state is the mean total
+        # RSS over the last steady_window seconds.
+        if len(self._total_history) == 0:
+            return None
+        now, current = self._total_history[-1]
+        window = [rss for t, rss in self._total_history if now - t <= steady_window]
+        latest = self.latest()
+        return {
+            "peak_total_mb": self._peak_total_rss / 1048576,
+            "steady_total_mb": sum(window) / len(window) / 1048576,
+            "current_total_mb": current / 1048576,
+            "services": {name: {
+                "peak_mb": self._peak_rss.get(name, 0) / 1048576,
+                "current_mb": latest[name].rss_bytes / 1048576 if name in latest and latest[name].timestamp == now else 0
+            } for name in self._peak_rss.keys()}
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                pgids = self._core.service_process_groups()
+                now = time.time()
+                groups = await loop.run_in_executor(None, read_process_groups, list(pgids.values()))
+                self._record(now, pgids, groups)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    def _record(self, now, pgids, groups):
+        elapsed = now - self._last_time if self._last_time is not None else None
+        self._last_time = now
+        last_ticks = self._last_ticks
+        self._last_ticks = dict()
+        lines = []
+        total_rss = 0
+        for name, pgid in pgids.items():
+            procs = groups.get(pgid, [])
+            if len(procs) == 0:
+                continue
+            ticks = 0
+            for p in procs:
+                key = (p["pid"], p["starttime"])
+                self._last_ticks[key] = p["cpu_ticks"]
+                ticks += max(p["cpu_ticks"] - last_ticks.get(key, p["cpu_ticks"]), 0)
+            cpu_percent = 100.0 * ticks / _clock_ticks / elapsed if elapsed else 0.0
+            sample = ResourceSample(now, len(procs), cpu_percent, sum(p["rss_bytes"] for p in procs),
+                sum(p["threads"] for p in procs), sum(_count_fds(p["pid"]) for p in procs))
+            h = self._history.get(name, None)
+            if h is None:
+                h = collections.deque(maxlen=self.history_size)
+                self._history[name] = h
+            h.append(sample)
+            self._peak_rss[name] = max(self._peak_rss.get(name, 0), sample.rss_bytes)
+            total_rss += sample.rss_bytes
+            lines.append(f"{now:.3f},{name},{sample.pids},{sample.cpu_percent:.1f},"
+                f"{sample.rss_bytes / 1048576:.1f},{sample.threads},{sample.fds}\n")
+            self._check_limits(name, sample)
+        self._total_history.append((now, total_rss))
+        self._peak_total_rss = max(self._peak_total_rss, total_rss)
+        if self._log_file is not None and len(lines) > 0:
+            self._log_file.write("".join(lines))
+
+    def _check_limits(self, name, sample):
+        rss_limit = self._core.service_param(name, "rss_limit_mb", self.rss_limit_mb)
+        cpu_limit = self._core.service_param(name, "cpu_limit_percent", self.cpu_limit_percent)
+        over = []
+        if rss_limit is not None and sample.rss_bytes > rss_limit * 1048576:
+            over.append(f"RSS {sample.rss_bytes / 1048576:.1f} MB > {rss_limit} MB")
+        if cpu_limit is not None and sample.cpu_percent > cpu_limit:
+            over.append(f"CPU {sample.cpu_percent:.1f}% > {cpu_limit}%")
+        if len(over) == 0:
+            self._over_limit.pop(name, None)
+            return
+        count = self._over_limit.get(name, 0) + 1
+        self._over_limit[name] = count
+        if count < self.limit_samples:
+            return
+        self._over_limit[name] = 0
+        action = self._core.service_param(name, "resource_limit_action", self.limit_action)
+        print(f"Warning: service {name} over resource limit: {', '.join(over)}")
+        if action == "restart":
+            print(f"Restarting service {name} due to resource limit")
+            self._core.restart_service(name)
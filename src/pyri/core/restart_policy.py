@@ -0,0 +1,65 @@
+import collections
+import random as _random
+
+# Restart policy for services with restart enabled. The delay before each
+# restart grows exponentially from initial_backoff up to max_backoff, with
+# random jitter so services that crash together don't restart in lockstep.
+# The backoff is reset once a service has been up for stable_uptime seconds.
+# The circuit breaker trips and the service is not restarted again if it
+# exits max_crashes times within crash_window seconds, or max_crashes times
+# in a row without staying up for stable_uptime seconds. The second rule
+# catches a service that dies on startup when the growing backoff spreads
+# its crashes over more than crash_window.
+
+
+class RestartPolicy:
+    def __init__(self, initial_backoff=5, max_backoff=60, multiplier=2, jitter=0.1, stable_uptime=60,
+            max_crashes=5, crash_window=60, random=_random.random):
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max(max_backoff, initial_backoff)
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.stable_uptime = stable_uptime
+        self.max_crashes = max_crashes
+        self.crash_window = crash_window
+        self._random = random
+        self._attempt = 0
+        self._crashes = collections.deque()
+        self._unstable_crashes = 0
+
+    @property
+    def attempt(self):
+        return self._attempt
+
+    @property
+    def recent_crashes(self):
+        return len(self._crashes)
+
+    @property
+    def unstable_crashes(self):
+        # Crashes in a row without a stable run
+        return self._unstable_crashes
+
+    def reset(self):
+        self._attempt = 0
+        self._crashes.clear()
+        self._unstable_crashes = 0
+
+    def record_exit(self, now, uptime):
+        # Returns the delay before the next restart, or None if the circuit breaker tripped
+        if uptime >= self.stable_uptime:
+            self._attempt = 0
+            self._unstable_crashes = 0
+        else:
+            self._unstable_crashes += 1
+        self._crashes.append(now)
+        while len(self._crashes) > 0 and now - self._crashes[0] > self.crash_window:
+            self._crashes.popleft()
+        if self.max_crashes > 0 and (len(self._crashes) >= self.max_crashes
+                or self._unstable_crashes >= self.max_crashes):
+            return None
+        delay = min(self.initial_backoff * (self.multiplier ** self._attempt), self.max_backoff)
+        self._attempt += 1
+        if self.jitter > 0:
+            delay *= 1 + self.jitter * (2 * self._random() - 1)
+        return max(delay, 0)
@@ -0,0 +1,258 @@
+import array
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from . import subprocess_impl
+from .fork_server import _open_read_pipe
+
+# Launcher side of the shared service host, see host_process.py. Services
+# with extra_params["hosting"] = "shared" run as threads in a host process
+# shared with the other services of the same host_group, instead of each in
+# its own interpreter. Each hosted service is still supervised separately:
+# it has its own output pipes, exit code, restart policy and state.
+
+
+def service_host_supported():
+    return sys.platform.startswith("linux") and hasattr(socket, "SOCK_SEQPACKET")
+
+
+class PyriServiceHost:
+    def __init__(self, loop, group, log=None, env=None):
+        self._loop = loop
+        self.group = group
+        self._log = log
+        self._env = env
+        self._sock = None
+        self._process = None
+        self._ready = None
+        self._next_id = 1
+        self._spawn_futures = dict()
+        self._exit_futures = dict()
+        self._early_exits = dict()
+        self._closed = False
+        self._pump_tasks = []
+        self.pid = None
+
+    @property
+    def alive(self):
+        return self._sock is not None and not self._closed
+
+    async def start(self):
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._process = await subprocess_impl.create_subprocess_exec(sys.executable,
+                ["-m", "pyri.core.host_process", "--fd", str(child_sock.fileno())],
+                env=self._env, pass_fds=[child_sock.fileno()])
+        finally:
+            child_sock.close()
+        self.pid = self._process.pid
+        parent_sock.setblocking(False)
+        self._sock = parent_sock
+        self._ready = self._loop.create_future()
+        self._loop.add_reader(parent_sock.fileno(), self._on_readable)
+        self._pump_tasks = [asyncio.ensure_future(self._pump_output(self._process.stdout)),
+            asyncio.ensure_future(self._pump_output(self._process.stderr))]
+        await self._ready
+
+    async def _pump_output(self, stream):
+        while True:
+            data = await stream.read(65536)
+            if len(data) == 0:
+                break
+            if self._log is not None:
+                self._log.write(data)
+                await self._log.drain()
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+            if len(data) == 0:
+                self._lost()
+                return
+            try:
+                self._handle_msg(json.loads(data.decode("utf-8")))
+            except Exception:
+                traceback.print_exc()
+
+    def _handle_msg(self, msg):
+        op = msg["op"]
+        if op == "ready":
+            if not self._ready.done():
+                self._ready.set_result(True)
+        elif op == "spawned":
+            f = self._spawn_futures.pop(msg["id"], None)
+            if f is not None and not f.done():
+                f.set_result(msg["hid"])
+        elif op == "error":
+            f = self._spawn_futures.pop(msg["id"], None)
+            if f is not None and not f.done():
+                f.set_exception(OSError(msg["error"]))
+        elif op == "exited":
+            hid = msg["hid"]
+            f = self._exit_futures.pop(hid, None)
+            if f is None:
+                self._early_exits[hid] = msg["returncode"]
+            elif not f.done():
+                f.set_result(msg["returncode"])
+
+    def _lost(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        err = ConnectionError(f"Service host {self.group} exited")
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(err)
+        for f in self._spawn_futures.values():
+            if not f.done():
+                f.set_exception(err)
+        self._spawn_futures.clear()
+        # The hosted services exited with the host
+        for f in self._exit_futures.values():
+            if not f.done():
+                f.set_result(-signal.SIGKILL)
+        self._exit_futures.clear()
+        if not self._closed:
+            print(f"Warning: service host {self.group} exited unexpectedly, its services will be restarted")
+
+    def _send(self, msg, fds=None):
+        if not self.alive:
+            raise ConnectionError(f"Service host {self.group} not running")
+        if fds:
+            self._sock.sendmsg([json.dumps(msg).encode("utf-8")],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        else:
+            self._sock.send(json.dumps(msg).encode("utf-8"))
+
+    async def create_subprocess(self, name, module_main, args, entry=None):
+        req_id = self._next_id
+        self._next_id += 1
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        try:
+            msg = {"op": "spawn", "id": req_id, "name": name, "module_main": module_main, "args": list(args),
+                "entry": entry}
+            f = self._loop.create_future()
+            self._spawn_futures[req_id] = f
+            self._send(msg, [stdout_w, stderr_w])
+        except:
+            self._spawn_futures.pop(req_id, None)
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        try:
+            hid = await f
+        except:
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+
+        exit_future = self._loop.create_future()
+        if hid in self._early_exits:
+            exit_future.set_result(self._early_exits.pop(hid))
+        else:
+            self._exit_futures[hid] = exit_future
+
+        stdout = await _open_read_pipe(self._loop, stdout_r)
+        stderr = await _open_read_pipe(self._loop, stderr_r)
+        return PyriHostedSubprocessImpl(self, hid, stdout, stderr, exit_future)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+        # Services are stopped before the host is closed, killing the host also ends the threads
+        # of services that did not stop
+        if self._process is not None:
+            try:
+                self._process.close()
+            except Exception:
+                traceback.print_exc()
+        for t in self._pump_tasks:
+            t.cancel()
+
+    async def wait_closed(self, timeout=5):
+        # Waits for the host process to exit after close()
+        if self._process is None:
+            return
+        try:
+            await asyncio.wait_for(self._process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: service host {self.group} did not exit")
+        await asyncio.gather(*self._pump_tasks, return_exceptions=True)
+
+
+class PyriHostedSubprocessImpl:
+    hosted = True
+
+    def __init__(self, host, hid, stdout, stderr, exit_future):
+        self._host = host
+        self._hid = hid
+        self._stdout = stdout
+        self._stderr = stderr
+        self._exit_future = exit_future
+
+    @property
+    def process(self):
+        return None
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    @property
+    def pid(self):
+        # The pid of the shared host process
+        return self._host.pid
+
+    @property
+    def host_group(self):
+        return self._host.group
+
+    @property
+    def returncode(self):
+        if not self._exit_future.done():
+            return None
+        return self._exit_future.result()
+
+    async def wait(self):
+        return await asyncio.shield(self._exit_future)
+
+    def kill(self):
+        # The thread of the service can't be killed, the host abandons it and reports the exit
+        if self._exit_future.done() or not self._host.alive:
+            return
+        self._host._send({"op": "kill", "hid": self._hid})
+
+    def send_term(self):
+        if self._exit_future.done() or not self._host.alive:
+            return
+        self._host._send({"op": "stop", "hid": self._hid})
+
+    def close(self):
+        try:
+            self.kill()
+        except Exception:
+            pass
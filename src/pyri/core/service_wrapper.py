@@ -0,0 +1,19 @@
+import runpy
+import sys
+from . import heartbeat
+
+# Runs a service module with the stack dump handler installed, used by
+# pyri-core to start services that have the hang detection watchdog enabled:
+#
+#   python -m pyri.core.service_wrapper <module_main> <args>
+
+
+def main():
+    module_main = sys.argv[1]
+    heartbeat.install_stack_dump_handler()
+    sys.argv = [module_main] + sys.argv[2:]
+    runpy.run_module(module_main, run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main()
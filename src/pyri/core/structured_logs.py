@@ -0,0 +1,148 @@
+import queue
+import re
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+# Optional SQLite sidecar with the service output, enabled with
+# --structured-logs. Output is stored one row for each chunk read from the
+# service, with the lines of the chunk joined by newlines. All lines of a chunk
+# share the chunk timestamp, so this is a sparse index of the lines by time
+# and by service and time, and time range and service queries across runs
+# are fast, see "pyri-core logs". Chunks are handed to a writer thread and
+# inserted in batches, so the event loop never waits on the database.
+
+db_fname = "logs.sqlite"
+
+_schema = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS services (id INTEGER PRIMARY KEY, name TEXT UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS chunks (ts REAL, service INTEGER, stream TEXT, lines TEXT)",
+    "CREATE INDEX IF NOT EXISTS chunks_ts ON chunks (ts)",
+    "CREATE INDEX IF NOT EXISTS chunks_service_ts ON chunks (service, ts)"
+]
+
+
+class PyriStructuredLogStore:
+    def __init__(self, fname, flush_interval=1.0):
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        conn = sqlite3.connect(str(fname))
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for s in _schema:
+                conn.execute(s)
+            now = time.time()
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("start_time", str(now)), ("end_time", str(now)), ("hostname", socket.gethostname())])
+            conn.commit()
+        finally:
+            conn.close()
+        self._thread = threading.Thread(target=self._run, name="pyri-structured-logs", daemon=True)
+        self._thread.start()
+
+    def append(self, service, stream, lines, timestamp=None):
+        if self._closed or len(lines) == 0:
+            return
+        self._queue.put((timestamp if timestamp is not None else time.time(), service, stream, lines))
+
+    def event(self, service, text):
+        # Launcher events, such as service state changes, are stored in the "pyri-core" stream
+        self.append(service, "pyri-core", [text])
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(str(self.fname), check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        service_ids = dict(conn.execute("SELECT name, id FROM services"))
+        stop = False
+        while not stop:
+            items = []
+            try:
+                items.append(self._queue.get(timeout=self.flush_interval))
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or items[-1] is None:
+                        break
+                    items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            if len(items) == 0:
+                continue
+            try:
+                rows = []
+                for item in items:
+                    if item is None:
+                        stop = True
+                        continue
+                    ts, service, stream, lines = item
+                    service_id = service_ids.get(service, None)
+                    if service_id is None:
+                        service_id = conn.execute("INSERT INTO services (name) VALUES (?)", (service,)).lastrowid
+                        service_ids[service] = service_id
+                    rows.append((ts, service_id, stream, "\n".join(lines)))
+                conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+                if len(rows) > 0:
+                    last_ts = max(r[0] for r in rows)
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('end_time', ?)", (str(last_ts),))
+                conn.commit()
+            except Exception:
+                traceback.print_exc()
+        conn.close()
+
+
+def read_meta(fname):
+    conn = sqlite3.connect(f"file:{fname}?mode=ro", uri=True)
+    try:
+        return dict(conn.execute("SELECT key, value FROM meta"))
+    finally:
+        conn.close()
+
+
+def query_logs(fname, since=None, until=None, services=None, streams=None, pattern=None, limit=None):
+    # Generator of (timestamp, service, stream, text) tuples for each line, in time order
+    conn = sqlite3.connect(f"file:{fname}?mode=ro", uri=True)
+    try:
+        where = []
+        params = []
+        if since is not None:
+            where.append("chunks.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("chunks.ts <= ?")
+            params.append(until)
+        if services is not None:
+            where.append(f"chunks.service IN (SELECT id FROM services WHERE name IN ({','.join('?' * len(services))}))")
+            params.extend(services)
+        if streams is not None:
+            where.append(f"chunks.stream IN ({','.join('?' * len(streams))})")
+            params.extend(streams)
+        sql = "SELECT chunks.ts, services.name, chunks.stream, chunks.lines FROM chunks " \
+            "JOIN services ON chunks.service = services.id"
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY chunks.ts, chunks.rowid"
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        n = 0
+        for ts, service, stream, lines in conn.execute(sql, params):
+            for text in lines.split("\n"):
+                if pattern is not None and pattern.search(text) is None:
+                    continue
+                yield (ts, service, stream, text)
+                n += 1
+                if limit is not None and n >= limit:
+                    return
+    finally:
+        conn.close()
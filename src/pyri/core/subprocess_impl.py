@@ -3,11 +3,13 @@ import asyncio
 import subprocess
 import os
 
+from . import process_resources
+
 if sys.platform == "win32":
     from . import subprocess_impl_win32
 
 
-async def create_subprocess_exec(process, args, env=None):
+async def create_subprocess_exec(process, args, env=None, pass_fds=(), resources=None):
     if sys.platform == "win32":
         job_handle = subprocess_impl_win32.win32_create_job_object()
 
@@ -22,9 +24,12 @@ async def create_subprocess_exec(process, args, env=None):
 
     else:
         #TODO: Use "start_new_session=True" arg for new process
+        preexec_fn = os.setsid
+        if resources is not None:
+            preexec_fn = process_resources.make_preexec_fn(resources)
         process = await asyncio.create_subprocess_exec(process,*args, \
             stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.PIPE,\
-            env=env, close_fds=True, preexec_fn=os.setsid )
+            env=env, close_fds=True, pass_fds=pass_fds, preexec_fn=preexec_fn )
         return PyriSubprocessImpl(process)
 
 
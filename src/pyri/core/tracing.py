@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+
+# Records startup and shutdown timeline events in the Chrome trace event
+# format. The resulting file can be opened in chrome://tracing or
+# https://ui.perfetto.dev . Each service is shown as its own thread.
+
+
+class PyriTraceRecorder:
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._t0 = clock()
+        self._pid = os.getpid()
+        self._events = []
+        self._tids = dict()
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._clock()
+
+    def _ts(self, t):
+        return round((t - self._t0) * 1e6, 1)
+
+    def _tid(self, track):
+        tid = self._tids.get(track, None)
+        if tid is None:
+            tid = len(self._tids) + 1
+            self._tids[track] = tid
+        return tid
+
+    def instant(self, track, name, args=None, t=None):
+        if t is None:
+            t = self._clock()
+        with self._lock:
+            e = {"name": name, "ph": "i", "s": "t", "ts": self._ts(t), "pid": self._pid, "tid": self._tid(track)}
+            if args is not None:
+                e["args"] = args
+            self._events.append(e)
+
+    def complete(self, track, name, t_start, t_end=None, args=None):
+        if t_end is None:
+            t_end = self._clock()
+        with self._lock:
+            e = {"name": name, "ph": "X", "ts": self._ts(t_start), "dur": round((t_end - t_start) * 1e6, 1),
+                "pid": self._pid, "tid": self._tid(track)}
+            if args is not None:
+                e["args"] = args
+            self._events.append(e)
+
+    def to_json(self):
+        with self._lock:
+            events = [{"name": "process_name", "ph": "M", "pid": self._pid, "args": {"name": "pyri-core"}}]
+            for track, tid in self._tids.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": track}})
+                events.append({"name": "thread_sort_index", "ph": "M", "pid": self._pid, "tid": tid,
+                    "args": {"sort_index": tid}})
+            events.extend(self._events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, fname):
+        data = self.to_json()
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_fname, fname)
+
+
+def format_startup_summary(t0, timings):
+    # timings is a dict of service name -> dict with "requested", "spawned",
+    # "first_output" and "ready" times, any of which may be missing
+    def fmt(t):
+        return f"{t - t0:9.3f}" if t is not None else f"{'-':>9}"
+
+    def fmt_diff(t1, t2):
+        return f"{t2 - t1:9.3f}" if t1 is not None and t2 is not None else f"{'-':>9}"
+
+    name_width = max([len(n) for n in timings.keys()] + [7])
+    lines = [f"{'service':<{name_width}}  {'requested':>9}  {'spawn':>9}  {'output':>9}  {'ready':>9}  {'to ready':>9}"]
+    for name, t in sorted(timings.items(), key=lambda x: x[1].get("ready") or float("inf")):
+        requested = t.get("requested")
+        lines.append(f"{name:<{name_width}}  {fmt(requested)}  {fmt_diff(requested, t.get('spawned'))}  "
+            f"{fmt_diff(requested, t.get('first_output'))}  {fmt(t.get('ready'))}  "
+            f"{fmt_diff(requested, t.get('ready'))}")
+    return "\n".join(lines)
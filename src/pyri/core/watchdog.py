@@ -0,0 +1,151 @@
+import os
+import traceback
+from . import heartbeat
+
+# Launcher side of the hang detection watchdog. Each service with
+# extra_params["heartbeat"] gets a watchdog for each run of the process:
+#
+#   {"timeout": 2.0}
+#   {"timeout": 0.2, "startup_timeout": 30, "action": "warn"}
+#   {"timeout": 10, "channel": "stdout", "marker": "HEARTBEAT"}
+#
+# Heartbeats are received on a pipe passed to the service ("fd" channel), or
+# as marker lines on stdout ("stdout" channel). A single timer is armed for
+# the current deadline, and heartbeats only record the time, so frequent
+# heartbeats are cheap. on_missed is called when no heartbeat was received
+# within timeout seconds, or within startup_timeout seconds of the start, and
+# again only after heartbeats have resumed.
+
+_default_marker = "PYRI_HEARTBEAT"
+
+
+def parse_heartbeat_settings(name, settings, default_startup_timeout):
+    if settings is None:
+        return None
+    if isinstance(settings, (int, float)):
+        settings = {"timeout": settings}
+    settings = dict(settings)
+    if "timeout" not in settings:
+        raise ValueError(f"Heartbeat settings of service {name} must include timeout")
+    settings["timeout"] = float(settings["timeout"])
+    settings["startup_timeout"] = float(settings.get("startup_timeout", default_startup_timeout))
+    settings.setdefault("channel", "fd")
+    settings.setdefault("marker", _default_marker)
+    settings.setdefault("action", "restart")
+    if settings["channel"] not in ("fd", "stdout"):
+        raise ValueError(f"Invalid heartbeat channel for service {name}: {settings['channel']}")
+    if settings["action"] not in ("restart", "warn"):
+        raise ValueError(f"Invalid heartbeat action for service {name}: {settings['action']}")
+    return settings
+
+
+class PyriHeartbeatWatchdog:
+    def __init__(self, loop, name, timeout, startup_timeout, on_missed, channel="fd", marker=_default_marker,
+            action="restart"):
+        self._loop = loop
+        self.name = name
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.channel = channel
+        self.marker = marker
+        self.action = action
+        self._on_missed = on_missed
+        self._read_fd = None
+        self._write_fd = None
+        self._started = None
+        self._last = None
+        self._handle = None
+        self._closed = False
+        self.missed_count = 0
+
+    def open_pipe(self):
+        # Returns the write end of the heartbeat pipe, to be inherited by the service
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        return self._write_fd
+
+    def service_env(self):
+        if self._write_fd is not None:
+            return {heartbeat.heartbeat_fd_env: str(self._write_fd)}
+        return {heartbeat.heartbeat_marker_env: self.marker}
+
+    def start(self):
+        # Called after the service process is created
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        if self._read_fd is not None:
+            self._loop.add_reader(self._read_fd, self._on_readable)
+        self._started = self._loop.time()
+        self._arm(self._started + self.startup_timeout)
+
+    def beat(self):
+        now = self._loop.time()
+        if self._started is not None and not self._closed and (self._last is None or self._handle is None):
+            # First heartbeat, the timer is armed for the later startup deadline. Or the first
+            # heartbeat after a missed deadline, when the timer is not armed.
+            self._cancel()
+            self._arm(now + self.timeout)
+        self._last = now
+
+    def feed_line(self, stream, line):
+        if stream == "stdout" and self.marker in line:
+            self.beat()
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._read_fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            # The service closed the pipe, it is exiting. Heartbeats are no longer expected.
+            self._loop.remove_reader(self._read_fd)
+            self._cancel()
+            return
+        self.beat()
+
+    def _deadline(self):
+        if self._last is None:
+            return self._started + self.startup_timeout
+        return self._last + self.timeout
+
+    def _arm(self, deadline):
+        self._handle = self._loop.call_at(deadline, self._check)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self):
+        self._handle = None
+        if self._closed:
+            return
+        now = self._loop.time()
+        deadline = self._deadline()
+        if now < deadline:
+            self._arm(deadline)
+            return
+        elapsed = now - (self._last if self._last is not None else self._started)
+        self.missed_count += 1
+        # Each hang is reported once, the timer is armed again by the next heartbeat
+        self._last = now
+        try:
+            self._on_missed(elapsed)
+        except Exception:
+            traceback.print_exc()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._cancel()
+        if self._read_fd is not None:
+            self._loop.remove_reader(self._read_fd)
+            os.close(self._read_fd)
+            self._read_fd = None
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
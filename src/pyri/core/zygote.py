@@ -0,0 +1,176 @@
+import argparse
+import array
+import gc
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import traceback
+from . import process_resources
+from . import heartbeat
+
+# Fork server used by pyri-core on Linux. Heavy modules are imported once,
+# then services are forked from this process instead of starting a new
+# interpreter for each service. Requests are received as JSON messages on a
+# SOCK_SEQPACKET socket, with the stdout and stderr pipes of the new service
+# passed as file descriptors.
+
+
+def _send(sock, msg):
+    sock.send(json.dumps(msg).encode("utf-8"))
+
+
+def _recv_msg(sock):
+    fds = array.array("i")
+    data, ancdata, flags, _ = sock.recvmsg(65536, socket.CMSG_SPACE(16 * fds.itemsize))
+    for level, type_, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(data) == 0:
+        return None, []
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _preimport(modules):
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except Exception:
+            print(f"Warning: fork server could not preimport {m}", file=sys.stderr)
+    if threading.active_count() > 1:
+        print("Warning: fork server has running threads after preimport, forked services may be unstable",
+            file=sys.stderr)
+
+
+def _fork_service(sock, wakeup_r, msg, fds):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid, None
+
+    # Child process
+    try:
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sock.close()
+        os.close(wakeup_r)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        extra_fds = [os.dup(fd) for fd in fds[2:]]
+        for fd in fds:
+            os.close(fd)
+        env = msg.get("env", None)
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        for name, fd in zip(msg.get("fd_env", []), extra_fds):
+            os.environ[name] = str(fd)
+        cwd = msg.get("cwd", None)
+        if cwd is not None:
+            os.chdir(cwd)
+        process_resources.apply_resources(msg.get("resources", None))
+        return 0, msg
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+
+
+def serve(sock):
+    # SIGCHLD wakes up select() through the wakeup fd
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _send(sock, {"op": "ready", "pid": os.getpid()})
+
+    while True:
+        try:
+            r, _, _ = select.select([sock, wakeup_r], [], [])
+        except InterruptedError:
+            continue
+
+        if wakeup_r in r:
+            try:
+                os.read(wakeup_r, 4096)
+            except BlockingIOError:
+                pass
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                _send(sock, {"op": "exited", "pid": pid, "returncode": _exit_code(status)})
+
+        if sock in r:
+            msg, fds = _recv_msg(sock)
+            if msg is None:
+                # Launcher has gone away
+                return None
+            if msg["op"] == "spawn":
+                try:
+                    pid, child_msg = _fork_service(sock, wakeup_r, msg, fds)
+                except Exception as e:
+                    _send(sock, {"op": "error", "id": msg["id"], "error": str(e)})
+                    pid, child_msg = None, None
+                if pid == 0:
+                    return child_msg
+                for fd in fds:
+                    os.close(fd)
+                if pid is not None:
+                    _send(sock, {"op": "spawned", "id": msg["id"], "pid": pid})
+            else:
+                for fd in fds:
+                    os.close(fd)
+                _send(sock, {"op": "error", "id": msg.get("id", None), "error": f"Invalid op {msg['op']}"})
+
+
+def run_service(msg):
+    import runpy
+    module_main = msg["module_main"]
+    heartbeat.install_stack_dump_handler()
+    sys.argv = [module_main] + list(msg.get("args", []))
+    runpy.run_module(module_main, run_name="__main__", alter_sys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser("PyRI Core Fork Server")
+    parser.add_argument("--fd", type=int, required=True)
+    parser.add_argument("--preimport", type=str, default="")
+    parser_results = parser.parse_args()
+
+    _preimport([m for m in parser_results.preimport.split(",") if len(m) > 0])
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        # Keep preimported objects out of the collector so forked pages stay shared
+        gc.freeze()
+
+    sock = socket.socket(fileno=parser_results.fd)
+    child_msg = serve(sock)
+    if child_msg is None:
+        return
+    run_service(child_msg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import sys
+import time
+
+# Test service: prints a line on stdout and stderr, then runs until SIGINT
+
+name = sys.argv[1] if len(sys.argv) > 1 else "echo"
+print(f"{name} started", flush=True)
+print(f"{name} stderr", file=sys.stderr, flush=True)
+try:
+    while True:
+        time.sleep(0.05)
+except KeyboardInterrupt:
+    print(f"{name} stopping", flush=True)
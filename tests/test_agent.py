@@ -0,0 +1,96 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+from pyri.core import agent
+from pyri.core import heartbeat
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Uses SIGINT to stop services")
+
+_services_dir = str(Path(__file__).parent.joinpath("services"))
+_token = "test-token"
+
+
+@pytest.fixture
+def service_path(monkeypatch):
+    # The agents run the test services with their own environment
+    monkeypatch.setenv("PYTHONPATH", _services_dir)
+
+
+async def _read_line(stream, timeout=10):
+    return (await asyncio.wait_for(stream.readline(), timeout)).decode("utf-8").strip()
+
+
+@pytest.mark.asyncio
+async def test_two_agents_start_stop_and_stream_output(service_path):
+    loop = asyncio.get_running_loop()
+    agents = [agent.PyriAgent("127.0.0.1", 0, _token, stop_grace_period=2) for _ in range(2)]
+    clients = []
+    try:
+        for a in agents:
+            await a.start()
+        for i, a in enumerate(agents):
+            c = agent.PyriAgentClient(loop, f"agent{i}", "127.0.0.1", a.port, _token)
+            await c.connect()
+            clients.append(c)
+
+        env = {heartbeat.heartbeat_marker_env: "HB"}
+        processes = [await c.create_subprocess("echo_service", [f"service{i}"], env)
+            for i, c in enumerate(clients)]
+        for i, p in enumerate(processes):
+            assert p.remote
+            assert await _read_line(p.stdout) == f"service{i} started"
+            assert await _read_line(p.stderr) == f"service{i} stderr"
+
+        processes[0].send_term()
+        assert await asyncio.wait_for(processes[0].wait(), 10) == 0
+        assert await _read_line(processes[0].stdout) == "service0 stopping"
+        # The service on the other agent keeps running
+        assert processes[1].returncode is None
+
+        processes[1].kill()
+        assert await asyncio.wait_for(processes[1].wait(), 10) != 0
+    finally:
+        for c in clients:
+            c.close()
+        for a in agents:
+            await a.close()
+
+
+@pytest.mark.asyncio
+async def test_agent_rejects_invalid_token(service_path):
+    a = agent.PyriAgent("127.0.0.1", 0, _token)
+    await a.start()
+    try:
+        c = agent.PyriAgentClient(asyncio.get_running_loop(), "agent", "127.0.0.1", a.port, "wrong")
+        with pytest.raises(ConnectionError):
+            await c.connect()
+    finally:
+        await a.close()
+
+
+@pytest.mark.asyncio
+async def test_agent_rejects_environment(service_path):
+    a = agent.PyriAgent("127.0.0.1", 0, _token)
+    await a.start()
+    c = agent.PyriAgentClient(asyncio.get_running_loop(), "agent", "127.0.0.1", a.port, _token)
+    try:
+        await c.connect()
+        with pytest.raises(OSError, match="LD_PRELOAD"):
+            await c.create_subprocess("echo_service", [], {"LD_PRELOAD": "/tmp/x.so"})
+        with pytest.raises(OSError, match="invalid module"):
+            await c.create_subprocess("-c", ["print()"])
+    finally:
+        c.close()
+        await a.close()
+
+
+@pytest.mark.asyncio
+async def test_agent_requires_token_on_public_address():
+    with pytest.raises(ValueError):
+        await agent.PyriAgent("0.0.0.0", 0, None).start()
+    assert agent.is_loopback_address("127.0.0.1")
+    assert agent.is_loopback_address("::1")
+    assert not agent.is_loopback_address("192.168.1.20")
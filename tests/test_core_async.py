@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import selectors
+import time
+
+import pytest
+
+pytest.importorskip("pyri.plugins.service_node_launch")
+
+from pyri.plugins.service_node_launch import ServiceNodeLaunch
+from pyri.core.__main__ import PyriCore, ProcessState
+
+# The core runs on an event loop whose clock jumps ahead when the loop would sleep, so
+# restart backoffs of several seconds run in a few milliseconds. The service processes are
+# replaced with fake processes that exit after a given time.
+
+_ready = {"readiness": {"type": "stdout", "marker": "READY"}}
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, loop_ref):
+        super().__init__()
+        self._loop_ref = loop_ref
+
+    def select(self, timeout=None):
+        events = super().select(0 if timeout is not None and timeout <= 0 else 0.002)
+        if len(events) == 0 and timeout is not None and timeout > 0:
+            self._loop_ref[0].offset += timeout
+        return events
+
+
+class _VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        ref = [None]
+        super().__init__(_VirtualSelector(ref))
+        ref[0] = self
+        self.offset = 0.0
+
+    def time(self):
+        return time.monotonic() + self.offset
+
+
+class _FakeProcess:
+    def __init__(self, loop, run_time, returncode):
+        self.pid = 0
+        self.returncode = None
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self.stdout.feed_data(b"READY\n")
+        self._loop = loop
+        self._exit = loop.create_future()
+        if run_time is not None:
+            loop.call_later(run_time, self._finish, returncode)
+
+    def _finish(self, returncode):
+        if self._exit.done():
+            return
+        self.returncode = returncode
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+        self._exit.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._exit)
+
+    def send_term(self):
+        self._loop.call_soon(self._finish, -15)
+
+    def kill(self):
+        self._finish(-9)
+
+    def close(self):
+        self.kill()
+
+
+class _FakeCore(PyriCore):
+    def __init__(self, *args, run_times=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.run_times = run_times or dict()
+        self.start_times = dict()
+
+    async def create_service_subprocess(self, name, module_main, args, env=None, watchdog=None):
+        self.start_times.setdefault(name, []).append(self.clock())
+        return _FakeProcess(self._loop, self.run_times.get(name, None), 1)
+
+
+def _launch(name, depends=[], **kwargs):
+    extra_params = dict(_ready)
+    extra_params.update(kwargs.pop("extra_params", dict()))
+    return ServiceNodeLaunch(name, "test", "json.tool", depends=depends, extra_params=extra_params, **kwargs)
+
+
+def _run(coro):
+    loop = _VirtualLoop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _core(launches, tmp_path, **kwargs):
+    parser_results = argparse.Namespace(resource_sample_interval=0, loop_stats_interval=0)
+    return _FakeCore(None, launches, parser_results, tmp_path, **kwargs)
+
+
+def test_on_demand_start_waits_for_dependencies(tmp_path):
+    launches = [_launch("dep"), _launch("a", depends=["dep"], extra_params={"activation": "on-demand"})]
+
+    async def run():
+        async with _core(launches, tmp_path) as core:
+            assert core.get_process_state("a") == ProcessState.STOPPED
+            await core.start("a", wait_ready=True, timeout=10)
+            assert core.start_times["dep"][0] <= core.start_times["a"][0]
+            assert core.get_process_state("dep") == ProcessState.RUNNING
+            assert core.get_process_state("a") == ProcessState.RUNNING
+            await core.stop("a")
+            assert core.get_process_state("a") == ProcessState.STOPPED
+            assert core.get_process_state("dep") == ProcessState.RUNNING
+
+    _run(run())
+
+
+def test_crashing_service_backs_off_and_trips_breaker(tmp_path):
+    launches = [_launch("crash", restart=True, restart_backoff=5, extra_params={
+        "activation": "on-demand", "restart_max_crashes": 3, "restart_crash_window": 600, "restart_jitter": 0})]
+
+    async def run():
+        async with _core(launches, tmp_path, run_times={"crash": 0.5}) as core:
+            await core.start("crash")
+            await core.wait_state("crash", [ProcessState.FAILED], timeout=1000)
+            return core.start_times["crash"]
+
+    start_times = _run(run())
+    assert len(start_times) == 3
+    # The backoff doubles after each crash, the service runs for 0.5 s each time
+    delays = [t2 - t1 - 0.5 for t1, t2 in zip(start_times, start_times[1:])]
+    assert delays == pytest.approx([5, 10], abs=0.1)
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("RobotRaconteurCompanion.Util.IdentifierUtil")
+
+from pyri.core.default_devices import PyriDefaultDeviceRegistration
+
+
+class _DeviceManager:
+    def __init__(self, active, fail):
+        self.active = [SimpleNamespace(local_device_name=n) for n in active]
+        self.fail = dict(fail)
+        self.active_calls = 0
+        self.added = []
+
+    async def async_getf_active_devices(self, _):
+        self.active_calls += 1
+        return list(self.active)
+
+    async def async_add_device(self, ident, local_device_name, *args):
+        if self.fail.get(local_device_name, 0) > 0:
+            self.fail[local_device_name] -= 1
+            raise Exception("not ready")
+        self.added.append(local_device_name)
+
+
+@pytest.mark.asyncio
+async def test_only_failed_devices_are_retried_with_cached_active_devices():
+    c = _DeviceManager(["d0"], {"d2": 2})
+    r = PyriDefaultDeviceRegistration([(f"dev{i}", f"d{i}") for i in range(4)], retry_backoff=0.01)
+    results = await r.run(lambda: c)
+    assert sorted(c.added) == ["d1", "d2", "d3"]
+    assert not results["d0"].added
+    assert results["d2"].attempts == 3
+    assert c.active_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_connect_warning_is_rate_limited(capsys):
+    c = _DeviceManager([], {})
+    clients = [None] * 20 + [c]
+    now = [0.0]
+
+    def get_client():
+        # Each attempt advances the clock by one second
+        now[0] += 1
+        return clients.pop(0)
+
+    r = PyriDefaultDeviceRegistration([("dev0", "d0")], clock=lambda: now[0])
+    await r.run(get_client, client_wait=0)
+    warnings = [l for l in capsys.readouterr().out.splitlines() if "could not connect" in l]
+    assert len(warnings) == 4
@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pyri.core import dependencies
+
+
+def _launches(graph):
+    return {name: SimpleNamespace(depends=deps) for name, deps in graph.items()}
+
+
+def test_cycle_is_reported_with_its_path():
+    with pytest.raises(dependencies.DependencyCycleError) as e:
+        dependencies.build_dependency_graph(_launches({"a": ["b"], "b": ["c"], "c": ["a"], "d": []}))
+    cycle = e.value.cycle
+    assert cycle[0] == cycle[-1]
+    assert sorted(cycle[:-1]) == ["a", "b", "c"]
+
+
+def test_self_dependency_is_a_cycle():
+    assert dependencies.find_dependency_cycle({"a": ["a"]}) == ["a", "a"]
+
+
+def test_unknown_dependencies_are_ignored():
+    graph = dependencies.build_dependency_graph(_launches({"a": ["missing", "b", "b"], "b": None}))
+    assert graph == {"a": ["b"], "b": []}
+
+
+def test_tiers_and_transitive_dependencies():
+    graph = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"]}
+    assert dependencies.find_dependency_cycle(graph) is None
+    assert dependencies.dependency_tiers(graph) == [["a"], ["b", "c"], ["d"]]
+    assert sorted(dependencies.transitive_dependencies(graph, "d")) == ["a", "b", "c"]
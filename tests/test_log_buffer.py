@@ -0,0 +1,32 @@
+from pyri.core.log_buffer import PyriLogBuffer
+
+
+def _texts(lines):
+    return [l.text for l in lines]
+
+
+def test_oldest_lines_are_dropped_at_line_limit():
+    b = PyriLogBuffer(max_lines=5, max_bytes=1024)
+    b.append("stdout", ["1", "2", "3"])
+    b.append("stdout", ["4", "5", "6", "7"])
+    assert _texts(b.tail(10)) == ["3", "4", "5", "6", "7"]
+    # Trimming part of a chunk keeps the sequence numbers of the remaining lines
+    assert b.first_seq == 3
+    assert b.last_seq == 7
+    assert [l.seq for l in b.since(0)] == [3, 4, 5, 6, 7]
+
+
+def test_oldest_lines_are_dropped_at_byte_limit():
+    b = PyriLogBuffer(max_lines=100, max_bytes=10)
+    b.append("stdout", ["aaaa", "bbbb"])
+    b.append("stderr", ["cccc"])
+    assert _texts(b.tail(10)) == ["bbbb", "cccc"]
+    assert _texts(b.tail(10, stream="stderr")) == ["cccc"]
+
+
+def test_chunk_larger_than_limit_keeps_newest_lines():
+    b = PyriLogBuffer(max_lines=3, max_bytes=1024)
+    b.append("stdout", [str(i) for i in range(10)])
+    assert _texts(b.since(0)) == ["7", "8", "9"]
+    assert b.first_seq == 8
+    assert _texts(b.since(8)) == ["8", "9"]
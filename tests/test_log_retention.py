@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from pyri.core import log_retention
+
+
+def _make_run(log_root, name, size=1024):
+    p = log_root.joinpath(name)
+    p.mkdir()
+    p.joinpath("service.txt").write_bytes(b"x" * size)
+    return p
+
+
+def test_prune_skips_running_runs(tmp_path):
+    old = _make_run(tmp_path, "pyri-core-2020-01-01--00-00-00")
+    live = _make_run(tmp_path, "pyri-core-2020-01-02--00-00-00")
+    lock = log_retention.lock_run(live)
+    try:
+        assert log_retention.run_locked(live)
+        assert not log_retention.run_locked(old)
+        removed, compacted = log_retention.apply_retention(tmp_path, max_age_days=30, compact_days=1)
+        assert removed == [old]
+        assert compacted == []
+        assert live.joinpath("service.txt").is_file()
+    finally:
+        lock.close()
+    assert not log_retention.run_locked(live)
+    assert log_retention.compact_runs(tmp_path, 1) == [live]
+    assert live.joinpath("service.txt.gz").is_file()
+
+
+def test_prune_by_size_removes_oldest_first(tmp_path):
+    runs = [_make_run(tmp_path, f"pyri-core-2020-01-0{i}--00-00-00", 1024 * 1024) for i in range(1, 4)]
+    removed = log_retention.prune_runs(tmp_path, max_total_mb=2.5, now=datetime(2020, 2, 1))
+    assert removed == runs[:1]
+    assert log_retention.list_runs(tmp_path) == runs[1:]
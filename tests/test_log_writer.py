@@ -0,0 +1,42 @@
+import asyncio
+import gzip
+import threading
+
+import pytest
+
+from pyri.core.log_writer import PyriLogWriter
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_writer(tmp_path):
+    writer = PyriLogWriter(max_queue_bytes=1024)
+    try:
+        log = writer.open(str(tmp_path.joinpath("out.txt")))
+        # Simulates a slow disk, the writer thread waits for the gate before writing
+        gate = threading.Event()
+        do_write = log._do_write
+        log._do_write = lambda data: gate.wait(5) and do_write(data)
+        log.write(b"x" * 4096)
+        drained = asyncio.ensure_future(log.drain())
+        await asyncio.sleep(0.1)
+        assert not drained.done()
+        gate.set()
+        await asyncio.wait_for(drained, 5)
+        assert writer._queued_bytes < writer.max_queue_bytes
+        log.close()
+    finally:
+        writer.close()
+    assert tmp_path.joinpath("out.txt").read_bytes() == b"x" * 4096
+
+
+def test_compressed_rotation_keeps_backup_order(tmp_path):
+    fname = str(tmp_path.joinpath("out.txt"))
+    writer = PyriLogWriter(max_bytes=100, backup_count=3, compress=True)
+    log = writer.open(fname)
+    for i in range(4):
+        log.write(bytes([ord("a") + i]) * 100)
+    log.close()
+    writer.close()
+    backups = [gzip.decompress(tmp_path.joinpath(f"out.txt.{i}.gz").read_bytes()) for i in range(1, 4)]
+    assert backups == [b"d" * 100, b"c" * 100, b"b" * 100]
+    assert list(tmp_path.glob("*.rotated-*")) == []
@@ -0,0 +1,22 @@
+import pytest
+
+from pyri.core import process_resources
+
+
+def test_parse_cpu_list():
+    assert process_resources.parse_cpu_list("0-3,6") == [0, 1, 2, 3, 6]
+    assert process_resources.parse_cpu_list(" 2 , 1-2,") == [1, 2]
+    assert process_resources.parse_cpu_list(4) == [4]
+    assert process_resources.parse_cpu_list([3, 1, 3]) == [1, 3]
+
+
+def test_parse_cpu_list_rejects_invalid_ranges():
+    with pytest.raises(ValueError):
+        process_resources.parse_cpu_list("0-a")
+
+
+def test_parse_resources_option():
+    assert process_resources.parse_resources_option("robot:cpu_affinity=2-3;sched_policy=fifo;sched_priority=50") == \
+        ("robot", {"cpu_affinity": "2-3", "sched_policy": "fifo", "sched_priority": 50})
+    with pytest.raises(ValueError):
+        process_resources.parse_resources_option("cpu_affinity=2")
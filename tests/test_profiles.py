@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pyri.core import profiles
+
+
+def _launch(name, **kwargs):
+    kwargs.setdefault("extra_params", None)
+    return SimpleNamespace(name=name, depends=[], restart=False, prepare_service_args=lambda r: ["--base"], **kwargs)
+
+
+def test_profile_settings_are_merged_into_launch():
+    profile = profiles.parse_profile({"default_enabled": True, "services": {
+        "robot": {"restart": True, "extra_args": ["--robot-info-file", "abb_1200.yml"], "activation": "on-demand"},
+        "vision": {"enabled": False}}})
+    launches = profiles.apply_profile([_launch("robot", extra_params={"readiness": "stdout"}), _launch("vision"),
+        _launch("other")], profile)
+    assert [l.name for l in launches] == ["robot", "other"]
+    robot = launches[0]
+    assert robot.restart is True
+    assert robot.depends == []
+    assert robot.prepare_service_args(None) == ["--base", "--robot-info-file", "abb_1200.yml"]
+    assert robot.extra_params == {"readiness": "stdout", "activation": "on-demand"}
+
+
+def test_changed_services_between_profiles():
+    old = profiles.parse_profile({"services": {"a": {"restart": True}, "b": {}, "c": {"enabled": False}}})
+    new = profiles.parse_profile({"services": {"a": {"restart": False}, "b": {"enabled": False}, "c": {}}})
+    assert profiles.changed_services(old, new, ["a", "b", "c", "d"]) == (["c"], ["b"], ["a"])
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        profiles.parse_profile({"services": {"a": {"extra_args": "--not-a-list"}}})
+    with pytest.raises(ValueError):
+        profiles.parse_profile({"services": {"a": {"enabled": "no"}}})
+
+
+def test_unknown_settings_are_merged_with_a_warning(capsys):
+    profile = profiles.parse_profile({"services": {"a": {"restrat": True, "activation": "on-demand"}}})
+    out = capsys.readouterr().out
+    assert "restrat" in out
+    assert "activation" not in out
+    assert profiles.apply_profile([_launch("a")], profile)[0].extra_params == \
+        {"restrat": True, "activation": "on-demand"}
+    with pytest.raises(ValueError):
+        profiles.parse_profile({"services": {"a": {"module_main": "other"}}})
@@ -0,0 +1,32 @@
+import os
+import socket
+
+import pytest
+
+from pyri.core import resource_monitor
+
+pytestmark = pytest.mark.skipif(not resource_monitor.resource_monitor_supported(), reason="Requires /proc")
+
+
+def test_client_connections_count_only_accepted_connections(tmp_path):
+    pid = os.getpid()
+    base = resource_monitor.read_client_connections(pid)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    unix_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_server.bind(str(tmp_path.joinpath("sock")))
+    unix_server.listen()
+    sockets = [server, unix_server]
+    try:
+        # The client ends are connections made by this process and are not counted
+        client = socket.create_connection(server.getsockname())
+        sockets.extend([client, server.accept()[0]])
+        assert resource_monitor.read_client_connections(pid) == base + 1
+        unix_client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_client.connect(str(tmp_path.joinpath("sock")))
+        sockets.extend([unix_client, unix_server.accept()[0]])
+        assert resource_monitor.read_client_connections(pid) == base + 2
+    finally:
+        for s in sockets:
+            s.close()
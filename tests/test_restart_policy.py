@@ -0,0 +1,50 @@
+from pyri.core.restart_policy import RestartPolicy
+
+
+def _policy(**kwargs):
+    return RestartPolicy(random=lambda: 0.5, **kwargs)
+
+
+def test_backoff_grows_to_max_and_resets_after_stable_run():
+    p = _policy(initial_backoff=1, max_backoff=5, max_crashes=0)
+    assert [p.record_exit(t * 100, 1) for t in range(5)] == [1, 2, 4, 5, 5]
+    assert p.record_exit(1000, 60) == 1
+
+
+def test_jitter_is_applied():
+    p = RestartPolicy(initial_backoff=10, jitter=0.1, max_crashes=0, random=lambda: 1.0)
+    assert abs(p.record_exit(0, 1) - 11) < 1e-9
+
+
+def test_breaker_trips_on_crashes_within_window():
+    p = _policy(initial_backoff=0.1, max_crashes=3, crash_window=60, stable_uptime=0.5)
+    assert p.record_exit(0, 10) is not None
+    assert p.record_exit(10, 10) is not None
+    assert p.record_exit(20, 10) is None
+
+
+def test_breaker_trips_on_service_that_dies_on_startup_with_default_settings():
+    # With the default backoff the crashes of a service that dies after 1 s are spread over more
+    # than crash_window, they are counted because the service never runs for stable_uptime
+    p = _policy(initial_backoff=5)
+    now = 0
+    restarts = 0
+    while True:
+        now += 1
+        delay = p.record_exit(now, 1)
+        if delay is None:
+            break
+        restarts += 1
+        now += delay
+    assert restarts == 4
+    assert p.unstable_crashes == 5
+
+
+def test_stable_run_resets_unstable_crashes():
+    p = _policy(initial_backoff=1, max_crashes=3, crash_window=1)
+    for t in range(2):
+        assert p.record_exit(t * 100, 1) is not None
+    assert p.record_exit(200, 120) is not None
+    assert p.unstable_crashes == 0
+    p.reset()
+    assert p.attempt == 0